@@ -0,0 +1,208 @@
+"""
+admission.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-05
+
+Admission control for the submit endpoint.
+
+Before a workflow is enqueued, `admit_jobs` verifies that the system can take it and reserves its job:
+- the Celery queue of its lane is not longer than `MAX_QUEUE_DEPTH`
+- the estimated work pending on its lane is below `MAX_PENDING_SECONDS`
+- the upload directory has at least `MIN_FREE_DISK_BYTES` available
+- at least one worker reports `MIN_WORKER_MEMORY_BYTES` of available memory (skipped if no worker reports)
+- the application is below its concurrency cap (`HELICAL_APP_CONCURRENCY_CAPS`, e.g. "1=4,2=2")
+
+The application cap and the lane backlog are checked atomically with the reservation of the jobs (see
+`app.scheduling.reserve_jobs`), so that concurrent submissions cannot exceed them.
+
+System-wide overload is reported as 503 and a per-application cap as 429, both with a `Retry-After` header
+and an estimated wait. Workers publish their available memory to Redis through `publish_worker_resources`.
+"""
+import os
+import shutil
+import threading
+import time
+
+import redis
+
+from app.scheduling import LANE_WORKERS, lane_backlog, plan_job, reserve_jobs, ReservationRejected
+
+MAX_QUEUE_DEPTH = int(os.getenv("HELICAL_MAX_QUEUE_DEPTH", "100"))
+MAX_PENDING_SECONDS = float(os.getenv("HELICAL_MAX_PENDING_SECONDS", str(4 * 3600)))
+MIN_FREE_DISK_BYTES = int(os.getenv("HELICAL_MIN_FREE_DISK_BYTES", str(2 * 1024 ** 3)))
+MIN_WORKER_MEMORY_BYTES = int(os.getenv("HELICAL_MIN_WORKER_MEMORY_BYTES", str(2 * 1024 ** 3)))
+DEFAULT_APP_CONCURRENCY = int(os.getenv("HELICAL_DEFAULT_APP_CONCURRENCY", "0"))  # 0 = unlimited
+RESOURCE_RETRY_AFTER_SECONDS = 60
+MAX_RETRY_AFTER_SECONDS = 3600
+
+WORKER_RESOURCES_KEY = "helical:worker_resources:{hostname}"
+WORKER_RESOURCES_INTERVAL_SECONDS = 10
+
+redis_client = redis.Redis(host="redis", port=6379, db=0)
+
+
+def _parse_caps(value):
+    """Parses `HELICAL_APP_CONCURRENCY_CAPS` ("<application_id>=<cap>,...") into a dict."""
+    caps = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        application_id, cap = item.split("=")
+        caps[int(application_id)] = int(cap)
+    return caps
+
+
+APP_CONCURRENCY_CAPS = _parse_caps(os.getenv("HELICAL_APP_CONCURRENCY_CAPS", ""))
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a workflow cannot be admitted.
+
+    Attributes:
+        status_code (int): 429 for a per-application cap, 503 for system-wide overload
+        reason (str): Machine-readable reason
+        message (str): Human-readable message
+        retry_after (int): Seconds after which the client should retry
+        estimated_wait (float): Estimated seconds until the system can take the job
+    """
+
+    def __init__(self, status_code, reason, message, retry_after, estimated_wait):
+        super().__init__(message)
+        self.status_code = status_code
+        self.reason = reason
+        self.message = message
+        self.retry_after = int(min(max(retry_after, 1), MAX_RETRY_AFTER_SECONDS))
+        self.estimated_wait = round(estimated_wait, 1)
+
+    def detail(self):
+        return {
+            "reason": self.reason,
+            "message": self.message,
+            "retry_after": self.retry_after,
+            "estimated_wait_seconds": self.estimated_wait,
+        }
+
+
+def application_cap(application_id):
+    """Returns the concurrency cap of an application (0 = unlimited)."""
+    return APP_CONCURRENCY_CAPS.get(application_id, DEFAULT_APP_CONCURRENCY)
+
+
+def worker_available_memory():
+    """
+    Returns the available memory reported by each live worker.
+
+    Returns:
+        dict: Hostname -> available bytes
+    """
+    resources = {}
+    for key in redis_client.scan_iter(WORKER_RESOURCES_KEY.format(hostname="*")):
+        value = redis_client.get(key)
+        if value is not None:
+            resources[key.decode().rsplit(":", 1)[-1]] = int(value)
+    return resources
+
+
+def check_disk_space(path):
+    """
+    Raises `AdmissionRejected` if the volume holding `path` is almost full.
+
+    Args:
+        path (str): Directory on the volume to check
+    """
+    free = shutil.disk_usage(path).free
+    if free < MIN_FREE_DISK_BYTES:
+        raise AdmissionRejected(
+            503, "disk_full", f"Not enough free disk space ({free // 1024 ** 2} MB available)",
+            RESOURCE_RETRY_AFTER_SECONDS, RESOURCE_RETRY_AFTER_SECONDS
+        )
+
+
+def admit_jobs(application_id, jobs, upload_dir):
+    """
+    Checks whether new workflows can be enqueued and reserves their jobs.
+
+    Args:
+        application_id (int): Application of the workflows
+        jobs (list): (workflow ID, number of cells of the upload, models) of each workflow, see
+            `app.scheduling.reserve_jobs`. Several workflows are admitted at once for batch submissions.
+        upload_dir (str): Directory where uploads and results are written
+
+    Returns:
+        dict: Workflow ID -> schedule of its job; the caller releases the jobs it does not enqueue
+
+    Raises:
+        AdmissionRejected: If the workflows must be rejected; no job is reserved then
+    """
+    lanes = [plan_job(n_cells, models)[1] for _, n_cells, models in jobs]
+    waits = {lane: lane_backlog(lane) / max(LANE_WORKERS[lane], 1) for lane in lanes}
+    for lane, estimated_wait in waits.items():
+        try:
+            queue_depth = redis_client.llen(lane)
+        except redis.RedisError:
+            queue_depth = 0
+        if queue_depth + lanes.count(lane) > MAX_QUEUE_DEPTH:
+            raise AdmissionRejected(
+                503, "queue_full", f"The {lane} queue already holds {queue_depth} workflows",
+                estimated_wait, estimated_wait
+            )
+
+    check_disk_space(upload_dir)
+
+    try:
+        memory = worker_available_memory()
+    except redis.RedisError:
+        memory = {}
+    if memory and max(memory.values()) < MIN_WORKER_MEMORY_BYTES:
+        raise AdmissionRejected(
+            503, "worker_memory", "No worker currently has enough available memory",
+            RESOURCE_RETRY_AFTER_SECONDS, max(waits.values())
+        )
+
+    cap = application_cap(application_id)
+    try:
+        return reserve_jobs(jobs, application_id, cap=cap, max_pending_seconds=MAX_PENDING_SECONDS)
+    except ReservationRejected as e:
+        if e.reason == "application_concurrency":
+            raise AdmissionRejected(
+                429, "application_concurrency",
+                f"Application {application_id} has {e.value:.0f} workflows in flight, {len(jobs)} more would exceed its cap of {cap}",
+                max(waits.values()), max(waits.values())
+            )
+        estimated_wait = e.value / max(LANE_WORKERS[e.lane], 1)
+        raise AdmissionRejected(
+            503, "backlog_full", f"The {e.lane} queue already holds {e.value / 60:.0f} minutes of work",
+            e.value - MAX_PENDING_SECONDS, estimated_wait
+        )
+
+
+def _available_memory_bytes():
+    """Returns the MemAvailable value of /proc/meminfo in bytes."""
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    raise OSError("MemAvailable not found in /proc/meminfo")
+
+
+def publish_worker_resources(hostname):
+    """
+    Starts a daemon thread publishing the available memory of the worker host to Redis.
+    The key expires if the worker stops publishing, so dead workers are not taken into account.
+
+    Args:
+        hostname (str): Name of the Celery worker
+    """
+    key = WORKER_RESOURCES_KEY.format(hostname=hostname)
+
+    def _publish():
+        while True:
+            try:
+                redis_client.set(key, _available_memory_bytes(), ex=WORKER_RESOURCES_INTERVAL_SECONDS * 3)
+            except (OSError, redis.RedisError) as e:
+                print(f"Could not publish worker resources: {e}")
+            time.sleep(WORKER_RESOURCES_INTERVAL_SECONDS)
+
+    thread = threading.Thread(target=_publish, name="worker-resources", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,253 @@
+"""
+analytics.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-11
+
+Run history of the workflows, and the aggregate queries served by the `/analytics` routes.
+
+When the result of a workflow is received (see app.pubsub_listener), `record_run` writes:
+- one `RunHistory` row, with the cell count, the processing time and the end-to-end latency of the run
+- one `RunStage` row per stage span (see app.telemetry.StageRecorder)
+- `ResultMetadata` rows for the other scalar metadata of the run (profiled, token cache hit, shards, models, ...)
+- an increment of the `RunDailySummary` row of its day, model, application and status
+
+Recording is idempotent: `RunHistory.workflow_id` is unique, so a result received twice (e.g. by several API
+replicas subscribed to the channel) is recorded once. The queries only read indexed columns of the run history
+and the pre-rolled daily summary, never the result blobs of `Workflow`.
+"""
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+from db.models import RunHistory, RunStage, ResultMetadata, RunDailySummary, Model
+
+# Metadata of a result stored in the columns of RunHistory / RunStage rather than as ResultMetadata rows
+RECORDED_METADATA = {"model", "application", "input_file_name", "created_at", "n_cells", "wall_seconds", "stages"}
+
+
+def record_run(db, workflow, result, now=None):
+    """
+    Records a finished run in the run history and the daily summary.
+
+    Args:
+        db (Session): The database session; the pending changes of the caller must be committed beforehand
+        workflow (Workflow): The workflow which produced the result
+        result (dict): The published result
+        now (datetime | None): End of the run, defaults to `datetime.utcnow()`
+
+    Returns:
+        RunHistory | None: The recorded run, or None if it was already recorded
+    """
+    now = now or datetime.utcnow()
+    metadata = result.get("metadata", {})
+    stages = metadata.get("stages", [])
+    status = result.get("status", "finished")
+    n_cells = metadata.get("n_cells")
+    wall_seconds = metadata.get("wall_seconds")
+    if wall_seconds is None and stages:
+        wall_seconds = sum(span["wall_seconds"] for span in stages)
+
+    run = RunHistory(
+        workflow_id=workflow.id,
+        model_id=workflow.model_id,
+        application_id=workflow.application_id,
+        timestamp=now,
+        result_path=f"annotated_data_{workflow.id}.csv" if status == "completed" else None,
+        status=status,
+        n_cells=n_cells,
+        wall_seconds=wall_seconds,
+        latency_seconds=(now - workflow.created_at).total_seconds() if workflow.created_at else None,
+    )
+    run.stages = [
+        RunStage(
+            stage=span["stage"],
+            shard=span.get("shard"),
+            wall_seconds=span["wall_seconds"],
+            cpu_seconds=span.get("cpu_seconds"),
+            peak_rss_bytes=span.get("peak_rss_bytes"),
+            n_cells=span.get("n_cells"),
+        )
+        for span in stages
+    ]
+    run.run_info = [
+        ResultMetadata(key=key, value=value if isinstance(value, str) else json.dumps(value))
+        for key, value in metadata.items() if key not in RECORDED_METADATA
+    ]
+
+    # Atomic increment, so that concurrent listeners do not lose updates
+    summary = sqlite_insert(RunDailySummary).values(
+        day=now.date(),
+        model_id=workflow.model_id,
+        application_id=workflow.application_id,
+        status=status,
+        runs=1,
+        cells=n_cells or 0,
+        wall_seconds=wall_seconds or 0.0,
+    )
+    summary = summary.on_conflict_do_update(
+        index_elements=["day", "model_id", "application_id", "status"],
+        set_={
+            "runs": RunDailySummary.runs + summary.excluded.runs,
+            "cells": RunDailySummary.cells + summary.excluded.cells,
+            "wall_seconds": RunDailySummary.wall_seconds + summary.excluded.wall_seconds,
+        },
+    )
+    try:
+        db.add(run)
+        db.flush()
+        db.execute(summary)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        print(f"Run of workflow {workflow.id} already recorded")
+        return None
+    return run
+
+
+def _model_names(db):
+    return dict(db.query(Model.id, Model.name).all())
+
+
+def throughput_by_day(db, days=7, model_id=None, application_id=None):
+    """
+    Processing throughput per model and per day, from the daily summary of the completed runs.
+
+    Args:
+        db (Session): The database session
+        days (int): Number of days, today included
+        model_id (int | None): Restrict to a model
+        application_id (int | None): Restrict to an application
+
+    Returns:
+        list: One dictionary per day and model, with the runs, cells, processing seconds and cells per second
+    """
+    since = datetime.utcnow().date() - timedelta(days=days - 1)
+    query = (
+        db.query(
+            RunDailySummary.day,
+            RunDailySummary.model_id,
+            func.sum(RunDailySummary.runs),
+            func.sum(RunDailySummary.cells),
+            func.sum(RunDailySummary.wall_seconds),
+        )
+        .filter(RunDailySummary.day >= since, RunDailySummary.status == "completed")
+    )
+    if model_id is not None:
+        query = query.filter(RunDailySummary.model_id == model_id)
+    if application_id is not None:
+        query = query.filter(RunDailySummary.application_id == application_id)
+    names = _model_names(db)
+    return [
+        {
+            "day": day.isoformat(),
+            "model_id": row_model_id,
+            "model": names.get(row_model_id),
+            "runs": runs,
+            "cells": cells,
+            "wall_seconds": round(wall_seconds, 3),
+            "cells_per_second": round(cells / wall_seconds, 2) if wall_seconds else None,
+        }
+        for day, row_model_id, runs, cells, wall_seconds in query
+        .group_by(RunDailySummary.day, RunDailySummary.model_id)
+        .order_by(RunDailySummary.day, RunDailySummary.model_id)
+    ]
+
+
+def recent_runs(db, hours=1.0, model_id=None, application_id=None):
+    """
+    Runs finished during the last hours, per model and status, from the run history.
+
+    Args:
+        db (Session): The database session
+        hours (float): Length of the window
+        model_id (int | None): Restrict to a model
+        application_id (int | None): Restrict to an application
+
+    Returns:
+        dict: Start of the window, total number of runs, and per model and status the runs, cells and
+            average processing time and latency
+    """
+    since = datetime.utcnow() - timedelta(hours=hours)
+    query = (
+        db.query(
+            RunHistory.model_id,
+            RunHistory.status,
+            func.count(RunHistory.id),
+            func.sum(RunHistory.n_cells),
+            func.avg(RunHistory.wall_seconds),
+            func.avg(RunHistory.latency_seconds),
+        )
+        .filter(RunHistory.timestamp >= since)
+    )
+    if model_id is not None:
+        query = query.filter(RunHistory.model_id == model_id)
+    if application_id is not None:
+        query = query.filter(RunHistory.application_id == application_id)
+    names = _model_names(db)
+    groups = [
+        {
+            "model_id": row_model_id,
+            "model": names.get(row_model_id),
+            "status": status,
+            "runs": runs,
+            "cells": cells or 0,
+            "avg_wall_seconds": round(avg_wall, 3) if avg_wall is not None else None,
+            "avg_latency_seconds": round(avg_latency, 3) if avg_latency is not None else None,
+        }
+        for row_model_id, status, runs, cells, avg_wall, avg_latency in query
+        .group_by(RunHistory.model_id, RunHistory.status)
+        .order_by(RunHistory.model_id, RunHistory.status)
+    ]
+    return {"since": since.isoformat(), "runs": sum(g["runs"] for g in groups), "groups": groups}
+
+
+def stage_timings(db, days=7, model_id=None):
+    """
+    Average time and memory of each stage per model, over the runs of the last days.
+
+    Args:
+        db (Session): The database session
+        days (int): Length of the window in days
+        model_id (int | None): Restrict to a model
+
+    Returns:
+        list: One dictionary per model and stage, with the number of spans, the average wall and CPU seconds,
+            the maximal peak RSS and the cells per second of the stage
+    """
+    since = datetime.utcnow() - timedelta(days=days)
+    query = (
+        db.query(
+            RunHistory.model_id,
+            RunStage.stage,
+            func.count(RunStage.id),
+            func.avg(RunStage.wall_seconds),
+            func.avg(RunStage.cpu_seconds),
+            func.max(RunStage.peak_rss_bytes),
+            func.sum(RunStage.n_cells),
+            func.sum(RunStage.wall_seconds),
+        )
+        .join(RunStage, RunStage.run_id == RunHistory.id)
+        .filter(RunHistory.timestamp >= since, RunHistory.status == "completed")
+    )
+    if model_id is not None:
+        query = query.filter(RunHistory.model_id == model_id)
+    names = _model_names(db)
+    return [
+        {
+            "model_id": row_model_id,
+            "model": names.get(row_model_id),
+            "stage": stage,
+            "spans": spans,
+            "avg_wall_seconds": round(avg_wall, 4),
+            "avg_cpu_seconds": round(avg_cpu, 4) if avg_cpu is not None else None,
+            "max_peak_rss_bytes": max_rss,
+            "cells_per_second": round(cells / total_wall, 2) if cells and total_wall else None,
+        }
+        for row_model_id, stage, spans, avg_wall, avg_cpu, max_rss, cells, total_wall in query
+        .group_by(RunHistory.model_id, RunStage.stage)
+        .order_by(RunHistory.model_id, RunStage.stage)
+    ]
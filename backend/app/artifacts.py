@@ -0,0 +1,268 @@
+"""
+artifacts.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-09
+
+Artifact store of the shared data volume.
+
+Every file written by the API and the workers belongs to a class of artifacts, stored in its own directory:
+- `uploads`: the uploaded files, normally deleted at the end of their workflow (but not when it fails)
+- `intermediate`: the memory-mapped embedding buffers, checkpoints, and shard outputs and descriptors of running
+  workflows
+- `results`: the annotated CSV files and profile artifacts served by `/download` and `/profile`
+
+The store enforces, for each class, a time to live since the last access, and a total quota
+(`ARTIFACT_QUOTA_BYTES`) together with the `MIN_FREE_DISK_BYTES` of the admission control, by evicting the least
+recently used artifacts. Artifacts of the workflows still in progress are never removed.
+
+`start_reaper` runs the eviction periodically in a daemon thread of the API; a Redis lock makes sure that only
+one API replica reaps at a time. The token cache (see ml.token_cache) and the embedding index (see
+ml.embedding_index) manage their own quotas; both are only reported.
+"""
+import glob
+import os
+import shutil
+import threading
+import time
+
+import redis
+
+from app.admission import MIN_FREE_DISK_BYTES
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UPLOAD_DIR = os.path.join(BASE_DIR, "data", "tmp")
+RESULTS_DIR = os.path.join(UPLOAD_DIR, "results")
+EMBEDDING_DIR = os.path.join(UPLOAD_DIR, "embeddings")
+
+HOUR = 3600
+ARTIFACT_CLASSES = {
+    "uploads": {
+        "dir": UPLOAD_DIR,
+        "pattern": "*",
+        "ttl_seconds": float(os.getenv("HELICAL_UPLOAD_TTL_HOURS", "24")) * HOUR,
+    },
+    "intermediate": {
+        "dir": EMBEDDING_DIR,
+        "pattern": "*",
+        "ttl_seconds": float(os.getenv("HELICAL_INTERMEDIATE_TTL_HOURS", "6")) * HOUR,
+    },
+    "results": {
+        "dir": RESULTS_DIR,
+        "pattern": "*",
+        "ttl_seconds": float(os.getenv("HELICAL_RESULTS_TTL_HOURS", str(7 * 24))) * HOUR,
+    },
+}
+ARTIFACT_QUOTA_BYTES = int(os.getenv("HELICAL_ARTIFACT_QUOTA_BYTES", str(50 * 1024 ** 3)))
+REAPER_INTERVAL_SECONDS = float(os.getenv("HELICAL_REAPER_INTERVAL_SECONDS", "300"))
+REAPER_LOCK_KEY = "helical:artifact_reaper"
+
+redis_client = redis.Redis(host="redis", port=6379, db=0)
+
+
+def artifact_path(kind, name):
+    """
+    Returns the path of an artifact.
+
+    Args:
+        kind (str): Class of the artifact, a key of `ARTIFACT_CLASSES`
+        name (str): File name of the artifact
+
+    Returns:
+        str: Path of the artifact
+    """
+    return os.path.join(ARTIFACT_CLASSES[kind]["dir"], name)
+
+
+def touch(path):
+    """
+    Marks an artifact as used now, for the TTL and LRU bookkeeping (the volume may be mounted with noatime).
+
+    Args:
+        path (str): Path of the artifact
+    """
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def list_artifacts():
+    """
+    Lists the artifacts of every class.
+
+    Returns:
+        list: Dictionaries with the kind, path, name, size in bytes and last access time (mtime) of each artifact
+    """
+    artifacts = []
+    for kind, spec in ARTIFACT_CLASSES.items():
+        for path in glob.glob(os.path.join(spec["dir"], spec["pattern"])):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Deleted in the meantime
+            if os.path.isfile(path):
+                artifacts.append({
+                    "kind": kind,
+                    "path": path,
+                    "name": os.path.basename(path),
+                    "bytes": stat.st_size,
+                    "last_used": stat.st_mtime,
+                })
+    return artifacts
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def artifact_usage():
+    """
+    Reports the disk usage of the artifacts.
+
+    Returns:
+        dict: Per class file count, bytes, age of the oldest artifact and TTL; total, quota and free disk space
+    """
+    now = time.time()
+    artifacts = list_artifacts()
+    classes = {}
+    for kind, spec in ARTIFACT_CLASSES.items():
+        own = [a for a in artifacts if a["kind"] == kind]
+        classes[kind] = {
+            "files": len(own),
+            "bytes": sum(a["bytes"] for a in own),
+            "oldest_seconds": round(now - min(a["last_used"] for a in own), 1) if own else None,
+            "ttl_seconds": spec["ttl_seconds"],
+        }
+    from ml.token_cache import TOKEN_CACHE_DIR, TOKEN_CACHE_MAX_BYTES
+    classes["token_cache"] = {
+        "bytes": _dir_size(TOKEN_CACHE_DIR),
+        "quota_bytes": TOKEN_CACHE_MAX_BYTES,
+    }
+    from ml.embedding_index import EMBEDDING_INDEX_DIR
+    classes["embedding_index"] = {"bytes": _dir_size(EMBEDDING_INDEX_DIR)}
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    return {
+        "classes": classes,
+        "total_bytes": sum(c["bytes"] for kind, c in classes.items() if kind in ARTIFACT_CLASSES),
+        "quota_bytes": ARTIFACT_QUOTA_BYTES,
+        "disk_free_bytes": shutil.disk_usage(UPLOAD_DIR).free,
+        "min_free_disk_bytes": MIN_FREE_DISK_BYTES,
+    }
+
+
+def _remove(artifact, reason):
+    try:
+        os.remove(artifact["path"])
+    except OSError as e:
+        print(f"Could not remove artifact {artifact['path']}: {e}")
+        return False
+    print(f"Removed {artifact['kind']} artifact {artifact['name']} ({artifact['bytes'] / 1024 ** 2:.1f} MB, {reason})")
+    return True
+
+
+def reap(in_use=(), now=None):
+    """
+    Removes the expired artifacts, then the least recently used ones while the artifacts exceed the quota or
+    the free disk space is below `MIN_FREE_DISK_BYTES`.
+
+    Args:
+        in_use (Iterable[str]): IDs of the uploads and workflows in progress; artifacts whose name contains one
+            of them are never removed
+        now (float | None): Current time, defaults to `time.time()`
+
+    Returns:
+        list: The removed artifacts
+    """
+    now = time.time() if now is None else now
+    in_use = [i for i in in_use if i]
+    removed = []
+    kept = []
+    for artifact in list_artifacts():
+        if any(i in artifact["name"] for i in in_use):
+            continue
+        if now - artifact["last_used"] > ARTIFACT_CLASSES[artifact["kind"]]["ttl_seconds"]:
+            if _remove(artifact, "expired"):
+                removed.append(artifact)
+        else:
+            kept.append(artifact)
+
+    total = sum(a["bytes"] for a in list_artifacts())
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    free = shutil.disk_usage(UPLOAD_DIR).free
+    for artifact in sorted(kept, key=lambda a: a["last_used"]):
+        if total <= ARTIFACT_QUOTA_BYTES and free >= MIN_FREE_DISK_BYTES:
+            break
+        if _remove(artifact, "evicted"):
+            removed.append(artifact)
+            total -= artifact["bytes"]
+            free += artifact["bytes"]
+    return removed
+
+
+def artifacts_in_use():
+    """
+    Returns the IDs of the workflows which may still be running, and of their uploads.
+    A pending workflow whose Celery task already finished (e.g. failed) does not hold its artifacts anymore.
+
+    Returns:
+        set: Workflow and upload IDs
+    """
+    from app.worker import celery_app
+    from db.database import SessionLocal
+    from db.models import Workflow
+    from app.memoization import IN_PROGRESS_STATUSES
+
+    db = SessionLocal()
+    try:
+        in_use = set()
+        for workflow in db.query(Workflow).filter(Workflow.status.in_(IN_PROGRESS_STATUSES)).all():
+            if workflow.task_id and celery_app.AsyncResult(workflow.task_id).ready():
+                continue
+            in_use.add(workflow.id)
+            if workflow.upload_id:
+                in_use.add(workflow.upload_id)
+        return in_use
+    finally:
+        db.close()
+
+
+def reap_once():
+    """
+    Runs one eviction pass, unless another process ran one during the last interval.
+
+    Returns:
+        list | None: The removed artifacts, or None if the pass was skipped
+    """
+    try:
+        if not redis_client.set(REAPER_LOCK_KEY, os.getpid(), nx=True, ex=max(1, int(REAPER_INTERVAL_SECONDS) - 1)):
+            return None
+    except redis.RedisError as e:
+        print(f"Could not take the artifact reaper lock, reaping anyway: {e}")
+    return reap(artifacts_in_use())
+
+
+def start_reaper():
+    """
+    Starts the daemon thread removing expired and least recently used artifacts every `REAPER_INTERVAL_SECONDS`.
+    """
+    def loop():
+        while True:
+            try:
+                removed = reap_once()
+                if removed:
+                    print(f"Artifact reaper freed {sum(a['bytes'] for a in removed) / 1024 ** 2:.1f} MB")
+            except Exception as e:
+                print(f"Artifact reaper failed: {e}")
+            time.sleep(REAPER_INTERVAL_SECONDS)
+
+    thread = threading.Thread(target=loop, name="artifact-reaper", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,95 @@
+"""
+cancellation.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-14
+
+Cooperative cancellation of the workflows.
+
+`DELETE /workflow/{job_id}` revokes the Celery task of the workflow, which drops it if it is still queued, and
+sets a cancellation flag in Redis for the case where it is already running: revoking does not stop a running task
+(terminating the worker process would also lose its loaded models). The tasks call `check_cancelled` between the
+stages of the pipeline and between the embedding batches (see `app.tasks.pipeline.embed_cells`), which raises
+`WorkflowCancelled`; the task then cleans up its temporary files, releases its job and publishes a "cancelled"
+result, so the worker is free again within one embedding batch.
+
+This module only depends on Redis, so the API can import it.
+"""
+import json
+
+import redis
+
+CANCEL_KEY = "helical:cancel:{workflow_id}"
+# The flag outlives any queued task of the workflow
+CANCEL_TTL_SECONDS = 24 * 3600
+
+redis_client = redis.Redis(host="redis", port=6379, db=0)
+
+
+class WorkflowCancelled(Exception):
+    """Raised in a task when its workflow was cancelled."""
+
+    def __init__(self, workflow_id):
+        super().__init__(f"Workflow {workflow_id} was cancelled")
+        self.workflow_id = workflow_id
+
+
+def request_cancel(workflow_id):
+    """Sets the cancellation flag of a workflow, read by its running tasks."""
+    redis_client.set(CANCEL_KEY.format(workflow_id=workflow_id), 1, ex=CANCEL_TTL_SECONDS)
+
+
+def is_cancelled(workflow_id):
+    """Returns whether the workflow was cancelled. Redis errors never cancel a workflow."""
+    try:
+        return bool(redis_client.exists(CANCEL_KEY.format(workflow_id=workflow_id)))
+    except redis.RedisError as e:
+        print(f"Could not read the cancellation flag of workflow {workflow_id}: {e}")
+        return False
+
+
+def check_cancelled(workflow_id):
+    """
+    Cancellation point of a task.
+
+    Raises:
+        WorkflowCancelled: If the workflow was cancelled
+    """
+    if is_cancelled(workflow_id):
+        raise WorkflowCancelled(workflow_id)
+
+
+def cancelled_result(workflow_id):
+    """Returns the result stored for a cancelled workflow."""
+    return {"workflow_id": workflow_id, "status": "cancelled"}
+
+
+def publish_cancelled(workflow_id):
+    """Publishes the "cancelled" result of a workflow on the results channel (see app.pubsub_listener)."""
+    redis_client.publish("workflow_results", json.dumps(cancelled_result(workflow_id)))
+    print(f"Workflow {workflow_id} cancelled")
+
+
+def failed_result(workflow_id, error=None):
+    """Returns the result stored for a workflow whose task failed."""
+    result = {"workflow_id": workflow_id, "status": "failed"}
+    if error:
+        result["error"] = error
+    return result
+
+
+def publish_failed(workflow_id, error=None):
+    """
+    Publishes the "failed" result of a workflow on the results channel, so that the workflow (and the workflows
+    attached to it) end instead of staying in progress.
+
+    Args:
+        workflow_id (str): ID of the workflow
+        error (str | None): Description of the failure, stored with the result
+    """
+    try:
+        redis_client.publish("workflow_results", json.dumps(failed_result(workflow_id, error)))
+    except redis.RedisError as e:
+        print(f"Could not publish the failure of workflow {workflow_id}: {e}")
+        return
+    print(f"Workflow {workflow_id} failed: {error}")
@@ -0,0 +1,167 @@
+"""
+checkpoints.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-15
+
+Stage checkpoints of the workflows, so that a task redelivered after a worker crash resumes where it stopped.
+
+`tasks.run_workflow` is acknowledged late and rejected when its worker process is lost (`acks_late`,
+`reject_on_worker_lost`): a worker killed by the OOM killer or restarted in the middle of a run does not lose the
+job, the broker delivers it again. The redelivered task resumes after the last checkpointed stage:
+
+- tokenized input: the token cache (see ml.token_cache), keyed by the content of the upload
+- `embed`: the embedding buffer
+- `classify`: the probabilities of the cell type head and its prediction statistics
+- `umap`: the UMAP layout and its quality report
+
+The arrays are stored in the "intermediate" class of the storage backend (see app.storage), so the task may
+resume on another host with a remote storage. The manifest of a workflow (completed stages and their metadata,
+settings of the run and number of attempts) is a Redis hash: a stage is only recorded once its files are stored,
+so an interrupted checkpoint is simply redone. The checkpoints are removed when the task ends, whether it
+completed or failed, since only a lost worker leads to a redelivery.
+
+A workflow is given up after `MAX_TASK_ATTEMPTS` deliveries, so that a job which always crashes its worker does
+not loop forever.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import redis
+
+from app.storage import get_storage
+
+CHECKPOINTS_ENABLED = os.getenv("HELICAL_CHECKPOINTS", "1") != "0"
+CHECKPOINT_TTL_SECONDS = int(float(os.getenv("HELICAL_CHECKPOINT_TTL_HOURS", "24")) * 3600)
+MAX_TASK_ATTEMPTS = int(os.getenv("HELICAL_MAX_TASK_ATTEMPTS", "3"))
+CHECKPOINT_KEY = "helical:checkpoint:{workflow_id}"
+STAGE_PREFIX = "stage:"
+
+redis_client = redis.Redis(host="redis", port=6379, db=0)
+
+
+def _link_or_copy(src, dst):
+    """Makes `dst` a hard link to `src` (no copy on the same file system), or a copy of it."""
+    if os.path.abspath(src) == os.path.abspath(dst):
+        return
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class WorkflowCheckpoint:
+    """
+    Checkpoints of the stages of one workflow run.
+    """
+
+    def __init__(self, workflow_id, settings):
+        """
+        Opens the checkpoints of a workflow and counts a new attempt. Checkpoints written with other settings
+        (e.g. another model for the same workflow ID) are discarded.
+
+        Args:
+            workflow_id (str): ID of the workflow
+            settings (dict): JSON-serializable settings of the run which alter the stage outputs
+        """
+        self.workflow_id = workflow_id
+        self.key = CHECKPOINT_KEY.format(workflow_id=workflow_id)
+        self.fingerprint = json.dumps(settings, sort_keys=True)
+        self.storage = get_storage()
+        self.stages = {}
+        self.attempt = 1
+        self.enabled = CHECKPOINTS_ENABLED
+        if not self.enabled:
+            return
+        try:
+            manifest = {k.decode(): v.decode() for k, v in redis_client.hgetall(self.key).items()}
+            if manifest and manifest.get("fingerprint") != self.fingerprint:
+                self.clear()
+                manifest = {}
+            self.stages = {
+                field[len(STAGE_PREFIX):]: json.loads(value)
+                for field, value in manifest.items() if field.startswith(STAGE_PREFIX)
+            }
+            pipe = redis_client.pipeline()
+            pipe.hset(self.key, "fingerprint", self.fingerprint)
+            pipe.hincrby(self.key, "attempts", 1)
+            pipe.expire(self.key, CHECKPOINT_TTL_SECONDS)
+            self.attempt = pipe.execute()[1]
+        except redis.RedisError as e:
+            print(f"Checkpoints of workflow {workflow_id} disabled: {e}")
+            self.enabled = False
+            self.stages = {}
+
+    def object_name(self, name):
+        """Returns the name of a checkpointed file in the storage (it contains the workflow ID)."""
+        return f"checkpoint_{self.workflow_id}_{name}.npy"
+
+    def get(self, stage):
+        """Returns the metadata of a completed stage, or None if the stage has to be run."""
+        return self.stages.get(stage)
+
+    def save(self, stage, files=None, info=None):
+        """
+        Records a completed stage, once its files are stored.
+
+        Args:
+            stage (str): Name of the stage
+            files (dict | None): File name -> array to save, or path of an .npy file written by the stage
+            info (dict | None): JSON-serializable metadata of the stage, returned by `get`
+        """
+        if not self.enabled:
+            return
+        try:
+            for name, value in (files or {}).items():
+                local = self.storage.local_path("intermediate", self.object_name(name))
+                if isinstance(value, str):
+                    _link_or_copy(value, local)
+                else:
+                    np.save(local, value)
+                self.storage.put("intermediate", self.object_name(name), local)
+            entry = {**(info or {}), "files": sorted(files or {})}
+            pipe = redis_client.pipeline()
+            pipe.hset(self.key, STAGE_PREFIX + stage, json.dumps(entry))
+            pipe.expire(self.key, CHECKPOINT_TTL_SECONDS)
+            pipe.execute()
+            self.stages[stage] = entry
+        except (OSError, redis.RedisError) as e:
+            # A missing checkpoint only costs a recomputation after a crash
+            print(f"Could not checkpoint stage {stage} of workflow {self.workflow_id}: {e}")
+
+    def load(self, name, path=None):
+        """
+        Loads a checkpointed array.
+
+        Args:
+            name (str): File name given to `save`
+            path (str | None): If set, the file is restored at this path and memory-mapped in read/write mode
+                (like an `embedding_buffer`); otherwise it is read into memory
+
+        Returns:
+            ndarray: The array
+        """
+        stored = self.storage.fetch("intermediate", self.object_name(name))
+        if path is None:
+            return np.load(stored)
+        _link_or_copy(stored, path)
+        return np.load(path, mmap_mode="r+")
+
+    def clear(self):
+        """Removes the checkpointed files and the manifest of the workflow."""
+        if not self.enabled:
+            return
+        try:
+            for field, value in redis_client.hgetall(self.key).items():
+                if field.decode().startswith(STAGE_PREFIX):
+                    for name in json.loads(value).get("files", []):
+                        self.storage.delete("intermediate", self.object_name(name))
+            redis_client.delete(self.key)
+        except (OSError, redis.RedisError) as e:
+            print(f"Could not clear the checkpoints of workflow {self.workflow_id}: {e}")
+        self.stages = {}
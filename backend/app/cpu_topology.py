@@ -0,0 +1,211 @@
+"""
+cpu_topology.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-13
+
+CPU partitioning of the Celery worker processes.
+
+Torch (intra-op and inter-op pools), the BLAS library of NumPy/SciPy (OpenMP or OpenBLAS threads) and numba
+(used by UMAP) each size their thread pool to the whole machine. With several Celery child processes, every
+process then runs as many threads as there are cores and they fight over the same cores; with a single child,
+big machines are only used through the parts of the pipeline which are multithreaded.
+
+The CPUs of a worker are those of its affinity mask (e.g. the `cpuset` of its container), restricted to
+`HELICAL_WORKER_CPUS` when set: several workers sharing a host (like the `worker` and `worker-fast` services of
+docker-compose.yaml) are given disjoint CPU lists so that they do not oversubscribe the cores either.
+
+At startup, each child process (`configure_worker_process`, called from `worker_process_init`):
+- takes its share of the CPUs of the worker: the physical cores are split in contiguous blocks
+  between the `concurrency` children, by child index (the index of a replaced child is reused)
+- optionally pins itself to these CPUs (`HELICAL_WORKER_CPU_AFFINITY=1`), so that the threads it starts
+  stay on its cores and keep their caches
+- limits torch, OpenMP/BLAS (through threadpoolctl, when installed) and numba to one thread per physical
+  core of its share (or `HELICAL_WORKER_THREADS`)
+
+The share of a child includes the SMT siblings of its cores, but the thread counts only use physical cores:
+the dense kernels of the pipeline do not gain from hyper-threads.
+"""
+import os
+
+WORKER_THREADS = int(os.getenv("HELICAL_WORKER_THREADS", "0"))  # 0 = physical cores of the share of the process
+WORKER_CPU_AFFINITY = os.getenv("HELICAL_WORKER_CPU_AFFINITY", "0") == "1"
+# CPU list in cpuset syntax ("0-3,8"), an open range ("2-") running to the last CPU; empty = every available CPU
+WORKER_CPUS = os.getenv("HELICAL_WORKER_CPUS", "")
+THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+]
+SYS_CPU_DIR = "/sys/devices/system/cpu"
+
+# Number of child processes of the worker, set in the parent process before the pool starts
+_pool_size = None
+# Keeps the threadpoolctl limits alive for the lifetime of the process
+_threadpool_limits = None
+
+
+def set_pool_size(concurrency):
+    """Records the number of child processes of the worker, inherited by the children."""
+    global _pool_size
+    _pool_size = max(1, int(concurrency or 1))
+
+
+def available_cpus():
+    """Returns the sorted CPUs the process may run on (affinity mask / cpuset of the container)."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def parse_cpu_list(spec, last_cpu):
+    """
+    Parses a CPU list in cpuset syntax, e.g. "0-3,8,10-11". An open range "N-" runs to `last_cpu`.
+
+    Args:
+        spec (str): The CPU list
+        last_cpu (int): Last CPU of the open ranges
+
+    Returns:
+        list: Sorted logical CPU numbers
+
+    Raises:
+        ValueError: If the list is malformed
+    """
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.update(range(int(first), (int(last) if last else last_cpu) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def worker_cpus():
+    """
+    Returns the CPUs of the worker: the available CPUs, restricted to `HELICAL_WORKER_CPUS` when it is set.
+    A list matching none of the available CPUs is ignored, with a warning.
+    """
+    cpus = available_cpus()
+    if not WORKER_CPUS:
+        return cpus
+    selected = [cpu for cpu in parse_cpu_list(WORKER_CPUS, max(cpus)) if cpu in cpus]
+    if not selected:
+        print(f"Warning: HELICAL_WORKER_CPUS={WORKER_CPUS} matches none of the CPUs {cpus}, using all of them")
+        return cpus
+    return selected
+
+
+def _read_topology(cpu, name):
+    try:
+        with open(os.path.join(SYS_CPU_DIR, f"cpu{cpu}", "topology", name)) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def physical_cores(cpus):
+    """
+    Groups CPUs by physical core (SMT siblings together), ordered by socket and core.
+
+    Args:
+        cpus (list): Logical CPU numbers
+
+    Returns:
+        list: One list of logical CPUs per physical core. Each CPU is its own core when the topology is unknown.
+    """
+    cores = {}
+    for cpu in cpus:
+        package, core = _read_topology(cpu, "physical_package_id"), _read_topology(cpu, "core_id")
+        key = (package, core) if package is not None and core is not None else (-1, cpu)
+        cores.setdefault(key, []).append(cpu)
+    return [cores[key] for key in sorted(cores)]
+
+
+def partition_cpus(index, n_processes, cpus=None):
+    """
+    Share of the CPUs of one child process: a contiguous block of physical cores (with their siblings).
+
+    When there are fewer physical cores than processes, the processes share cores round-robin.
+
+    Args:
+        index (int): Index of the child process, in [0, n_processes)
+        n_processes (int): Number of child processes
+        cpus (list | None): CPUs to split, defaults to `worker_cpus()`
+
+    Returns:
+        tuple: (logical CPUs of the share, number of physical cores of the share)
+    """
+    cores = physical_cores(cpus if cpus is not None else worker_cpus())
+    n_processes = max(1, n_processes)
+    index = index % n_processes
+    if len(cores) < n_processes:
+        share = [cores[index % len(cores)]]
+    else:
+        start = index * len(cores) // n_processes
+        stop = (index + 1) * len(cores) // n_processes
+        share = cores[start:stop]
+    return sorted(cpu for core in share for cpu in core), len(share)
+
+
+def limit_threads(n_threads):
+    """
+    Limits the thread pools of torch, OpenMP/BLAS and numba of the current process.
+
+    The environment variables are set for the libraries (and subprocesses) which read them later; the
+    libraries already imported are limited through their runtime APIs.
+
+    Args:
+        n_threads (int): Number of threads per pool
+    """
+    global _threadpool_limits
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(n_threads)
+
+    try:
+        import torch
+        torch.set_num_threads(n_threads)
+        try:
+            torch.set_num_interop_threads(max(1, min(n_threads, 4)))
+        except RuntimeError:
+            pass  # Can only be set before the first inter-op parallel work
+    except ImportError:
+        pass
+
+    try:
+        from threadpoolctl import threadpool_limits
+        _threadpool_limits = threadpool_limits(limits=n_threads)
+    except ImportError:
+        print("threadpoolctl is not installed, the BLAS thread pool is only limited through the environment")
+
+    try:
+        import numba
+        numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
+    except ImportError:
+        pass
+
+
+def configure_worker_process():
+    """
+    Assigns its CPUs and thread counts to the current Celery child process.
+
+    Returns:
+        dict: Index of the process, its CPUs and its number of threads
+    """
+    from billiard.process import current_process
+
+    index = getattr(current_process(), "index", None) or 0
+    n_processes = _pool_size or int(os.getenv("HELICAL_WORKER_CONCURRENCY", "1"))
+    cpus, n_cores = partition_cpus(index, n_processes)
+    if WORKER_CPU_AFFINITY:
+        # Threads inherit the affinity of the thread which starts them, so this comes before any pool is started
+        os.sched_setaffinity(0, cpus)
+    n_threads = WORKER_THREADS or n_cores
+    limit_threads(n_threads)
+    print(f"Worker process {index}/{n_processes}: CPUs {cpus}, {n_threads} threads"
+          f"{' (pinned)' if WORKER_CPU_AFFINITY else ''}")
+    return {"index": index, "cpus": cpus, "threads": n_threads}
@@ -0,0 +1,127 @@
+"""
+inspection.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-04
+
+Lightweight inspection of uploaded .h5ad files. The functions in this module only read the HDF5 header and
+metadata with h5py, they never load the expression matrix, so they are cheap enough to be called from the API.
+
+`inspect_h5ad` is called by `/upload`, and its output is stored in the `dataset_info` table so that `/submit`
+can validate a dataset and estimate its run time without opening the file again.
+"""
+import h5py
+
+
+def _matrix_shape(f):
+    """
+    Returns the shape of the `X` matrix of an open .h5ad file, for both dense and sparse encodings.
+    """
+    X = f["X"]
+    if isinstance(X, h5py.Dataset):
+        return tuple(X.shape)
+    shape = X.attrs.get("shape", X.attrs.get("h5sparse_shape"))
+    return tuple(int(s) for s in shape)
+
+
+def count_cells(path):
+    """
+    Returns the number of cells (observations) of an .h5ad file without loading it.
+
+    Args:
+        path (str): Path of the .h5ad file
+
+    Returns:
+        int: Number of cells
+    """
+    with h5py.File(path, "r") as f:
+        return int(_matrix_shape(f)[0])
+
+
+def _as_str_list(dataset):
+    """Reads a dataset of (variable or fixed length) strings, or of other scalars, as a list of str."""
+    if h5py.check_string_dtype(dataset.dtype) is not None:
+        return list(dataset.asstr()[...])
+    return [v.decode() if isinstance(v, bytes) else str(v) for v in dataset[...]]
+
+
+def _read_strings(node):
+    """
+    Reads a column of strings stored either as a plain dataset or as an anndata categorical (codes + categories).
+    """
+    if isinstance(node, h5py.Group):
+        categories = _as_str_list(node["categories"])
+        return [categories[c] if c >= 0 else "" for c in node["codes"][...]]
+    return _as_str_list(node)
+
+
+def _read_var_column(f, column):
+    """
+    Reads a column of `var`, for both the current (group per column) and the legacy (compound dataset) layouts.
+
+    Returns:
+        list | None: The values, or None if the column does not exist
+    """
+    var = f.get("var")
+    if var is None:
+        return None
+    if isinstance(var, h5py.Group):
+        return _read_strings(var[column]) if column in var else None
+    if var.dtype.names and column in var.dtype.names:
+        return [v.decode() if isinstance(v, bytes) else str(v) for v in var[column]]
+    return None
+
+
+def inspect_h5ad(path, gene_names="gene_name"):
+    """
+    Reads the header of an .h5ad file: shape, sparsity, dtype and gene names.
+    Only the metadata is read, the expression values are never loaded.
+
+    Args:
+        path (str): Path of the .h5ad file
+        gene_names (str): Column of `var` holding the gene names
+
+    Returns:
+        dict: n_obs, n_vars, nnz, sparsity, dtype, x_encoding, has_gene_name and gene_names (list or None)
+    """
+    with h5py.File(path, "r") as f:
+        n_obs, n_vars = _matrix_shape(f)
+        X = f["X"]
+        if isinstance(X, h5py.Dataset):
+            x_encoding = "dense"
+            dtype = str(X.dtype)
+            nnz = None  # Counting the zeros would require reading the whole matrix
+        else:
+            x_encoding = X.attrs.get("encoding-type", X.attrs.get("h5sparse_format", "sparse"))
+            x_encoding = x_encoding.decode() if isinstance(x_encoding, bytes) else str(x_encoding)
+            dtype = str(X["data"].dtype)
+            nnz = int(X["data"].shape[0])
+        genes = _read_var_column(f, gene_names)
+
+    total = n_obs * n_vars
+    return {
+        "n_obs": int(n_obs),
+        "n_vars": int(n_vars),
+        "nnz": nnz,
+        "sparsity": round(1 - nnz / total, 6) if nnz is not None and total else None,
+        "dtype": dtype,
+        "x_encoding": x_encoding,
+        "has_gene_name": genes is not None,
+        "gene_names": genes,
+    }
+
+
+def vocabulary_overlap(genes, vocabulary):
+    """
+    Returns the fraction of the genes of a dataset which are in the vocabulary of a model.
+
+    Args:
+        genes (list): Gene names of the dataset
+        vocabulary (set): Gene names known by the model
+
+    Returns:
+        float | None: The overlap, or None if the dataset has no genes
+    """
+    if not genes:
+        return None
+    return round(sum(1 for g in genes if g in vocabulary) / len(genes), 4)
@@ -8,18 +8,26 @@ Modules:
     - upload: Handles file uploads.
     - workflow: Manages workflow execution and status tracking.
     - meta: Provides metadata endpoints (e.g., list of models).
+    - analytics: Aggregates over the run history (throughput per model and day, recent runs, stage timings).
+    - similarity: Nearest neighbour search over the embeddings of past runs (see ml.embedding_index).
     - init_db: Initializes the SQLite database schema and structure.
     - pubsub_listener: Listens to internal pub/sub events for asynchronous updates.
-    - model_registry: Handles ML model registration logic.
+    - telemetry: Request latency, queue depth and worker stage metrics, exposed on `/metrics`.
+    - artifacts: TTL and quota of the files of the shared data volume, enforced by a background reaper.
+    - scheduling: Lanes and backlog of the jobs, whose counters are reconciled by a background thread.
+
+The API process never imports the ML stack (torch, scanpy, helical, transformers): tasks are submitted to the
+workers by name, and only the workers load the models. `benchmarks/bench_api_startup.py` checks it.
 """
-from fastapi import FastAPI
-from app.routes import upload, workflow, meta
+from fastapi import FastAPI, Request, Response
+from app.routes import upload, workflow, meta, analytics, similarity
+from app import telemetry, artifacts, scheduling
 from db.init_db import init_database
 from app.pubsub_listener import listen_to_workflow_results
 import threading
+import time
 from fastapi.middleware.cors import CORSMiddleware
 
-from ml.model_registry import ModelRegistry
 app = FastAPI()
 
 app.add_middleware( # for CORS support
@@ -33,6 +41,34 @@ app.add_middleware( # for CORS support
 app.include_router(upload.router)
 app.include_router(workflow.router)
 app.include_router(meta.router)
+app.include_router(analytics.router)
+app.include_router(similarity.router)
+
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    """
+    Middleware recording the latency of every request, labelled by route template.
+    """
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        telemetry.observe_request(request.method, route_path, status, time.perf_counter() - start)
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """
+    Prometheus endpoint exposing API latency, queue depth and the per-stage metrics of the workers.
+    """
+    payload, content_type = telemetry.render_metrics()
+    return Response(content=payload, media_type=content_type)
 
 
 @app.on_event("startup")
@@ -41,10 +77,13 @@ async def startup_event():
     Event handler triggered on application startup.
 
     Initializes the database schema and starts a daemon thread that listens
-    for workflow results published on the internal pub/sub system.
+    for workflow results published on the internal pub/sub system, the artifact reaper and the job reconciler.
     """
+    telemetry.clear_metrics_dir()
     init_database()
     thread = threading.Thread(target=listen_to_workflow_results)
     thread.daemon = True
     thread.start()
+    artifacts.start_reaper()
+    scheduling.start_reconciler()
     print("✅ Database initialized successfully.")
\ No newline at end of file
@@ -0,0 +1,111 @@
+"""
+memoization.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-06
+
+Memoization of workflow results for identical submissions.
+
+A submission is identified by a cache key computed from the SHA-256 of the uploaded file (recorded at upload
+time), the model, the application, its settings altering the results (statistics thresholds) and
+`PIPELINE_VERSION`. When a completed or in-flight workflow already has
+the same key, the submit endpoint attaches the new workflow to it instead of enqueuing a new task.
+
+`PIPELINE_VERSION` must be bumped whenever a change to the pipeline alters the results, so that previous
+results are no longer reused.
+"""
+import hashlib
+import json
+
+from app.worker import celery_app
+from db.models import Workflow
+
+PIPELINE_VERSION = "3"
+
+# Workflows with a partial result (see app.tasks.run_workflow) are still running
+IN_PROGRESS_STATUSES = ("pending", "partial")
+REUSABLE_STATUSES = IN_PROGRESS_STATUSES + ("completed",)
+FAILED_TASK_STATES = ("FAILURE", "REVOKED")
+
+
+def compute_cache_key(content_hash, model_ids, application_id, settings=None):
+    """
+    Computes the cache key of a submission.
+
+    Args:
+        content_hash (str): SHA-256 of the uploaded file
+        model_ids (list): IDs of the models, in submission order (the first one is the primary model)
+        application_id (int): ID of the application
+        settings (dict | None): Settings of the application altering the results, e.g. its statistics thresholds
+
+    Returns:
+        str: The cache key (hex digest)
+    """
+    models = ",".join(str(model_id) for model_id in model_ids)
+    raw = f"{content_hash}:{models}:{application_id}:{PIPELINE_VERSION}"
+    if settings:
+        raw += f":{json.dumps(settings, sort_keys=True)}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def find_reusable_workflow(db, cache_key):
+    """
+    Finds a completed or in-flight workflow with the given cache key.
+
+    In-flight workflows whose Celery task failed or was revoked are skipped, since they will never publish a result.
+
+    Args:
+        db (Session): Database session
+        cache_key (str): Cache key of the submission
+
+    Returns:
+        Workflow | None: The workflow to attach to, if any
+    """
+    return find_reusable_workflows(db, [cache_key]).get(cache_key)
+
+
+def find_reusable_workflows(db, cache_keys):
+    """
+    Finds the completed or in-flight workflows of several cache keys with a single query (batch submissions).
+
+    Args:
+        db (Session): Database session
+        cache_keys (list): Cache keys of the submissions
+
+    Returns:
+        dict: Cache key -> workflow to attach to, for the keys which have one
+    """
+    candidates = (
+        db.query(Workflow)
+        .filter(Workflow.cache_key.in_(cache_keys), Workflow.attached_to.is_(None), Workflow.status.in_(REUSABLE_STATUSES))
+        .order_by(Workflow.created_at.desc())
+        .all()
+    )
+    reusable = {}
+    for workflow in candidates:
+        if workflow.cache_key in reusable:
+            continue
+        if workflow.status == "completed" and workflow.result:
+            reusable[workflow.cache_key] = workflow
+        elif workflow.status in IN_PROGRESS_STATUSES and workflow.task_id:
+            if celery_app.AsyncResult(workflow.task_id).state not in FAILED_TASK_STATES:
+                reusable[workflow.cache_key] = workflow
+    return reusable
+
+
+def attached_result(result, workflow_id, source_workflow_id):
+    """
+    Returns a copy of a result for a workflow attached to another one.
+
+    Args:
+        result (dict): Result of the source workflow
+        workflow_id (str): ID of the attached workflow
+        source_workflow_id (str): ID of the workflow which produced the result
+
+    Returns:
+        dict: The result, with the attached workflow ID and a reference to the source workflow
+    """
+    result = dict(result)
+    result["workflow_id"] = workflow_id
+    result["metadata"] = {**result.get("metadata", {}), "reused_from": source_workflow_id}
+    return result
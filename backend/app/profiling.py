@@ -0,0 +1,124 @@
+"""
+profiling.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-03
+
+This module provides the opt-in profiler used by `run_workflow` when a workflow is submitted with
+`profile=true`. Two artifacts are produced for each profiled workflow:
+
+- `profile_{workflow_id}.pstats`: deterministic profile from cProfile, readable with `pstats` or snakeviz
+- `profile_{workflow_id}.folded`: collapsed stacks from a sampling thread, one line per unique stack
+  followed by its sample count, ready for flamegraph.pl or speedscope
+
+When profiling is disabled, `workflow_profiler` returns a no-op context manager so the task pays no overhead.
+"""
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+PSTATS_SUFFIX = "pstats"
+COLLAPSED_SUFFIX = "folded"
+
+
+def profile_artifact_path(folder, workflow_id, kind):
+    """
+    Returns the path of a profile artifact.
+
+    Args:
+        folder (str): Directory holding the artifacts
+        workflow_id (str): ID of the profiled workflow
+        kind (str): Either `PSTATS_SUFFIX` or `COLLAPSED_SUFFIX`
+
+    Returns:
+        str: Path of the artifact
+    """
+    return os.path.join(folder, f"profile_{workflow_id}.{kind}")
+
+
+def _frame_name(frame):
+    """Formats a frame as `function (file:line)`, with the file shortened to its last two components."""
+    code = frame.f_code
+    filename = os.path.join(*code.co_filename.split(os.sep)[-2:]) if code.co_filename else "?"
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """
+    Sampling profiler collecting the stacks of one thread at a fixed interval.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        """
+        Args:
+            thread_id (int): Identifier of the thread to sample
+            interval (float): Sampling interval in seconds
+        """
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def write_collapsed(self, path):
+        """Writes the collected stacks in the collapsed (folded) format."""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def _profile(folder, workflow_id, interval):
+    os.makedirs(folder, exist_ok=True)
+    profiler = cProfile.Profile()
+    sampler = StackSampler(threading.get_ident(), interval=interval)
+    start = time.perf_counter()
+    sampler.start()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        sampler.stop()
+        profiler.dump_stats(profile_artifact_path(folder, workflow_id, PSTATS_SUFFIX))
+        sampler.write_collapsed(profile_artifact_path(folder, workflow_id, COLLAPSED_SUFFIX))
+        print(f"Profile of workflow {workflow_id} saved to {folder} ({time.perf_counter() - start:.1f}s profiled)")
+
+
+def workflow_profiler(enabled, folder, workflow_id, interval=0.005):
+    """
+    Returns a context manager profiling the enclosed code when `enabled` is True.
+
+    Args:
+        enabled (bool): Whether to profile
+        folder (str): Directory in which the artifacts are written
+        workflow_id (str): ID of the profiled workflow
+        interval (float): Sampling interval of the stack sampler in seconds
+
+    Returns:
+        ContextManager: The profiler, or a no-op context manager
+    """
+    if not enabled:
+        return nullcontext()
+    return _profile(folder, workflow_id, interval)
@@ -2,6 +2,14 @@
 
 This module listens to messages on the 'workflow_results' Redis channel and updates
 the corresponding workflow entry in the database with the result and status.
+Workflows attached to it (identical submissions, see app.memoization) receive a copy of the result.
+The run is then recorded in the run history (see app.analytics).
+
+A workflow may first publish a partial result (status "partial", without the UMAP layout), which is stored until
+its final result arrives. A partial or failed result never replaces the result of a workflow which is no longer in
+progress (a failed task may be reported both by the task and by its error callback), and no result replaces that
+of a cancelled workflow (see app.cancellation). Likewise, attached workflows only receive the result while they are
+in progress, so that an attached workflow cancelled on its own stays cancelled.
 """
 
 import json
@@ -9,10 +17,49 @@ import redis
 import logging
 from db.database import SessionLocal
 from db.models import Workflow
+from app.memoization import attached_result, IN_PROGRESS_STATUSES
+from app.analytics import record_run
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def apply_workflow_result(db, result):
+    """Store a published result on its workflow and on the workflows attached to it, then record the run.
+
+    Attached workflows which are no longer in progress (e.g. cancelled on their own) keep their status and result.
+
+    Args:
+        db (Session): The database session
+        result (dict): The published result, with at least a 'workflow_id' field
+
+    Returns:
+        Workflow | None: The updated workflow, or None if it is unknown or the result was ignored
+    """
+    workflow_id = result["workflow_id"]
+    status = result.get("status", "finished")
+    wf = db.query(Workflow).filter_by(id=workflow_id).first()
+    if not wf:
+        logger.warning(f"Workflow {workflow_id} not found in DB")
+        return None
+    if wf.status == "cancelled" or (status in ("partial", "failed") and wf.status not in IN_PROGRESS_STATUSES):
+        logger.info(f"Ignoring {status} result of workflow {workflow_id} ({wf.status})")
+        return None
+    logger.info(f"Found workflow {workflow_id}, updating...")
+    wf.result = json.dumps(result)
+    wf.status = status
+    attached_workflows = db.query(Workflow).filter(
+        Workflow.attached_to == workflow_id, Workflow.status.in_(IN_PROGRESS_STATUSES)
+    ).all()
+    for attached in attached_workflows:
+        attached.result = json.dumps(attached_result(result, attached.id, workflow_id))
+        attached.status = status
+    db.commit()
+    logger.info(f"Updated workflow {workflow_id}")
+    if status != "partial":
+        record_run(db, wf, result)
+    return wf
+
+
 def listen_to_workflow_results():
     """Listen to the Redis 'workflow_results' channel and update workflows in the DB.
 
@@ -34,21 +81,12 @@ def listen_to_workflow_results():
                 if not isinstance(data, dict) or "workflow_id" not in data:
                     raise ValueError("Malformed message received")
                 workflow_id = data["workflow_id"]
-                result = data
                 status = data.get("status", "finished")
 
                 logger.info(f"Status: {status}, Workflow ID: {workflow_id}")
                 db = SessionLocal()
                 try:
-                    wf = db.query(Workflow).filter_by(id=workflow_id).first()
-                    if wf:
-                        logger.info(f"Found workflow {workflow_id}, updating...")
-                        wf.result = json.dumps(result) if isinstance(result, dict) else result
-                        wf.status = status
-                        db.commit()
-                        logger.info(f"Updated workflow {workflow_id}")
-                    else:
-                        logger.warning(f"Workflow {workflow_id} not found in DB")
+                    apply_workflow_result(db, data)
                 except Exception as e:
                     logger.error(f"DB error: {e}")
                     db.rollback()
@@ -0,0 +1,152 @@
+"""
+analytics.py - API routes for aggregate questions about past runs.
+
+Author: Vincent Lefeuve
+Date: 2025-07-11
+
+Endpoints:
+    - GET /analytics/throughput
+        Cells per second per model and per day, from the pre-rolled daily summary of the completed runs.
+
+    - GET /analytics/runs
+        Runs finished during the last hours, per model and status, with their average processing time and latency.
+
+    - GET /analytics/stages
+        Average time, memory and throughput of each pipeline stage per model.
+
+The run history is written by the pub/sub listener when a workflow result arrives (see `app.analytics`);
+these routes never parse the result blobs of the workflows.
+"""
+
+from typing import Optional
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy.orm import Session
+from db.database import get_db
+from app.analytics import throughput_by_day, recent_runs, stage_timings
+
+router = APIRouter(prefix="/analytics")
+
+@router.get(
+    "/throughput",
+    summary="Throughput per model and day",
+    description="Cells processed per second by each model, per day, over the completed runs of the last days.",
+    responses={
+        200: {
+            "description": "Throughput per day and model",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "days": [
+                            {
+                                "day": "2025-07-11",
+                                "model_id": 1,
+                                "model": "Geneformer",
+                                "runs": 12,
+                                "cells": 480000,
+                                "wall_seconds": 1520.4,
+                                "cells_per_second": 315.7
+                            }
+                        ]
+                    }
+                }
+            }
+        }
+    }
+)
+def get_throughput(
+    days: int = Query(7, ge=1, le=366),
+    model_id: Optional[int] = None,
+    application_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Retrieve the throughput per model and per day.
+
+    Returns:
+        dict: A dictionary with one entry per day and model in `days`.
+    """
+    return {"days": throughput_by_day(db, days, model_id, application_id)}
+
+@router.get(
+    "/runs",
+    summary="Recent runs",
+    description="Runs finished during the last hours, per model and status.",
+    responses={
+        200: {
+            "description": "Runs of the window, per model and status",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "since": "2025-07-11T09:00:00",
+                        "runs": 5,
+                        "groups": [
+                            {
+                                "model_id": 1,
+                                "model": "Geneformer",
+                                "status": "completed",
+                                "runs": 5,
+                                "cells": 120000,
+                                "avg_wall_seconds": 84.2,
+                                "avg_latency_seconds": 131.9
+                            }
+                        ]
+                    }
+                }
+            }
+        }
+    }
+)
+def get_recent_runs(
+    hours: float = Query(1.0, gt=0, le=24 * 31),
+    model_id: Optional[int] = None,
+    application_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Retrieve the runs finished during the last `hours`.
+
+    Returns:
+        dict: The start of the window, the number of runs, and the runs per model and status.
+    """
+    return recent_runs(db, hours, model_id, application_id)
+
+@router.get(
+    "/stages",
+    summary="Stage timings",
+    description="Average wall and CPU time, peak memory and throughput of each stage per model.",
+    responses={
+        200: {
+            "description": "Timings per model and stage",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "stages": [
+                            {
+                                "model_id": 1,
+                                "model": "Geneformer",
+                                "stage": "embed",
+                                "spans": 12,
+                                "avg_wall_seconds": 61.3,
+                                "avg_cpu_seconds": 240.8,
+                                "max_peak_rss_bytes": 6442450944,
+                                "cells_per_second": 652.1
+                            }
+                        ]
+                    }
+                }
+            }
+        }
+    }
+)
+def get_stage_timings(
+    days: int = Query(7, ge=1, le=366),
+    model_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """
+    Retrieve the timings of each stage per model over the last `days`.
+
+    Returns:
+        dict: A dictionary with one entry per model and stage in `stages`.
+    """
+    return {"stages": stage_timings(db, days, model_id)}
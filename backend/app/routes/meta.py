@@ -19,6 +19,10 @@ Endpoints:
         Lists all models that are compatible with the specified application ID. Returns the application name 
         and associated models. If the application ID does not exist, returns a 404-like error payload.
 
+    - GET /storage
+        Reports the disk usage of the artifacts (uploads, intermediate arrays, results, token cache) of the
+        shared data volume, with their TTL and quota.
+
 Dependencies:
     - FastAPI
     - SQLAlchemy ORM for DB interaction
@@ -31,6 +35,8 @@ from fastapi import Depends
 from db.database import get_db
 from db.models import Model, Application
 from fastapi import APIRouter
+from app.artifacts import artifact_usage
+from ml.head_config import head_names
 
 router = APIRouter()
 
@@ -52,7 +58,8 @@ router = APIRouter()
                                 "speed": 0.95,
                                 "recommended": True,
                                 "accuracy": 0.97,
-                                "attributes": ["cell_type", "organ"]
+                                "attributes": ["cell_type", "organ"],
+                                "heads": ["cell_type", "disease_state"]
                             }
                         ]
                     }
@@ -74,6 +81,7 @@ def list_models(db: Session = Depends(get_db)):
             - recommended (bool): Whether this model is the recommended default.
             - accuracy (float): The accuracy performance metric of the model.
             - attributes (List[str]): A list of associated attributes.
+            - heads (List[str]): The classification heads of the model, the default (cell type) head first.
     """
     
     models = db.query(Model).all()
@@ -86,7 +94,8 @@ def list_models(db: Session = Depends(get_db)):
                 "speed": m.speed,
                 "recommended": m.recommended,
                 "accuracy": m.accuracy,
-                "attributes": [attr.attribute for attr in m.attributes]
+                "attributes": [attr.attribute for attr in m.attributes],
+                "heads": head_names(m.name)
             }
             for m in models
         ]
@@ -225,4 +234,41 @@ def get_models_for_application(application_id: int, db: Session = Depends(get_db
             }
             for m in application.models
         ]
-    }
\ No newline at end of file
+    }
+
+@router.get(
+    "/storage",
+    summary="Artifact storage usage",
+    description="Report the disk usage of the uploads, intermediate arrays and results stored on the shared volume.",
+    responses={
+        200: {
+            "description": "Disk usage per class of artifacts",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "classes": {
+                            "uploads": {"files": 3, "bytes": 734003200, "oldest_seconds": 5400.0, "ttl_seconds": 86400.0},
+                            "intermediate": {"files": 1, "bytes": 20480000, "oldest_seconds": 60.0, "ttl_seconds": 21600.0},
+                            "results": {"files": 12, "bytes": 52428800, "oldest_seconds": 432000.0, "ttl_seconds": 604800.0},
+                            "token_cache": {"bytes": 1073741824, "quota_bytes": 21474836480},
+                            "embedding_index": {"bytes": 2147483648}
+                        },
+                        "total_bytes": 806912000,
+                        "quota_bytes": 53687091200,
+                        "disk_free_bytes": 107374182400,
+                        "min_free_disk_bytes": 2147483648
+                    }
+                }
+            }
+        }
+    }
+)
+def storage_usage():
+    """
+    Report the disk usage of the artifacts.
+
+    Returns:
+        dict: Per class file count, size, age of the oldest artifact and TTL, plus the total size, the quota
+            and the free disk space.
+    """
+    return artifact_usage()
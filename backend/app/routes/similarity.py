@@ -0,0 +1,96 @@
+"""
+similarity.py - API routes for the nearest neighbour search over the cells of past runs.
+
+Author: Vincent Lefeuve
+Date: 2025-07-12
+
+Endpoints:
+    - POST /similar
+        Finds the k cells most similar to a query cell (by workflow and cell ID) or to an embedding vector,
+        across every run of a model, with their run, cell ID, predicted label and cosine similarity.
+
+The embeddings of every run are appended by the workers to the persistent store of their model, indexed with an
+IVF index (see `ml.embedding_index`). The API only reads the memory-mapped store.
+"""
+
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel, Field
+from sqlalchemy.orm import Session
+from db.database import get_db
+from db.models import Model
+from app.routes.workflow import resolve_artifact_workflow_id
+from ml.embedding_index import get_index, DEFAULT_NPROBE
+from ml.head_config import default_head, head_labels
+
+router = APIRouter()
+
+class SimilarityRequest(BaseModel):
+    model: int
+    k: int = Field(10, ge=1, le=1000)
+    workflow_id: Optional[str] = None  # Query by cell: run of the cell
+    cell_id: Optional[str] = None  # Query by cell: ID of the cell in the uploaded dataset
+    vector: Optional[List[float]] = None  # Query by embedding
+    nprobe: int = Field(DEFAULT_NPROBE, ge=1, le=4096)  # IVF lists scanned: higher is slower and more exact
+    exclude_same_run: bool = False  # Query by cell: leave out the cells of its own run
+
+@router.post(
+    "/similar",
+    summary="Find similar cells across runs",
+    description="Find the k cells most similar to a cell of a past run, or to an embedding vector, among all the runs of a model.",
+    responses={
+        200: {
+            "description": "Nearest cells, most similar first",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "model": "Geneformer",
+                        "neighbours": [
+                            {
+                                "workflow_id": "123e4567-e89b-12d3-a456-426614174000",
+                                "cell_id": "AAACCTGAGCGATAGC-1",
+                                "label": "MYELOID",
+                                "score": 0.982
+                            }
+                        ]
+                    }
+                }
+            }
+        },
+        404: {"description": "Model, run or cell not found"},
+        422: {"description": "Neither a cell nor a vector was given, or the vector has the wrong dimension"}
+    }
+)
+def find_similar_cells(payload: SimilarityRequest, db: Session = Depends(get_db)):
+    """
+    Find the nearest cells of a query cell or vector.
+
+    Returns:
+        dict: The model name and the neighbours (workflow ID, cell ID, label, cosine similarity).
+    """
+    model = db.query(Model).filter(Model.id == payload.model).first()
+    if not model:
+        raise HTTPException(status_code=404, detail="Model not found")
+    index = get_index(model.name)
+
+    exclude = None
+    if payload.vector is not None:
+        query = payload.vector
+    elif payload.workflow_id and payload.cell_id:
+        workflow_id = resolve_artifact_workflow_id(db, payload.workflow_id)
+        try:
+            query = index.vector(workflow_id, payload.cell_id)
+        except KeyError as e:
+            raise HTTPException(status_code=404, detail=str(e.args[0]))
+        exclude = workflow_id if payload.exclude_same_run else None
+    else:
+        raise HTTPException(status_code=422, detail="Give either a vector, or a workflow_id and a cell_id")
+
+    try:
+        neighbours = index.search(query, payload.k, payload.nprobe, exclude_workflow=exclude)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    id2label = head_labels(model.name, default_head(model.name))
+    for neighbour in neighbours:
+        neighbour["label"] = id2label.get(neighbour["label"], "Unknown")
+    return {"model": model.name, "neighbours": neighbours}
@@ -6,16 +6,28 @@ Date: 2025-06-28
 
 This module provides an API endpoint to handle file uploads in the application.
 Uploaded files are stored in a temporary directory with a unique UUID-based filename.
+The SHA-256 of the content is computed while the file is written and recorded in the `uploads` table,
+so that identical submissions can reuse previous results (see app.memoization).
+.h5ad uploads are inspected (header only, see app.inspection): shape, sparsity, dtype, size, presence of the
+`gene_name` column and vocabulary overlap per model are stored in the `dataset_info` table and returned.
 """
-from fastapi import APIRouter, File, UploadFile
+from fastapi import APIRouter, File, UploadFile, HTTPException, Depends
+from sqlalchemy.orm import Session
+import hashlib
 import uuid
 import os
+from app.admission import check_disk_space, AdmissionRejected
+from app.inspection import inspect_h5ad, vocabulary_overlap
+from app.artifacts import UPLOAD_DIR, reap, artifacts_in_use
+from app.storage import get_storage
+from ml.vocabularies import load_vocabulary
+from db.database import get_db
+from db.models import Upload, DatasetInfo, Model
 
 router = APIRouter()
 
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-UPLOAD_DIR = os.path.join(BASE_DIR, "data", "tmp")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+CHUNK_SIZE = 8 * 1024 * 1024
 
 @router.post(
     "/upload",
@@ -28,29 +40,100 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
                 "application/json": {
                     "example": {
                         "upload_id": "a7f3c4a2-3b77-4b24-908b-6a6b9d4e2bfa",
-                        "file_path": "/absolute/path/to/data/tmp/a7f3c4a2-3b77-4b24-908b-6a6b9d4e2bfa.csv"
+                        "file_path": "/absolute/path/to/data/tmp/a7f3c4a2-3b77-4b24-908b-6a6b9d4e2bfa.h5ad",
+                        "dataset": {
+                            "n_obs": 1000,
+                            "n_vars": 2000,
+                            "nnz": 100000,
+                            "sparsity": 0.95,
+                            "dtype": "float32",
+                            "x_encoding": "csr_matrix",
+                            "size_bytes": 1234567,
+                            "has_gene_name": True,
+                            "vocabulary_overlap": {"Geneformer": 0.91, "scGPT": 0.87}
+                        }
                     }
                 }
             }
-        }
+        },
+        422: {"description": "The file is not a valid .h5ad file"},
+        503: {"description": "Not enough free disk space, retry after the `Retry-After` delay"}
     }
 )
-async def upload_file(file: UploadFile = File(...)):
+async def upload_file(file: UploadFile = File(...), db: Session = Depends(get_db)):
     """
     Handle file upload and save it to a temporary directory with a unique name.
 
     Args:
         file (UploadFile): The file sent via multipart/form-data.
+        db (Session): The database session dependency.
 
     Returns:
         dict: A dictionary containing:
             - upload_id (str): UUID used to uniquely identify the uploaded file.
-            - file_path (str): The absolute path where the file was saved.
+            - file_path (str): Where the file was stored (absolute path, or object URI with a remote storage).
     """
+    try:
+        check_disk_space(UPLOAD_DIR)
+    except AdmissionRejected:
+        # Evict the least recently used artifacts before rejecting the upload
+        reap(artifacts_in_use())
+        try:
+            check_disk_space(UPLOAD_DIR)
+        except AdmissionRejected as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail(), headers={"Retry-After": str(e.retry_after)})
+
     file_id = str(uuid.uuid4())
-    save_path = os.path.join(UPLOAD_DIR, file_id + "." + file.filename.split(".")[-1])
+    file_name = file_id + "." + file.filename.split(".")[-1]
+    storage = get_storage()
+    # The file is staged locally, inspected, then handed over to the storage backend
+    save_path = storage.local_path("uploads", file_name)
+    sha256 = hashlib.sha256()
+    size = 0
     with open(save_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
-    save_path = os.path.abspath(os.path.join(UPLOAD_DIR, file_id + "." + file.filename.split(".")[-1]))
-    return {"upload_id": file_id, "file_path": save_path}
\ No newline at end of file
+        while chunk := await file.read(CHUNK_SIZE):
+            sha256.update(chunk)
+            size += len(chunk)
+            f.write(chunk)
+
+    upload = Upload(id=file_id, filename=file.filename, content_hash=sha256.hexdigest(), size_bytes=size)
+    dataset = None
+    if save_path.endswith(".h5ad"):
+        dataset = inspect_dataset(db, save_path, size)
+        upload.dataset_info = DatasetInfo(**dataset)
+    storage.put("uploads", file_name, save_path)
+    db.add(upload)
+    db.commit()
+
+    return {"upload_id": file_id, "file_path": storage.uri("uploads", file_name), "dataset": dataset}
+
+
+def inspect_dataset(db, path, size):
+    """
+    Inspects an uploaded .h5ad file and computes its vocabulary overlap with each model.
+    The file is deleted if it cannot be read.
+
+    Args:
+        db (Session): The database session.
+        path (str): Path of the uploaded file.
+        size (int): Size of the file in bytes.
+
+    Returns:
+        dict: The columns of the `dataset_info` row (without the upload ID).
+
+    Raises:
+        HTTPException: If the file is not a valid .h5ad file.
+    """
+    try:
+        info = inspect_h5ad(path)
+    except (OSError, KeyError, ValueError) as e:
+        print(f"Could not inspect upload {path}: {e}")
+        os.remove(path)
+        raise HTTPException(status_code=422, detail="The uploaded file is not a valid .h5ad file")
+
+    genes = info.pop("gene_names")
+    overlap = {}
+    for model in db.query(Model).all():
+        vocabulary = load_vocabulary(model.name)
+        overlap[model.name] = vocabulary_overlap(genes, vocabulary) if vocabulary is not None and genes else None
+    return {**info, "size_bytes": size, "vocabulary_overlap": overlap}
\ No newline at end of file
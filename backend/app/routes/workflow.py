@@ -8,9 +8,13 @@ This module defines API routes related to managing and executing annotation work
 
 It provides endpoints for:
 - Submitting a new workflow (`/submit`)
+- Submitting the same workflow on several uploads at once (`/submit/batch`)
+- Checking the aggregate status of a batch (`/batch/{batch_id}`)
 - Checking the status of a workflow (`/status/{job_id}`)
+- Cancelling a workflow (`DELETE /workflow/{job_id}`)
 - Retrieving the result of a workflow (`/result/{job_id}`)
 - Downloading the annotated dataset (`/download/{job_id}`)
+- Downloading the profile of a workflow submitted with `profile=true` (`/profile/{job_id}`)
 
 Each submitted workflow corresponds to a user-uploaded `.h5ad` dataset file, a selected application, and an associated model. Submitted workflows are processed asynchronously using Celery.
 
@@ -26,41 +30,81 @@ Modules and Components:
 Key Concepts:
 -------------
 - `WorkflowRequest`: Pydantic model defining the required payload for a workflow submission.
-- `workflows_dict`: In-memory dictionary mapping workflow IDs to Celery task IDs.
-- `UPLOAD_DIR`: Directory path where user-uploaded `.h5ad` files and result files are stored.
-- `run_workflow`: Celery task responsible for executing the actual model-based annotation logic.
+- `workflows_dict`: In-memory dictionary mapping workflow IDs to Celery task IDs (also persisted in `Workflow.task_id`).
+- `UPLOAD_DIR`: Local directory where uploads and results are staged; they are stored with the backend of
+  `app.storage` (shared volume or S3-compatible object store).
+- `tasks.run_workflow`: Celery task responsible for executing the actual model-based annotation logic. Tasks are
+  submitted by name with `celery_app.send_task`, so that the API never imports the task modules and the ML stack.
+- Scheduling: each job is costed from its cell count and the model throughput, then routed to the `fast` or
+  `bulk` queue (see `app.scheduling`). The estimated start and finish times are returned on submission.
+- Multi-model mode: when `models` lists additional models, all of them run in a single job sharing the data
+  loading, and the result includes per-model predictions and agreement statistics (see `tasks.run_multi_model_workflow`).
+- Heads: `heads` lists additional classification heads (e.g. disease state, QC) of the model, run on the same
+  embeddings as the cell type head in one fused pass; their statistics are returned under `heads` in the result.
+- Memoization: a submission identical to a completed or in-flight one (same upload content, model, application
+  and pipeline version) is attached to it instead of being enqueued, unless `force=true` (see `app.memoization`).
+- Admission control: submissions are rejected with 429/503 and a `Retry-After` header when the system is
+  overloaded or the application reached its concurrency cap (see `app.admission`).
+- Batches: `/submit/batch` validates all the uploads, inserts the workflows in one transaction and dispatches
+  them as one Celery group. The workflows keep their own IDs; the `Batch` row only groups them, and its status
+  is a grouped count over `Workflow.batch_id`.
+- Cancellation: `DELETE /workflow/{job_id}` revokes the task of a queued workflow and flags a running one, which
+  stops at its next stage or embedding batch (see `app.cancellation`). The workflow is marked cancelled and its job
+  released right away, so the capacity it held is available to new submissions.
 
 Notes:
 ------
 - Results are serialized JSON objects stored in the database and returned via the `/result/{job_id}` endpoint.
+  Workflows publish a partial result (status "partial") as soon as the cells are classified: the statistics and
+  the predicted label of each cell (`predicted_labels`) are served while the UMAP is computed, with `umap` set to
+  null until the final result replaces it. Sharded workflows publish it once the shards are merged, multi-model
+  workflows once every model classified the cells (with the per-model statistics and the agreement).
 - UMAP embeddings, cell type labels, confidence scores, and annotated CSV files are generated as part of the workflow output.
 - This module assumes the application and model IDs are valid and linked in the database.
 """
 
-from fastapi import APIRouter, Depends, BackgroundTasks
+from fastapi import APIRouter, Depends, BackgroundTasks, Query
 from pydantic import BaseModel
+from typing import List, Optional
 from fastapi.responses import FileResponse
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from celery.result import AsyncResult
 from uuid import uuid4
 from db.database import get_db
-from db.models import Workflow, Application
+from db.models import Workflow, Application, Upload, Batch
 from fastapi import HTTPException
 import os
 import json
+from collections import Counter
 from sqlalchemy.exc import IntegrityError
-from app.tasks.run_workflow import run_workflow
-from app.tasks.run_workflow_mock import run_workflow_mock
+from celery import group, states
+from app.worker import celery_app
+from app.artifacts import UPLOAD_DIR, touch
+from app.storage import get_storage
+from app.inspection import count_cells
+from app.scheduling import release_job
+from app.admission import admit_jobs, AdmissionRejected
+from app.memoization import (
+    compute_cache_key, find_reusable_workflow, find_reusable_workflows, attached_result, IN_PROGRESS_STATUSES
+)
+from app.cancellation import request_cancel, cancelled_result, failed_result
+from app.analytics import record_run
+from app.profiling import profile_artifact_path, PSTATS_SUFFIX, COLLAPSED_SUFFIX
+from ml.head_config import head_names
 
 router = APIRouter()
 workflows_dict = {}
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-UPLOAD_DIR = os.path.abspath(os.path.join(BASE_DIR, "..", "data", "tmp"))
 
 class WorkflowRequest(BaseModel):
     upload_id: str
     model: int
     application: int
+    profile: bool = False  # Run under the profiler; a profiled workflow always runs (its profile is the point)
+    force: bool = False  # Run the workflow even if an identical submission can be reused
+    models: List[int] = []  # Additional models to compare with `model` on the same data (multi-model mode)
+    parallel: bool = False  # Multi-model mode: run the models in parallel instead of in sequence
+    shard: Optional[bool] = None  # Split the cells across workers; by default only large datasets are sharded
+    heads: List[str] = []  # Additional classification heads run on the same embeddings (single model only)
 
 @router.post(
     "/submit",
@@ -72,41 +116,90 @@ class WorkflowRequest(BaseModel):
                     "example": {
                         "workflow_id": "123e4567-e89b-12d3-a456-426614174000",
                         "status": "pending",
-                        "message": "Workflow successfully submitted and queued for processing"
+                        "message": "Workflow successfully submitted and queued for processing",
+                        "queue": "fast",
+                        "n_cells": 1000,
+                        "estimated_seconds": 35.0,
+                        "estimated_start": "2025-07-04T10:00:00",
+                        "estimated_finish": "2025-07-04T10:00:35"
                     }
                 }
             }
         },
         400: {"description": "Failed to commit workflow to DB"},
         404: {"description": "Application not found"},
-        503: {"description": "Task queue unavailable"}
+        422: {"description": "Upload is not a valid .h5ad file, has no 'gene_name' column, or no gene known by the model"},
+        429: {
+            "description": "The application reached its concurrency cap",
+            "headers": {"Retry-After": {"description": "Seconds after which to retry", "schema": {"type": "integer"}}},
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": {
+                            "reason": "application_concurrency",
+                            "message": "Application 1 has 4 workflows in flight, 1 more would exceed its cap of 4",
+                            "retry_after": 120,
+                            "estimated_wait_seconds": 120.0
+                        }
+                    }
+                }
+            }
+        },
+        503: {
+            "description": "Task queue unavailable, or the system is overloaded (queue, pending work, disk or worker memory)",
+            "headers": {"Retry-After": {"description": "Seconds after which to retry", "schema": {"type": "integer"}}}
+        }
     }
 )
 async def submit_workflow(payload: WorkflowRequest, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     print(f"Received workflow submission request: {payload}")
-    application = db.query(Application).filter(Application.id == payload.application).first()
-    if not application:
-        raise HTTPException(status_code=404, detail="Application not found")
+    application, model_ids, model_objs = resolve_models(db, payload.application, [payload.model, *payload.models])
+    heads = validate_heads(model_objs, payload.heads)
+    model_specs = [(m.name, m.speed.value) for m in model_objs]
 
-    model_obj = next((m for m in application.models if m.id == payload.model), None)
-    if not model_obj:
-        raise HTTPException(status_code=404, detail="Model not found for the given application")
+    # Reuse the result (or the running task) of an identical submission, unless a profile of this run is requested
+    upload = db.query(Upload).filter(Upload.id == payload.upload_id).first()
+    cache_key = compute_cache_key(
+        upload.content_hash, model_ids, payload.application, result_settings(application, heads)
+    ) if upload else None
+    if cache_key and not payload.force and not payload.profile:
+        existing = find_reusable_workflow(db, cache_key)
+        if existing:
+            return attach_to_workflow(db, existing, payload, cache_key)
 
-    model_name = model_obj.name
     # Check if upload_id exists in the files
-    print(UPLOAD_DIR)
-    print(BASE_DIR)
-    upload_path = os.path.join(UPLOAD_DIR, f"{payload.upload_id}.h5ad")
-    if not os.path.exists(upload_path):
+    storage = get_storage()
+    upload_name = f"{payload.upload_id}.h5ad"
+    if not storage.exists("uploads", upload_name):
         raise HTTPException(status_code=404, detail=f"Upload file with ID {payload.upload_id} not found")
     
-    print(f"Submitting workflow for application: {application.name}, model: {payload.model}, upload_id: {payload.upload_id}")
+    info = upload.dataset_info if upload else None
+    if info is not None:
+        validate_dataset(info, model_objs)
+        n_cells = info.n_obs
+    else:
+        # Uploads made before the inspection at upload time
+        try:
+            n_cells = count_cells(storage.fetch("uploads", upload_name))
+        except (OSError, KeyError) as e:
+            print(f"Could not read upload {payload.upload_id}: {e}")
+            raise HTTPException(status_code=422, detail=f"Upload file with ID {payload.upload_id} is not a valid .h5ad file")
+
     workflow_id = str(uuid4())
+    try:
+        schedule = admit_jobs(application.id, [(workflow_id, n_cells, model_specs)], UPLOAD_DIR)[workflow_id]
+    except AdmissionRejected as e:
+        print(f"Workflow rejected by admission control: {e.reason}")
+        raise HTTPException(status_code=e.status_code, detail=e.detail(), headers={"Retry-After": str(e.retry_after)})
+
+    print(f"Submitting workflow for application: {application.name}, model: {payload.model}, upload_id: {payload.upload_id}")
     workflow = Workflow(
         id=workflow_id,
         application_id=payload.application,
         model_id=payload.model,
-        status="pending"
+        status="pending",
+        upload_id=upload.id if upload else None,
+        cache_key=cache_key
     )
     try:
         db.add(workflow)
@@ -114,14 +207,27 @@ async def submit_workflow(payload: WorkflowRequest, background_tasks: Background
     except IntegrityError as e:
         print(f"IntegrityError: {e}")
         db.rollback()
+        release_job(workflow_id)
         raise HTTPException(status_code=400, detail="Failed to commit workflow to DB")
     
     try:
-        task = run_workflow.delay(workflow_id, payload.upload_id, model_name, workflow.application_id)
+        task = workflow_signature(
+            workflow_id, payload.upload_id, model_objs, workflow.application_id,
+            upload.content_hash if upload else None, schedule["queue"],
+            profile=payload.profile, parallel=payload.parallel, shard=payload.shard,
+            thresholds=application.statistics_thresholds, heads=heads
+        ).apply_async()
         workflows_dict[str(workflow.id)] = task.id
-        print(f"Task {task.id} submitted for workflow {workflow.id}")
+        workflow.task_id = task.id
+        db.commit()
+        print(f"Task {task.id} submitted for workflow {workflow.id} on queue {schedule['queue']}")
     except Exception as e:
         print(f"Error submitting task to Celery: {e}")
+        release_job(workflow_id)
+        db.rollback()
+        workflow.status = "failed"
+        workflow.result = json.dumps(failed_result(workflow_id, "Task queue unavailable"))
+        db.commit()
         raise HTTPException(status_code=503, detail="Task queue unavailable")
     
     db.refresh(workflow)
@@ -129,9 +235,522 @@ async def submit_workflow(payload: WorkflowRequest, background_tasks: Background
     return {
         "workflow_id": str(workflow.id),
         "status": "pending",
-        "message": "Workflow successfully submitted and queued for processing"
+        "message": "Workflow successfully submitted and queued for processing",
+        **schedule
     }
 
+class BatchWorkflowRequest(BaseModel):
+    upload_ids: List[str]
+    model: int
+    application: int
+    force: bool = False  # Run the workflows even if identical submissions can be reused
+    models: List[int] = []  # Additional models, as in `WorkflowRequest`
+    parallel: bool = False
+    shard: Optional[bool] = None
+    heads: List[str] = []
+
+MAX_BATCH_SIZE = int(os.getenv("HELICAL_MAX_BATCH_SIZE", "200"))
+
+@router.post(
+    "/submit/batch",
+    responses={
+        200: {
+            "description": "Successful Submission",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "batch_id": "9b2f6a1e-4c3d-4f8e-9a7b-1c2d3e4f5a6b",
+                        "status": "pending",
+                        "size": 2,
+                        "message": "Batch successfully submitted and queued for processing",
+                        "workflows": [
+                            {
+                                "upload_id": "0c1d2e3f-aaaa-bbbb-cccc-000000000001",
+                                "workflow_id": "123e4567-e89b-12d3-a456-426614174000",
+                                "status": "pending",
+                                "queue": "fast",
+                                "n_cells": 1000,
+                                "estimated_seconds": 35.0,
+                                "estimated_start": "2025-07-04T10:00:00",
+                                "estimated_finish": "2025-07-04T10:00:35"
+                            },
+                            {
+                                "upload_id": "0c1d2e3f-aaaa-bbbb-cccc-000000000002",
+                                "workflow_id": "223e4567-e89b-12d3-a456-426614174000",
+                                "status": "completed",
+                                "attached_to": "0a0e4567-e89b-12d3-a456-426614174000"
+                            }
+                        ]
+                    }
+                }
+            }
+        },
+        400: {"description": "Failed to commit the workflows to DB"},
+        404: {
+            "description": "Application, model or uploads not found",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": {
+                            "message": "1 upload file(s) not found",
+                            "upload_ids": ["0c1d2e3f-aaaa-bbbb-cccc-000000000003"]
+                        }
+                    }
+                }
+            }
+        },
+        422: {
+            "description": "Empty or oversized batch, or some uploads cannot be processed (errors listed per upload)",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": {
+                            "message": "1 upload(s) cannot be processed",
+                            "errors": {
+                                "0c1d2e3f-aaaa-bbbb-cccc-000000000002": "The uploaded dataset has no 'gene_name' column in var"
+                            }
+                        }
+                    }
+                }
+            }
+        },
+        429: {
+            "description": "The batch would exceed the concurrency cap of the application",
+            "headers": {"Retry-After": {"description": "Seconds after which to retry", "schema": {"type": "integer"}}}
+        },
+        503: {
+            "description": "Task queue unavailable, or the system is overloaded",
+            "headers": {"Retry-After": {"description": "Seconds after which to retry", "schema": {"type": "integer"}}}
+        }
+    }
+)
+async def submit_batch(payload: BatchWorkflowRequest, db: Session = Depends(get_db)):
+    """
+    Submits the same workflow (application and models) on several uploads at once.
+
+    The batch is all or nothing: every upload is validated first, and all the errors are reported together.
+    The workflow rows are then inserted in a single transaction and the tasks dispatched as one Celery group.
+    Uploads identical to a completed or in-flight workflow, or to another upload of the batch, are attached to it.
+    If the dispatch fails, the committed workflows of the batch are marked as failed.
+    """
+    upload_ids = list(dict.fromkeys(payload.upload_ids))
+    if not upload_ids:
+        raise HTTPException(status_code=422, detail="The batch has no upload")
+    if len(upload_ids) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=422, detail=f"A batch has at most {MAX_BATCH_SIZE} uploads")
+    print(f"Received batch submission request for {len(upload_ids)} uploads")
+    application, model_ids, model_objs = resolve_models(db, payload.application, [payload.model, *payload.models])
+    heads = validate_heads(model_objs, payload.heads)
+    model_specs = [(m.name, m.speed.value) for m in model_objs]
+
+    # Uploads made before the upload registry have no Upload row (hence no cache key): they always run, alone
+    uploads = {u.id: u for u in db.query(Upload).filter(Upload.id.in_(upload_ids)).all()}
+    cache_keys = {
+        upload_id: compute_cache_key(
+            upload.content_hash, model_ids, payload.application, result_settings(application, heads)
+        )
+        for upload_id, upload in uploads.items()
+    }
+    run_keys = {upload_id: cache_keys.get(upload_id) or f"upload:{upload_id}" for upload_id in upload_ids}
+    reusable = {} if payload.force else find_reusable_workflows(db, set(cache_keys.values()))
+
+    # Validate every upload that needs a run, collecting all the errors
+    storage = get_storage()
+    to_run = {}  # run key -> (upload ID, number of cells) of the upload running it
+    errors = {}
+    missing = []
+    for upload_id in upload_ids:
+        run_key = run_keys[upload_id]
+        if run_key in reusable or run_key in to_run:
+            continue
+        upload_name = f"{upload_id}.h5ad"
+        if not storage.exists("uploads", upload_name):
+            missing.append(upload_id)
+            continue
+        info = uploads[upload_id].dataset_info if upload_id in uploads else None
+        try:
+            if info is not None:
+                validate_dataset(info, model_objs)
+                n_cells = info.n_obs
+            else:
+                n_cells = count_cells(storage.fetch("uploads", upload_name))
+        except HTTPException as e:
+            errors[upload_id] = e.detail
+            continue
+        except (OSError, KeyError) as e:
+            print(f"Could not read upload {upload_id}: {e}")
+            errors[upload_id] = "Upload file is not a valid .h5ad file"
+            continue
+        to_run[run_key] = (upload_id, n_cells)
+    if missing:
+        raise HTTPException(status_code=404, detail={"message": f"{len(missing)} upload file(s) not found", "upload_ids": missing})
+    if errors:
+        raise HTTPException(status_code=422, detail={"message": f"{len(errors)} upload(s) cannot be processed", "errors": errors})
+
+    batch = Batch(id=str(uuid4()), application_id=application.id, size=len(upload_ids))
+    rows = {}  # upload ID -> workflow
+    runs = {}  # run key -> workflow running it
+    for upload_id in upload_ids:
+        run_key = run_keys[upload_id]
+        cache_key = cache_keys.get(upload_id)
+        if run_key in reusable:
+            rows[upload_id] = attached_workflow(
+                reusable[run_key], str(uuid4()), payload.application, payload.model, upload_id, cache_key, batch.id
+            )
+            continue
+        workflow = Workflow(
+            id=str(uuid4()),
+            application_id=payload.application,
+            model_id=payload.model,
+            status="pending",
+            upload_id=upload_id if upload_id in uploads else None,
+            cache_key=cache_key,
+            batch_id=batch.id
+        )
+        if run_key in runs:
+            # Same content as a previous upload of the batch: follow its task (set after dispatch)
+            workflow.attached_to = runs[run_key].id
+        else:
+            runs[run_key] = workflow
+        rows[upload_id] = workflow
+
+    # Admission control of the whole batch: the jobs of all its runs are reserved at once, or none is
+    try:
+        schedules = admit_jobs(
+            application.id, [(workflow.id, to_run[run_key][1], model_specs) for run_key, workflow in runs.items()],
+            UPLOAD_DIR
+        ) if runs else {}
+    except AdmissionRejected as e:
+        print(f"Batch rejected by admission control: {e.reason}")
+        raise HTTPException(status_code=e.status_code, detail=e.detail(), headers={"Retry-After": str(e.retry_after)})
+
+    try:
+        db.add(batch)
+        db.add_all(rows.values())
+        db.commit()
+    except IntegrityError as e:
+        print(f"IntegrityError: {e}")
+        db.rollback()
+        for workflow_id in schedules:
+            release_job(workflow_id)
+        raise HTTPException(status_code=400, detail="Failed to commit the workflows to DB")
+
+    signatures = []
+    for run_key, workflow in runs.items():
+        upload_id, _ = to_run[run_key]
+        signatures.append(workflow_signature(
+            workflow.id, upload_id, model_objs, application.id,
+            uploads[upload_id].content_hash if upload_id in uploads else None,
+            schedules[workflow.id]["queue"], parallel=payload.parallel, shard=payload.shard,
+            thresholds=application.statistics_thresholds, heads=heads
+        ))
+    try:
+        if signatures:
+            group_result = group(signatures).apply_async()
+            batch.group_id = group_result.id
+            for workflow, task in zip(runs.values(), group_result.results):
+                workflow.task_id = task.id
+        run_workflows = {workflow.id: workflow for workflow in runs.values()}
+        for workflow in rows.values():
+            if workflow.attached_to in run_workflows:
+                workflow.task_id = run_workflows[workflow.attached_to].task_id
+            if workflow.task_id:
+                workflows_dict[workflow.id] = workflow.task_id
+        db.commit()
+        print(f"Batch {batch.id} submitted: {len(signatures)} tasks for {len(upload_ids)} uploads")
+    except Exception as e:
+        print(f"Error submitting batch to Celery: {e}")
+        for workflow_id in schedules:
+            release_job(workflow_id)
+        # The rows are already committed: end them, so that they do not stay pending forever
+        db.rollback()
+        for workflow in rows.values():
+            workflow.status = "failed"
+            workflow.result = json.dumps(failed_result(workflow.id, "Task queue unavailable"))
+        db.commit()
+        raise HTTPException(status_code=503, detail="Task queue unavailable")
+
+    workflows = []
+    for upload_id, workflow in rows.items():
+        entry = {"upload_id": upload_id, "workflow_id": workflow.id, "status": workflow.status}
+        if workflow.attached_to:
+            entry["attached_to"] = workflow.attached_to
+        entry.update(schedules.get(workflow.id, {}))
+        workflows.append(entry)
+    return {
+        "batch_id": batch.id,
+        "status": batch_status(Counter(workflow.status for workflow in rows.values()), len(rows)),
+        "size": len(upload_ids),
+        "message": "Batch successfully submitted and queued for processing",
+        "workflows": workflows
+    }
+
+
+def batch_status(counts, size):
+    """
+    Derives the aggregate status of a batch from the number of its workflows in each status.
+
+    Args:
+        counts (dict): Number of workflows per status
+        size (int): Number of workflows of the batch
+
+    Returns:
+        str: "completed" if every workflow completed, "pending" while some are pending (or have a partial
+            result), "finished" otherwise (every workflow is done, some did not complete)
+    """
+    if counts.get("completed", 0) == size:
+        return "completed"
+    if counts.get("pending", 0) or counts.get("partial", 0):
+        return "pending"
+    return "finished"
+
+
+@router.get(
+    "/batch/{batch_id}",
+    responses={
+        200: {
+            "description": "Aggregate status of the batch",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "batch_id": "9b2f6a1e-4c3d-4f8e-9a7b-1c2d3e4f5a6b",
+                        "status": "pending",
+                        "size": 3,
+                        "counts": {"completed": 2, "pending": 1},
+                        "created_at": "2025-07-04T10:00:00"
+                    }
+                }
+            }
+        },
+        404: {"description": "Batch not found"}
+    }
+)
+async def get_batch_status(batch_id: str, workflows: bool = False, db: Session = Depends(get_db)):
+    """
+    Returns the aggregate status of a batch, computed with a single grouped count over its workflows.
+    With `workflows=true`, the ID, upload and status of each workflow are listed as well.
+    """
+    batch = db.query(Batch).filter(Batch.id == batch_id).first()
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    counts = dict(
+        db.query(Workflow.status, func.count(Workflow.id))
+        .filter(Workflow.batch_id == batch_id)
+        .group_by(Workflow.status)
+        .all()
+    )
+    response = {
+        "batch_id": batch.id,
+        "status": batch_status(counts, batch.size),
+        "size": batch.size,
+        "counts": counts,
+        "created_at": batch.created_at.isoformat() if batch.created_at else None
+    }
+    if workflows:
+        response["workflows"] = [
+            {"workflow_id": workflow_id, "upload_id": upload_id, "status": status}
+            for workflow_id, upload_id, status in db.query(Workflow.id, Workflow.upload_id, Workflow.status)
+            .filter(Workflow.batch_id == batch_id)
+            .all()
+        ]
+    return response
+
+
+def resolve_models(db, application_id, model_ids):
+    """
+    Looks up an application and the requested models, which must belong to it.
+
+    Args:
+        db (Session): The database session
+        application_id (int): ID of the application
+        model_ids (list): IDs of the models; the first one is the primary model, duplicates are dropped
+
+    Returns:
+        tuple: (application, deduplicated model IDs, models)
+
+    Raises:
+        HTTPException: 404 if the application or one of the models does not exist
+    """
+    application = db.query(Application).filter(Application.id == application_id).first()
+    if not application:
+        raise HTTPException(status_code=404, detail="Application not found")
+
+    model_ids = list(dict.fromkeys(model_ids))
+    model_objs = []
+    for model_id in model_ids:
+        model_obj = next((m for m in application.models if m.id == model_id), None)
+        if not model_obj:
+            raise HTTPException(status_code=404, detail=f"Model {model_id} not found for the given application")
+        model_objs.append(model_obj)
+    return application, model_ids, model_objs
+
+
+def workflow_signature(workflow_id, upload_id, model_objs, application_id, dataset_hash, queue,
+                       profile=False, parallel=False, shard=None, thresholds=None, heads=None):
+    """
+    Builds the Celery signature of a workflow task. The task is referenced by name, so that the API does not
+    import the task modules.
+
+    Args:
+        workflow_id (str): ID of the workflow
+        upload_id (str): ID of the upload
+        model_objs (list): Requested models; several models run a multi-model workflow
+        application_id (int): ID of the application
+        dataset_hash (str | None): SHA-256 of the upload
+        queue (str): Lane (Celery queue) of the workflow
+        profile (bool): Run the workflow under the profiler (single model only)
+        parallel (bool): Multi-model mode: run the models in parallel
+        shard (bool | None): Split the cells across workers (single model only)
+        thresholds (dict | None): Confidence thresholds of the application (`Application.statistics_thresholds`)
+        heads (list | None): Additional classification heads (single model only)
+
+    Returns:
+        Signature: The task signature
+    """
+    if len(model_objs) > 1:
+        return celery_app.signature(
+            "tasks.run_multi_model_workflow",
+            args=[workflow_id, upload_id, [m.name for m in model_objs], application_id],
+            kwargs={"parallel": parallel, "dataset_hash": dataset_hash, "thresholds": thresholds},
+            queue=queue
+        )
+    return celery_app.signature(
+        "tasks.run_workflow",
+        args=[workflow_id, upload_id, model_objs[0].name, application_id],
+        kwargs={
+            "profile": profile, "dataset_hash": dataset_hash, "shard": shard, "thresholds": thresholds, "heads": heads
+        },
+        queue=queue
+    )
+
+
+def validate_heads(model_objs, heads):
+    """
+    Checks the additional classification heads of a submission against the head configuration.
+
+    Args:
+        model_objs (list): Requested models
+        heads (list): Requested additional heads
+
+    Returns:
+        list: The additional heads, deduplicated and without the default head of the model
+
+    Raises:
+        HTTPException: 422 if heads are requested with several models, or a head is not configured for the model
+    """
+    if not heads:
+        return []
+    if len(model_objs) > 1:
+        raise HTTPException(status_code=422, detail="Additional heads are not supported in multi-model mode")
+    available = head_names(model_objs[0].name)
+    unknown = [head for head in heads if head not in available]
+    if unknown:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Unknown heads for {model_objs[0].name}: {', '.join(unknown)} (available: {', '.join(available)})"
+        )
+    return [head for head in dict.fromkeys(heads) if head != available[0]]
+
+
+def result_settings(application, heads):
+    """
+    Returns the settings of a submission which alter its result, for its cache key.
+    """
+    settings = {"statistics_thresholds": application.statistics_thresholds, "heads": heads}
+    return {key: value for key, value in settings.items() if value}
+
+
+def validate_dataset(info, model_objs):
+    """
+    Validates an upload against the requested models using the metadata recorded at upload time.
+
+    Args:
+        info (DatasetInfo): Metadata of the upload
+        model_objs (list): Requested models
+
+    Raises:
+        HTTPException: 422 if the dataset has no `gene_name` column, no cells, or no gene known by a model
+    """
+    if not info.has_gene_name:
+        raise HTTPException(status_code=422, detail="The uploaded dataset has no 'gene_name' column in var")
+    if info.n_obs == 0:
+        raise HTTPException(status_code=422, detail="The uploaded dataset has no cells")
+    overlap = info.vocabulary_overlap or {}
+    for model_obj in model_objs:
+        if overlap.get(model_obj.name) == 0:
+            raise HTTPException(status_code=422, detail=f"None of the genes of the uploaded dataset are known by {model_obj.name}")
+
+
+def attach_to_workflow(db, source, payload, cache_key):
+    """
+    Creates a workflow reusing the result, or the running task, of an identical previous submission.
+
+    Args:
+        db (Session): The database session
+        source (Workflow): The completed or in-flight workflow with the same cache key
+        payload (WorkflowRequest): The submission
+        cache_key (str): Cache key of the submission
+
+    Returns:
+        dict: The submission response, with `attached_to` set to the ID of the source workflow
+    """
+    workflow_id = str(uuid4())
+    workflow = attached_workflow(source, workflow_id, payload.application, payload.model, payload.upload_id, cache_key)
+    try:
+        db.add(workflow)
+        db.commit()
+    except IntegrityError as e:
+        print(f"IntegrityError: {e}")
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Failed to commit workflow to DB")
+    if source.task_id:
+        workflows_dict[workflow_id] = source.task_id
+    print(f"Workflow {workflow_id} attached to workflow {source.id} ({source.status})")
+
+    return {
+        "workflow_id": workflow_id,
+        "status": source.status,
+        "message": "Identical submission found, reusing its result" if source.status == "completed"
+                   else "Identical submission in progress, attached to its task",
+        "attached_to": source.id
+    }
+
+
+def attached_workflow(source, workflow_id, application_id, model_id, upload_id, cache_key, batch_id=None):
+    """
+    Builds (without committing it) the row of a workflow attached to a completed or in-flight workflow.
+
+    Returns:
+        Workflow: The attached workflow, sharing the status, the result and the task of its source
+    """
+    result = None
+    if source.status == "completed":
+        source_result = json.loads(source.result) if isinstance(source.result, str) else source.result
+        result = json.dumps(attached_result(source_result, workflow_id, source.id))
+    return Workflow(
+        id=workflow_id,
+        application_id=application_id,
+        model_id=model_id,
+        status=source.status,
+        result=result,
+        upload_id=upload_id,
+        task_id=source.task_id,
+        cache_key=cache_key,
+        attached_to=source.id,
+        batch_id=batch_id
+    )
+
+
+def resolve_artifact_workflow_id(db, job_id):
+    """
+    Returns the ID of the workflow which produced the artifacts (CSV, profile) of `job_id`,
+    following the `attached_to` link of reused workflows.
+    """
+    workflow = db.query(Workflow).filter(Workflow.id == job_id).first()
+    if workflow and workflow.attached_to:
+        return workflow.attached_to
+    return job_id
+
 
 @router.get(
     "/status/{job_id}",
@@ -165,11 +784,14 @@ async def check_status(job_id: str, db: Session = Depends(get_db)):
     #TODO: Handle case where workflow is not found in celery tasks
     if workflow:
         
-        if job_id not in workflows_dict:
+        if workflow.status == "cancelled":
+            # Attached workflows share the task of their source, which may still be running
+            return {"job_id": job_id, "status": "REVOKED", "info": {"stage": "CANCELLED"}}
+        task_id = workflows_dict.get(job_id) or workflow.task_id
+        if not task_id:
             raise HTTPException(status_code=404, detail="Workflow not found")
-        task_id = workflows_dict[job_id]
         
-        res = AsyncResult(task_id)
+        res = celery_app.AsyncResult(task_id)
         
         status = res.status
         try:
@@ -182,12 +804,88 @@ async def check_status(job_id: str, db: Session = Depends(get_db)):
     raise HTTPException(status_code=404, detail="Workflow not found")
 
 
+@router.delete(
+    "/workflow/{job_id}",
+    status_code=202,
+    summary="Cancel a workflow",
+    description="Cancel a queued or running workflow. A running task stops at its next stage or embedding batch.",
+    responses={
+        202: {
+            "description": "Workflow cancelled",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "workflow_id": "123e4567-e89b-12d3-a456-426614174000",
+                        "status": "cancelled",
+                        "cancelled_workflows": 1
+                    }
+                }
+            }
+        },
+        404: {"description": "Workflow not found"},
+        409: {
+            "description": "The workflow is not in progress",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Workflow 123e4567-e89b-12d3-a456-426614174000 is already completed"}
+                }
+            }
+        }
+    }
+)
+async def cancel_workflow(job_id: str, db: Session = Depends(get_db)):
+    """
+    Cancels a workflow.
+
+    A workflow attached to another one (identical submission) is cancelled alone, its source keeps running.
+    Otherwise the task is revoked and flagged, and the workflows attached to it are cancelled with it.
+
+    Returns:
+        dict: The workflow ID, its new status and the number of cancelled workflows
+    """
+    workflow = db.query(Workflow).filter(Workflow.id == job_id).first()
+    if not workflow:
+        raise HTTPException(status_code=404, detail="Workflow not found")
+    if workflow.status not in IN_PROGRESS_STATUSES:
+        raise HTTPException(status_code=409, detail=f"Workflow {job_id} is already {workflow.status}")
+
+    cancelled = [workflow]
+    if not workflow.attached_to:
+        started = False
+        try:
+            request_cancel(job_id)
+            if workflow.task_id:
+                started = celery_app.AsyncResult(workflow.task_id).state != states.PENDING
+                # Drops the task if it is still queued; a running task stops on the cancellation flag
+                celery_app.control.revoke(workflow.task_id)
+        except Exception as e:
+            print(f"Error cancelling workflow {job_id}: {e}")
+            raise HTTPException(status_code=503, detail="Task queue unavailable")
+        if not started:
+            # A dropped task never runs its cleanup; a started one releases its job once it actually stops
+            # (a task starting meanwhile also releases it, which is idempotent)
+            release_job(job_id)
+        cancelled += (
+            db.query(Workflow)
+            .filter(Workflow.attached_to == job_id, Workflow.status.in_(IN_PROGRESS_STATUSES))
+            .all()
+        )
+    for row in cancelled:
+        row.status = "cancelled"
+        row.result = json.dumps(cancelled_result(row.id))
+    db.commit()
+    record_run(db, workflow, cancelled_result(job_id))
+    print(f"Cancelled workflow {job_id} ({len(cancelled)} workflow(s))")
+    return {"workflow_id": job_id, "status": "cancelled", "cancelled_workflows": len(cancelled)}
+
+
 
 @router.get(
     "/result/{job_id}",
     responses={
         200: {
-            "description": "JSON containing the results of the workflow",
+            "description": "JSON containing the results of the workflow. While the UMAP is computed, the result has the "
+                           "status \"partial\", the predicted class of each cell in `predicted_labels` and a null `umap`",
             "content": {
                 "application/json": {
                     "example": {
@@ -310,12 +1008,13 @@ async def get_result(job_id: str, db: Session = Depends(get_db)):
         }
     }
 )
-async def download_file(job_id: str):
+async def download_file(job_id: str, db: Session = Depends(get_db)):
     """
     Download the annotated data file for the given workflow ID.
     
     Args:
         job_id (str): The unique identifier of the workflow.
+        db (Session): The database session dependency.
     
     Returns:
         FileResponse: The annotated data file if it exists.
@@ -323,9 +1022,62 @@ async def download_file(job_id: str):
     Raises:
         HTTPException: If the file does not exist.
     """
-    file_path = os.path.join(UPLOAD_DIR, "results", f"annotated_data_{job_id}.csv")
-    if os.path.exists(file_path):
-        return FileResponse(file_path, media_type='application/csv', filename=os.path.basename(file_path))
-    else:
+    source_id = resolve_artifact_workflow_id(db, job_id)
+    try:
+        file_path = get_storage().fetch("results", f"annotated_data_{source_id}.csv")
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail=f"File not found for workflow ID {job_id}")
-    
\ No newline at end of file
+    touch(file_path)
+    return FileResponse(file_path, media_type='application/csv', filename=os.path.basename(file_path))
+
+
+@router.get(
+    "/profile/{job_id}",
+    responses={
+        200: {
+            "description": "Download the profile of a workflow submitted with `profile=true`",
+            "content": {
+                "application/octet-stream": {
+                    "example": "profile_123e4567-e89b-12d3-a456-426614174000.pstats"
+                },
+                "text/plain": {
+                    "example": "run_workflow (tasks/run_workflow.py:55);compute_umap (tasks/pipeline.py:120) 42"
+                }
+            }
+        },
+        404: {
+            "description": "Profile not found",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Profile not found for workflow ID 123e4567-e89b-12d3-a456-426614174000"
+                    }
+                }
+            }
+        }
+    }
+)
+async def download_profile(job_id: str, format: str = Query("pstats", pattern="^(pstats|collapsed)$"), db: Session = Depends(get_db)):
+    """
+    Download the profile artifact of a workflow submitted with `profile=true`.
+
+    Args:
+        job_id (str): The unique identifier of the workflow.
+        format (str): `pstats` for the cProfile dump, `collapsed` for the flamegraph-ready collapsed stacks.
+        db (Session): The database session dependency.
+
+    Returns:
+        FileResponse: The profile artifact if it exists.
+
+    Raises:
+        HTTPException: If the workflow was not profiled or is still running.
+    """
+    kind = PSTATS_SUFFIX if format == "pstats" else COLLAPSED_SUFFIX
+    name = os.path.basename(profile_artifact_path("", resolve_artifact_workflow_id(db, job_id), kind))
+    try:
+        file_path = get_storage().fetch("results", name)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Profile not found for workflow ID {job_id}")
+    touch(file_path)
+    media_type = "application/octet-stream" if kind == PSTATS_SUFFIX else "text/plain"
+    return FileResponse(file_path, media_type=media_type, filename=os.path.basename(file_path))
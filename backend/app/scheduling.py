@@ -0,0 +1,439 @@
+"""
+scheduling.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-04
+
+Size- and model-aware scheduling of the workflows.
+
+Every submitted job gets a cost estimate (in seconds) computed from the number of cells of the upload and the
+throughput of the model. The throughput starts from a default derived from the model's `SpeedEnum` and is
+refined with the throughput measured by the workers at the end of each run (exponential moving average stored
+in Redis).
+
+Jobs are routed to one of two Celery queues ("lanes"):
+- `fast`: jobs whose estimated cost is below `FAST_LANE_MAX_SECONDS`
+- `bulk`: everything else
+
+A dedicated worker only consumes the fast lane, while the general worker consumes both lanes. The Redis
+transport polls the queues of a worker in round-robin, so the general worker alternates between lanes instead
+of draining the bulk lane first. The estimated work pending on each lane is tracked in Redis so that the
+submit endpoint can return an estimated start and finish time.
+
+Each reserved job is a `helical:job:<workflow_id>` hash, and the backlog of the lanes and the in-flight count of
+the applications are aggregates of these hashes. The admission limits are checked and the jobs reserved by one
+Lua script (`reserve_jobs`), so that concurrent submissions cannot exceed them, and a job is released by another
+one (`release_job`). A job whose task never releases it (worker killed, message lost) would inflate the aggregates
+forever: the API periodically releases the jobs of the finished workflows and rebuilds the aggregates from the
+live job hashes (`start_reconciler`).
+
+Large single-model workflows are split into shards of cells (`plan_shards`), embedded and classified in parallel
+by several workers (see app.tasks.run_sharded_workflow).
+"""
+import os
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+import redis
+
+FAST_LANE = "fast"
+BULK_LANE = "bulk"
+LANES = [FAST_LANE, BULK_LANE]
+
+FAST_LANE_MAX_SECONDS = float(os.getenv("HELICAL_FAST_LANE_MAX_SECONDS", "300"))
+LANE_WORKERS = {
+    FAST_LANE: int(os.getenv("HELICAL_FAST_LANE_WORKERS", "2")),  # dedicated fast worker + general worker
+    BULK_LANE: int(os.getenv("HELICAL_BULK_LANE_WORKERS", "1")),
+}
+
+# Fixed cost of a run (loading, UMAP setup, export), independent of the number of cells
+BASE_OVERHEAD_SECONDS = 15.0
+# Default throughput per speed class, used until the workers have measured the real one
+DEFAULT_SECONDS_PER_CELL = {
+    "fast": 0.02,
+    "medium": 0.05,
+    "slow": 0.1,
+}
+THROUGHPUT_SMOOTHING = 0.3
+
+# Sharding: datasets of at least SHARD_MIN_CELLS cells are split in shards of about SHARD_SIZE cells,
+# at most MAX_SHARDS of them (which bounds the number of workers used by one workflow)
+SHARD_MIN_CELLS = int(os.getenv("HELICAL_SHARD_MIN_CELLS", "200000"))
+SHARD_SIZE = int(os.getenv("HELICAL_SHARD_SIZE", "100000"))
+MAX_SHARDS = int(os.getenv("HELICAL_MAX_SHARDS", "8"))
+
+THROUGHPUT_KEY = "helical:seconds_per_cell"
+BACKLOG_KEY = "helical:lane_backlog"
+INFLIGHT_APPS_KEY = "helical:inflight_applications"
+JOB_KEY = "helical:job:{workflow_id}"
+JOB_TTL_SECONDS = 7 * 24 * 3600
+RECONCILE_LOCK_KEY = "helical:reconcile_lock"
+RECONCILE_INTERVAL_SECONDS = float(os.getenv("HELICAL_RECONCILE_INTERVAL_SECONDS", "60"))
+# Jobs reserved more recently may not have their workflow row or task yet
+RECONCILE_GRACE_SECONDS = 300
+
+redis_client = redis.Redis(host="redis", port=6379, db=0)
+
+# KEYS: backlog, in-flight counts, then the hash of each job
+# ARGV: application ID, cap (0 = none), max pending seconds (0 = none), TTL, reservation time, then (lane, seconds)
+# of each job. Returns {"ok", backlog of the lane before each job} or {reason, lane, value} if a limit is reached.
+RESERVE_SCRIPT = """
+local n = #KEYS - 2
+local inflight = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+local cap = tonumber(ARGV[2])
+if cap > 0 and inflight + n > cap then
+    return {'application_concurrency', '', tostring(inflight)}
+end
+local max_pending = tonumber(ARGV[3])
+if max_pending > 0 then
+    for i = 1, n do
+        local lane = ARGV[4 + 2 * i]
+        local pending = tonumber(redis.call('HGET', KEYS[1], lane) or '0')
+        if pending >= max_pending then
+            return {'backlog_full', lane, tostring(pending)}
+        end
+    end
+end
+local reply = {'ok'}
+for i = 1, n do
+    local lane, seconds = ARGV[4 + 2 * i], ARGV[5 + 2 * i]
+    table.insert(reply, redis.call('HGET', KEYS[1], lane) or '0')
+    redis.call('HINCRBYFLOAT', KEYS[1], lane, seconds)
+    redis.call('HSET', KEYS[2 + i], 'lane', lane, 'seconds', seconds, 'application', ARGV[1], 'reserved_at', ARGV[5])
+    redis.call('EXPIRE', KEYS[2 + i], ARGV[4])
+end
+redis.call('HINCRBY', KEYS[2], ARGV[1], n)
+return reply
+"""
+
+# KEYS: backlog, in-flight counts, hash of the job. Returns 1 if the job was released, 0 if it was not reserved.
+RELEASE_SCRIPT = """
+local job = redis.call('HMGET', KEYS[3], 'lane', 'seconds', 'application')
+if not job[1] then
+    return 0
+end
+redis.call('DEL', KEYS[3])
+redis.call('HINCRBYFLOAT', KEYS[1], job[1], -tonumber(job[2]))
+redis.call('HINCRBY', KEYS[2], job[3], -1)
+return 1
+"""
+
+_reserve_script = redis_client.register_script(RESERVE_SCRIPT)
+_release_script = redis_client.register_script(RELEASE_SCRIPT)
+
+
+class ReservationRejected(Exception):
+    """
+    Raised by `reserve_jobs` when a limit is reached; nothing is reserved.
+
+    Attributes:
+        reason (str): "application_concurrency" or "backlog_full"
+        lane (str | None): Lane whose backlog is full
+        value (float): In-flight count of the application, or pending seconds of the lane
+    """
+
+    def __init__(self, reason, lane, value):
+        super().__init__(reason)
+        self.reason = reason
+        self.lane = lane or None
+        self.value = value
+
+
+def seconds_per_cell(model_name, speed):
+    """
+    Returns the processing time per cell of a model.
+
+    Args:
+        model_name (str): Name of the model
+        speed (str): Value of the model's `SpeedEnum`
+
+    Returns:
+        float: Measured seconds per cell if available, otherwise the default for the speed class
+    """
+    try:
+        measured = redis_client.hget(THROUGHPUT_KEY, model_name.lower())
+    except redis.RedisError:
+        measured = None
+    if measured is not None:
+        return float(measured)
+    return DEFAULT_SECONDS_PER_CELL.get(speed, DEFAULT_SECONDS_PER_CELL["medium"])
+
+
+def estimate_job_seconds(n_cells, models):
+    """
+    Estimates the run time of a job.
+
+    Args:
+        n_cells (int): Number of cells of the upload
+        models (list): (name, speed) of each model run by the job, speed being the value of its `SpeedEnum`
+
+    Returns:
+        float: Estimated run time in seconds
+    """
+    return BASE_OVERHEAD_SECONDS + n_cells * sum(seconds_per_cell(name, speed) for name, speed in models)
+
+
+def choose_lane(estimated_seconds):
+    """Returns the lane (Celery queue) of a job given its estimated cost."""
+    return FAST_LANE if estimated_seconds <= FAST_LANE_MAX_SECONDS else BULK_LANE
+
+
+def lane_backlog(lane):
+    """Returns the estimated seconds of work pending on a lane."""
+    try:
+        value = redis_client.hget(BACKLOG_KEY, lane)
+    except redis.RedisError:
+        return 0.0
+    return max(float(value), 0.0) if value is not None else 0.0
+
+
+def plan_job(n_cells, models):
+    """
+    Estimates the cost of a job and picks its lane, without reserving anything.
+
+    Args:
+        n_cells (int): Number of cells of the upload
+        models (list): (name, speed) of each model run by the job
+
+    Returns:
+        tuple: (estimated seconds, lane)
+    """
+    estimated_seconds = estimate_job_seconds(n_cells, models)
+    return estimated_seconds, choose_lane(estimated_seconds)
+
+
+def reserve_jobs(jobs, application_id, cap=0, max_pending_seconds=0):
+    """
+    Estimates the cost of jobs, picks their lanes and adds them to the lane backlogs and to the in-flight
+    count of their application. The limits are checked and the jobs reserved atomically: either all the jobs
+    are reserved or none is.
+
+    Args:
+        jobs (list): (workflow ID, number of cells of the upload, models) of each job, models being the
+            (name, speed) of each model run by the job
+        application_id (int): Application of the workflows
+        cap (int): Maximum number of in-flight workflows of the application (0 = unlimited)
+        max_pending_seconds (float): Jobs are rejected while their lane holds this much work (0 = unlimited)
+
+    Returns:
+        dict: Workflow ID -> lane, estimated cost and estimated start and finish times (ISO, UTC)
+
+    Raises:
+        ReservationRejected: If a limit is reached
+    """
+    plans = [(workflow_id, n_cells, *plan_job(n_cells, models)) for workflow_id, n_cells, models in jobs]
+    backlogs = [0.0] * len(plans)
+    try:
+        reply = _reserve_script(
+            keys=[BACKLOG_KEY, INFLIGHT_APPS_KEY, *(JOB_KEY.format(workflow_id=plan[0]) for plan in plans)],
+            args=[
+                str(application_id), cap or 0, max_pending_seconds or 0, JOB_TTL_SECONDS, int(time.time()),
+                *(value for _, _, seconds, lane in plans for value in (lane, seconds))
+            ]
+        )
+        reply = [value.decode() if isinstance(value, bytes) else value for value in reply]
+        if reply[0] != "ok":
+            raise ReservationRejected(reply[0], reply[1], float(reply[2]))
+        backlogs = [max(float(value), 0.0) for value in reply[1:]]
+    except redis.RedisError as e:
+        print(f"Could not record the backlog of workflows {[plan[0] for plan in plans]}: {e}")
+
+    now = datetime.utcnow()
+    schedules = {}
+    for (workflow_id, n_cells, estimated_seconds, lane), backlog in zip(plans, backlogs):
+        start = now + timedelta(seconds=backlog / max(LANE_WORKERS[lane], 1))
+        schedules[workflow_id] = {
+            "queue": lane,
+            "n_cells": n_cells,
+            "estimated_seconds": round(estimated_seconds, 1),
+            "estimated_start": start.isoformat(),
+            "estimated_finish": (start + timedelta(seconds=estimated_seconds)).isoformat(),
+        }
+    return schedules
+
+
+def release_job(workflow_id):
+    """
+    Removes a finished (or failed) job from its lane backlog and from the in-flight count of its
+    application. Safe to call several times.
+
+    Args:
+        workflow_id (str): ID of the workflow
+
+    Returns:
+        bool: Whether the job was reserved (and is now released)
+    """
+    try:
+        return bool(_release_script(keys=[BACKLOG_KEY, INFLIGHT_APPS_KEY, JOB_KEY.format(workflow_id=workflow_id)]))
+    except redis.RedisError as e:
+        print(f"Could not release the backlog of workflow {workflow_id}: {e}")
+        return False
+
+
+def live_jobs():
+    """
+    Returns the reserved jobs.
+
+    Returns:
+        dict: Workflow ID -> lane, estimated seconds, application ID and reservation time (None for the jobs
+        reserved before it was recorded)
+    """
+    jobs = {}
+    for key in redis_client.scan_iter(JOB_KEY.format(workflow_id="*"), count=500):
+        job = {k.decode(): v.decode() for k, v in redis_client.hgetall(key).items()}
+        if "lane" not in job:
+            continue  # Released since the scan
+        jobs[key.decode().rsplit(":", 1)[-1]] = {
+            "lane": job["lane"],
+            "seconds": float(job["seconds"]),
+            "application": job["application"],
+            "reserved_at": float(job["reserved_at"]) if "reserved_at" in job else None,
+        }
+    return jobs
+
+
+def rebuild_aggregates(retries=5):
+    """
+    Recomputes the lane backlogs and the in-flight counts from the live job hashes, dropping the contributions
+    of the jobs whose hash expired. The aggregates are watched, so the rebuild is retried if a job is reserved or
+    released meanwhile.
+
+    Args:
+        retries (int): Number of attempts
+
+    Returns:
+        bool: Whether the aggregates were rebuilt
+    """
+    for _ in range(retries):
+        with redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(BACKLOG_KEY, INFLIGHT_APPS_KEY)
+                backlog, inflight = {}, {}
+                for job in live_jobs().values():
+                    backlog[job["lane"]] = backlog.get(job["lane"], 0.0) + job["seconds"]
+                    inflight[job["application"]] = inflight.get(job["application"], 0) + 1
+                pipe.multi()
+                pipe.delete(BACKLOG_KEY, INFLIGHT_APPS_KEY)
+                if backlog:
+                    pipe.hset(BACKLOG_KEY, mapping=backlog)
+                if inflight:
+                    pipe.hset(INFLIGHT_APPS_KEY, mapping=inflight)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                continue
+    print("Could not rebuild the scheduling aggregates, jobs kept changing")
+    return False
+
+
+def finished_jobs(jobs, now=None):
+    """
+    Returns the reserved jobs which no task will release: their workflow row does not exist, or its Celery task
+    is done (a worker killed in the middle of a task does not run its `finally`). Recently reserved jobs are
+    skipped, their submission may still be in progress.
+
+    Args:
+        jobs (dict): Reserved jobs, from `live_jobs`
+        now (float | None): Current time (Unix seconds), defaults to `time.time()`
+
+    Returns:
+        list: Workflow IDs
+    """
+    from app.worker import celery_app
+    from db.database import SessionLocal
+    from db.models import Workflow
+
+    now = now or time.time()
+    candidates = [
+        workflow_id for workflow_id, job in jobs.items()
+        if job["reserved_at"] is None or now - job["reserved_at"] > RECONCILE_GRACE_SECONDS
+    ]
+    if not candidates:
+        return []
+    db = SessionLocal()
+    try:
+        workflows = {wf.id: wf for wf in db.query(Workflow).filter(Workflow.id.in_(candidates)).all()}
+    finally:
+        db.close()
+    finished = []
+    for workflow_id in candidates:
+        workflow = workflows.get(workflow_id)
+        if workflow is None or (workflow.task_id and celery_app.AsyncResult(workflow.task_id).ready()):
+            finished.append(workflow_id)
+    return finished
+
+
+def reconcile_jobs():
+    """
+    Releases the jobs of the finished workflows and rebuilds the aggregates, unless another process did it
+    during the last interval.
+
+    Returns:
+        list | None: The released workflow IDs, or None if the pass was skipped
+    """
+    if not redis_client.set(RECONCILE_LOCK_KEY, os.getpid(), nx=True, ex=max(1, int(RECONCILE_INTERVAL_SECONDS) - 1)):
+        return None
+    released = [workflow_id for workflow_id in finished_jobs(live_jobs()) if release_job(workflow_id)]
+    rebuild_aggregates()
+    return released
+
+
+def start_reconciler():
+    """
+    Starts the daemon thread reconciling the scheduling aggregates every `RECONCILE_INTERVAL_SECONDS`.
+    """
+    def loop():
+        while True:
+            try:
+                released = reconcile_jobs()
+                if released:
+                    print(f"Released the jobs of {len(released)} finished workflows: {released}")
+            except Exception as e:
+                print(f"Job reconciliation failed: {e}")
+            time.sleep(RECONCILE_INTERVAL_SECONDS)
+
+    thread = threading.Thread(target=loop, name="job-reconciler", daemon=True)
+    thread.start()
+    return thread
+
+
+def record_throughput(model_name, n_cells, seconds):
+    """
+    Updates the measured processing time per cell of a model with a finished run.
+
+    Args:
+        model_name (str): Name of the model
+        n_cells (int): Number of cells processed
+        seconds (float): Total run time of the workflow
+    """
+    if n_cells <= 0:
+        return
+    observed = max(seconds - BASE_OVERHEAD_SECONDS, 0.0) / n_cells
+    try:
+        previous = redis_client.hget(THROUGHPUT_KEY, model_name.lower())
+        if previous is not None:
+            observed = THROUGHPUT_SMOOTHING * observed + (1 - THROUGHPUT_SMOOTHING) * float(previous)
+        redis_client.hset(THROUGHPUT_KEY, model_name.lower(), observed)
+    except redis.RedisError as e:
+        print(f"Could not record the throughput of {model_name}: {e}")
+
+
+def plan_shards(n_cells, shard=None):
+    """
+    Splits the cells of a workflow into contiguous, balanced shards.
+
+    Args:
+        n_cells (int): Number of cells of the dataset
+        shard (bool | None): True forces sharding, False disables it, None shards datasets of at least
+            `SHARD_MIN_CELLS` cells
+
+    Returns:
+        list: (start, stop) cell ranges; a single range when the workflow is not sharded
+    """
+    if n_cells <= 0 or shard is False or (shard is None and n_cells < SHARD_MIN_CELLS):
+        return [(0, n_cells)]
+    n_shards = min(MAX_SHARDS, max(1, math.ceil(n_cells / SHARD_SIZE)))
+    size = math.ceil(n_cells / n_shards)
+    return [(start, min(start + size, n_cells)) for start in range(0, n_cells, size)]
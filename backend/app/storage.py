@@ -0,0 +1,275 @@
+"""
+storage.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-10
+
+Storage backends of the uploads and of the workflow artifacts, so that workers can run on other hosts than the API.
+
+Artifacts are addressed by their class (see `app.artifacts.ARTIFACT_CLASSES`: "uploads", "intermediate",
+"results") and their file name. They are always written to a local path first (`local_path`), then handed over
+to the storage with `put`; readers get a local path with `fetch`.
+
+Backends, selected with `HELICAL_STORAGE_BACKEND`:
+- `local` (default): the shared data volume. `put` and `fetch` are no-ops on the files of `app.artifacts`.
+- `s3`: an S3-compatible object store (AWS S3, MinIO, ...), configured with the `HELICAL_S3_*` variables and the
+  standard AWS credential variables. Transfers are multipart and parallel above `HELICAL_S3_MULTIPART_THRESHOLD_MB`.
+  `fetch` downloads the objects into a local read-through cache, bounded by `HELICAL_STORAGE_CACHE_MAX_BYTES`
+  and shared by the worker processes of a host. Expiration of the objects is left to the lifecycle rules of
+  the bucket; the artifact reaper only cleans up the local staging files.
+"""
+import fcntl
+import os
+import uuid
+from abc import ABC, abstractmethod
+
+from app.artifacts import artifact_path, touch
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STORAGE_BACKEND = os.getenv("HELICAL_STORAGE_BACKEND", "local")
+STORAGE_CACHE_DIR = os.getenv("HELICAL_STORAGE_CACHE_DIR", os.path.join(BASE_DIR, "data", "cache", "objects"))
+STORAGE_CACHE_MAX_BYTES = int(os.getenv("HELICAL_STORAGE_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+MB = 1024 ** 2
+
+
+class Storage(ABC):
+    """
+    Interface of the storage backends. A backend missing one of the abstract methods cannot be instantiated.
+    """
+    remote = False
+
+    def local_path(self, kind, name):
+        """
+        Returns the local path where a new artifact must be written before calling `put`.
+
+        Args:
+            kind (str): Class of the artifact
+            name (str): File name of the artifact
+
+        Returns:
+            str: Local path, whose directory exists
+        """
+        path = artifact_path(kind, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    @abstractmethod
+    def put(self, kind, name, local_path):
+        """
+        Stores an artifact. The local file is moved into the storage: it must not be used afterwards.
+
+        Args:
+            kind (str): Class of the artifact
+            name (str): File name of the artifact
+            local_path (str): Path of the local file, usually from `local_path`
+        """
+
+    @abstractmethod
+    def fetch(self, kind, name):
+        """
+        Returns a local path from which an artifact can be read.
+
+        Raises:
+            FileNotFoundError: If the artifact does not exist
+        """
+
+    @abstractmethod
+    def exists(self, kind, name):
+        """Returns whether an artifact exists."""
+
+    @abstractmethod
+    def delete(self, kind, name):
+        """Deletes an artifact, if it exists."""
+
+    @abstractmethod
+    def uri(self, kind, name):
+        """Returns a printable location of an artifact."""
+
+
+class LocalStorage(Storage):
+    """
+    Storage on the local (or shared) file system, in the directories of `app.artifacts`.
+    """
+
+    def put(self, kind, name, local_path):
+        path = artifact_path(kind, name)
+        if os.path.abspath(local_path) != os.path.abspath(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(local_path, path)
+
+    def fetch(self, kind, name):
+        path = artifact_path(kind, name)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Artifact {kind}/{name} not found")
+        return path
+
+    def exists(self, kind, name):
+        return os.path.exists(artifact_path(kind, name))
+
+    def delete(self, kind, name):
+        try:
+            os.remove(artifact_path(kind, name))
+        except FileNotFoundError:
+            pass
+
+    def uri(self, kind, name):
+        return os.path.abspath(artifact_path(kind, name))
+
+
+class S3Storage(Storage):
+    """
+    Storage on an S3-compatible object store, with a local read-through cache.
+    """
+    remote = True
+
+    def __init__(self, bucket, prefix="", endpoint_url=None, region=None, multipart_threshold=64 * MB,
+                 multipart_chunksize=16 * MB, max_concurrency=8, cache_dir=STORAGE_CACHE_DIR,
+                 cache_max_bytes=STORAGE_CACHE_MAX_BYTES):
+        """
+        Args:
+            bucket (str): Name of the bucket
+            prefix (str): Prefix of the object keys
+            endpoint_url (str | None): Endpoint of an S3-compatible service (e.g. "http://minio:9000")
+            region (str | None): Region of the bucket
+            multipart_threshold (int): Size in bytes above which transfers are multipart
+            multipart_chunksize (int): Size in bytes of the parts
+            max_concurrency (int): Number of parts transferred in parallel
+            cache_dir (str): Directory of the read-through cache
+            cache_max_bytes (int): Quota of the read-through cache
+        """
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency,
+            use_threads=True,
+        )
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+
+    def _key(self, kind, name):
+        return f"{self.prefix}{kind}/{name}"
+
+    def _cache_path(self, kind, name):
+        return os.path.join(self.cache_dir, kind, name)
+
+    @staticmethod
+    def _is_not_found(error):
+        return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+    def put(self, kind, name, local_path):
+        self.client.upload_file(local_path, self.bucket, self._key(kind, name), Config=self.transfer_config)
+        os.remove(local_path)
+
+    def fetch(self, kind, name):
+        from botocore.exceptions import ClientError
+
+        path = self._cache_path(kind, name)
+        if os.path.exists(path):
+            touch(path)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Only one process of the host downloads a given object, the others wait for it
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(path):
+                    touch(path)
+                    return path
+                tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+                try:
+                    self.client.download_file(self.bucket, self._key(kind, name), tmp_path, Config=self.transfer_config)
+                except ClientError as e:
+                    if self._is_not_found(e):
+                        raise FileNotFoundError(f"Artifact {kind}/{name} not found") from e
+                    raise
+                finally:
+                    if os.path.exists(tmp_path) and not os.path.getsize(tmp_path):
+                        os.remove(tmp_path)
+                os.replace(tmp_path, path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.evict_cache()
+        return path
+
+    def exists(self, kind, name):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(kind, name))
+            return True
+        except ClientError as e:
+            if self._is_not_found(e):
+                return False
+            raise
+
+    def delete(self, kind, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(kind, name))
+        for path in (self._cache_path(kind, name), f"{self._cache_path(kind, name)}.lock"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def uri(self, kind, name):
+        return f"s3://{self.bucket}/{self._key(kind, name)}"
+
+    def evict_cache(self):
+        """
+        Removes the least recently used objects of the read-through cache until it fits in its quota.
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for file_name in files:
+                if file_name.endswith((".lock", ".tmp")):
+                    continue
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.cache_max_bytes:
+                break
+            print(f"Evicting cached object {path} ({size / MB:.0f} MB)")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+_storage = None
+
+
+def get_storage():
+    """
+    Returns the storage backend configured with `HELICAL_STORAGE_BACKEND`, created on first use.
+
+    Returns:
+        Storage: The storage backend
+    """
+    global _storage
+    if _storage is None:
+        if STORAGE_BACKEND == "s3":
+            _storage = S3Storage(
+                bucket=os.environ["HELICAL_S3_BUCKET"],
+                prefix=os.getenv("HELICAL_S3_PREFIX", ""),
+                endpoint_url=os.getenv("HELICAL_S3_ENDPOINT_URL") or None,
+                region=os.getenv("HELICAL_S3_REGION") or None,
+                multipart_threshold=int(os.getenv("HELICAL_S3_MULTIPART_THRESHOLD_MB", "64")) * MB,
+                multipart_chunksize=int(os.getenv("HELICAL_S3_MULTIPART_CHUNK_MB", "16")) * MB,
+                max_concurrency=int(os.getenv("HELICAL_S3_MAX_CONCURRENCY", "8")),
+            )
+        elif STORAGE_BACKEND == "local":
+            _storage = LocalStorage()
+        else:
+            raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+    return _storage
@@ -0,0 +1,65 @@
+"""
+maintain_embedding_index.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-12
+
+This module defines the Celery task maintaining the embedding store of a model (see ml.embedding_index):
+it drops the oldest runs once the store exceeds `EMBEDDING_INDEX_MAX_ROWS` rows, and trains the IVF index once the
+store is large enough.
+
+The workflows only add their embeddings to the store; when the store needs maintenance, they schedule this task on
+the bulk lane (`request_index_maintenance`), so that no workflow runs the k-means or the compaction of the store.
+A Redis key makes sure that a single maintenance task per model is queued or running.
+"""
+import redis
+from app.worker import celery_app
+from app.scheduling import BULK_LANE
+from ml.embedding_index import get_index, EMBEDDING_INDEX_ENABLED, EMBEDDING_INDEX_MAX_ROWS
+
+MAINTENANCE_KEY = "helical:index_maintenance:{model}"
+# Lets another task be scheduled if the worker running this one died
+MAINTENANCE_TTL_SECONDS = 6 * 3600
+
+redis_client = redis.Redis(host="redis", port=6379, db=0)
+
+
+def request_index_maintenance(model_name):
+    """
+    Schedules the maintenance of the store of a model if it needs it and none is pending. Failures are logged
+    and never fail the workflow.
+
+    Args:
+        model_name (str): Name of the embedding model
+    """
+    if not EMBEDDING_INDEX_ENABLED:
+        return
+    try:
+        if not get_index(model_name).needs_maintenance():
+            return
+        if not redis_client.set(MAINTENANCE_KEY.format(model=model_name.lower()), 1, nx=True, ex=MAINTENANCE_TTL_SECONDS):
+            return
+        celery_app.send_task("tasks.maintain_embedding_index", args=[model_name], queue=BULK_LANE)
+        print(f"Scheduled the maintenance of the {model_name} embedding store")
+    except Exception as e:
+        print(f"Could not schedule the maintenance of the {model_name} embedding store: {e}")
+
+
+@celery_app.task(name="tasks.maintain_embedding_index")
+def maintain_embedding_index(model_name):
+    """
+    Celery task pruning the embedding store of a model to its quota and training its index if needed.
+
+    Args:
+        model_name (str): Name of the embedding model
+
+    Returns:
+        dict: Number of rows dropped and whether the index was trained
+    """
+    index = get_index(model_name)
+    try:
+        dropped = index.prune(EMBEDDING_INDEX_MAX_ROWS)
+        trained = index.needs_training() and index.rebuild()
+        return {"model": model_name, "dropped_rows": dropped, "trained": bool(trained)}
+    finally:
+        redis_client.delete(MAINTENANCE_KEY.format(model=model_name.lower()))
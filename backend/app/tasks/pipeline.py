@@ -0,0 +1,671 @@
+"""
+pipeline.py
+
+Author: Vincent Lefeuve
+Date: 2025-06-29
+
+This module holds the individual stages of the cell type annotation pipeline as plain functions, so that
+they can be reused outside of the Celery task (e.g. by the benchmark suite in `benchmarks/`).
+
+Stages:
+- `load_h5ad_sparse` / `ensure_sparse`: loads the upload (or a range of its cells) keeping the expression matrix in CSR format,
+  and restores it after the preprocessing of a model densified it
+- `load_h5ad_obs`: loads the cell annotations only
+- `embedding_buffer`: moves the embeddings into a memory-mapped buffer shared by the following stages
+- `embed_cells`: embeds the cells batch by batch straight into that buffer, with a callback between batches
+- `classify_embeddings`: runs the classification head and returns probabilities, labels and confidences
+- `classify_heads`: runs several heads fused in one bank over the same embeddings (see ml.head_bank)
+- `compute_statistics`: computes the label distribution and confidence summaries (see ml.statistics)
+- `compute_umap`: computes the UMAP layout of the embeddings, fitted on landmarks for large datasets
+- `build_result`: assembles the JSON-serializable result dictionary (final, or partial before the UMAP)
+- `save_annotated_data`: exports the annotated cells to CSV
+- `compute_agreement` / `save_multi_model_annotated_data`: comparison of several models on the same cells
+
+The embeddings are kept in a single memory-mapped array from `embedding_buffer` to the CSV export: the
+classification head, the neighbors/UMAP and the export all read it through zero-copy NumPy views and
+`torch.from_numpy` tensors, so that only one copy of the (n_cells, embedding_dim) matrix exists at a time.
+
+This module deliberately does not import the model registry, so it can be used without loading the
+foundation models.
+"""
+import scanpy as sc
+import anndata as ad
+import scipy.sparse as sp
+import torch
+import numpy as np
+import pandas as pd
+from datetime import datetime
+import os
+from ml.statistics import PredictionStats
+
+# Rows read (or densified) at once when the matrix has to be converted
+SPARSE_CHUNK_ROWS = 10_000
+# Cells passed through the classification head at once
+CLASSIFY_BATCH_SIZE = 8192
+# Cells passed to the embedding model at once, when its input can be sliced (see `embed_cells`)
+EMBED_BATCH_CELLS = int(os.getenv("HELICAL_EMBED_BATCH_CELLS", "4096"))
+# Rows written at once to the annotated CSV files
+CSV_CHUNK_ROWS = 50_000
+EMBEDDING_DTYPES = {"float32": np.float32, "float16": np.float16}
+# Datasets of at least this many cells get a UMAP fitted on landmarks and projected (see `compute_umap`)
+UMAP_LANDMARK_MIN_CELLS = int(os.getenv("HELICAL_UMAP_LANDMARK_MIN_CELLS", "200000"))
+UMAP_LANDMARKS = int(os.getenv("HELICAL_UMAP_LANDMARKS", "50000"))
+UMAP_MIN_LANDMARKS_PER_LABEL = 50
+UMAP_PROJECTION_NEIGHBORS = 10
+# Cells and neighbours of the layout quality metric
+UMAP_QUALITY_SAMPLE = 2000
+UMAP_QUALITY_NEIGHBORS = 15
+
+
+def _to_csr_chunked(X, chunk_rows=SPARSE_CHUNK_ROWS, rows=None):
+    """
+    Converts a matrix (in memory or backed on disk, dense or sparse) to CSR, one block of rows at a time,
+    so that a dense matrix is never fully materialized. `rows` optionally restricts it to a (start, stop) range.
+    """
+    first, last = rows if rows is not None else (0, X.shape[0])
+    blocks = []
+    for start in range(first, last, chunk_rows):
+        block = X[start:min(start + chunk_rows, last)]
+        blocks.append(block.tocsr() if sp.issparse(block) else sp.csr_matrix(np.asarray(block)))
+    if not blocks:
+        return sp.csr_matrix((0, X.shape[1]), dtype=np.float32)
+    return sp.vstack(blocks, format="csr")
+
+
+def load_h5ad_obs(path):
+    """
+    Loads the cell annotations (`obs`) of an .h5ad file, without its expression matrix.
+
+    Args:
+        path (str): Path of the .h5ad file
+
+    Returns:
+        AnnData: A dataset with `obs` only, e.g. to compute the UMAP of embeddings computed elsewhere
+    """
+    backed = sc.read_h5ad(path, backed="r")
+    try:
+        return ad.AnnData(obs=backed.obs.copy())
+    finally:
+        backed.file.close()
+
+
+def load_h5ad_sparse(path, chunk_rows=SPARSE_CHUNK_ROWS, rows=None):
+    """
+    Loads an .h5ad file with its expression matrix in CSR format.
+
+    The file is opened in backed mode and `X` is read one block of rows at a time: sparse matrices stay sparse
+    (CSC is converted to CSR) and dense matrices are converted to CSR without ever being fully loaded.
+
+    Only `X`, `obs`, `var`, `uns` and `obsm` are loaded: `layers`, `raw`, `varm`, `obsp` and `varp` are dropped,
+    since the models only read `X` and the gene names of `var`. A dataset whose counts live in a layer or in
+    `raw` must have them in `X` before upload.
+
+    Args:
+        path (str): Path of the .h5ad file
+        chunk_rows (int): Number of rows read at once
+        rows (tuple): Optional (start, stop) range of cells to load, e.g. for one shard of a dataset
+
+    Returns:
+        AnnData: The dataset, in memory, with `X` as a CSR matrix
+    """
+    backed = sc.read_h5ad(path, backed="r")
+    try:
+        start, stop = rows if rows is not None else (0, backed.n_obs)
+        X = _to_csr_chunked(backed.X, chunk_rows, (start, stop))
+        data = ad.AnnData(
+            X=X,
+            obs=backed.obs.iloc[start:stop].copy(),
+            var=backed.var.copy(),
+            uns=dict(backed.uns),
+            obsm={key: np.asarray(value[start:stop]) for key, value in backed.obsm.items()},
+        )
+    finally:
+        backed.file.close()
+    return data
+
+
+def ensure_sparse(data, stage, chunk_rows=SPARSE_CHUNK_ROWS):
+    """
+    Checks that `data.X` is still a CSR matrix after a stage, and converts it back otherwise.
+
+    Preprocessing code we do not control (e.g. helical's `process_data`) may densify or change the format of
+    `data.X` in place; this guard logs it and restores a CSR matrix so that the dense copy can be freed.
+    It runs after the preprocessing: it does not bound the peak memory of the preprocessing itself, which
+    holds the dense matrix of the whole dataset (or shard) while it runs. Sharding bounds it for large datasets
+    (see app.scheduling.plan_shards).
+
+    Args:
+        data (AnnData): The dataset (modified in place)
+        stage (str): Name of the stage which just ran, for the log
+        chunk_rows (int): Number of rows converted at once
+    """
+    if sp.isspmatrix_csr(data.X):
+        return
+    kind = "dense" if not sp.issparse(data.X) else data.X.format
+    print(f"Warning: data.X is {kind} after {stage}, converting it back to CSR")
+    data.X = _to_csr_chunked(data.X, chunk_rows)
+
+
+def embedding_buffer(x_embedded, path, dtype=np.float32, batch_size=CLASSIFY_BATCH_SIZE):
+    """
+    Moves the embeddings into a memory-mapped `.npy` buffer, which the following stages share zero-copy.
+
+    The embeddings are copied one batch of rows at a time, so once the caller drops its reference to the
+    input only the (disk-backed, evictable) buffer remains.
+
+    Args:
+        x_embedded (ndarray | Tensor): Cell embeddings of shape (n_cells, embedding_dim)
+        path (str): Path of the buffer file
+        dtype: dtype of the buffer, float32 or float16 (halves its size, the head and UMAP upcast per batch)
+        batch_size (int): Number of rows copied at once
+
+    Returns:
+        np.memmap: The buffer
+    """
+    if isinstance(x_embedded, torch.Tensor):
+        x_embedded = x_embedded.detach().cpu().numpy()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    buffer = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=tuple(x_embedded.shape))
+    for start in range(0, x_embedded.shape[0], batch_size):
+        buffer[start:start + batch_size] = x_embedded[start:start + batch_size]
+    buffer.flush()
+    return buffer
+
+
+def embed_cells(embedding_model, x_processed, path, dtype=np.float32, batch_cells=EMBED_BATCH_CELLS, before_batch=None):
+    """
+    Embeds the preprocessed cells into a memory-mapped buffer (see `embedding_buffer`).
+
+    Inputs which can be sliced (Hugging Face datasets, with `select`) are embedded `batch_cells` cells at a time,
+    each batch being written into the buffer as soon as it is embedded; the other inputs are embedded at once.
+    `before_batch` is called before each batch, e.g. as a cancellation point.
+
+    Args:
+        embedding_model: Helical embedding model
+        x_processed: Output of `embedding_model.process_data`
+        path (str): Path of the buffer file
+        dtype: dtype of the buffer
+        batch_cells (int): Number of cells embedded at once
+        before_batch (callable | None): Called without arguments before each batch
+
+    Returns:
+        np.memmap: The buffer
+    """
+    n_cells = len(x_processed)
+    if not hasattr(x_processed, "select") or n_cells <= batch_cells:
+        if before_batch is not None:
+            before_batch()
+        return embedding_buffer(embedding_model.get_embeddings(x_processed), path, dtype)
+
+    buffer = None
+    for start in range(0, n_cells, batch_cells):
+        if before_batch is not None:
+            before_batch()
+        stop = min(start + batch_cells, n_cells)
+        batch = embedding_model.get_embeddings(x_processed.select(range(start, stop)))
+        if isinstance(batch, torch.Tensor):
+            batch = batch.detach().cpu().numpy()
+        if buffer is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            buffer = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(n_cells, batch.shape[1]))
+        buffer[start:stop] = batch
+    buffer.flush()
+    return buffer
+
+
+def classify_embeddings(classification_model, x_embedded, device, batch_size=CLASSIFY_BATCH_SIZE, stats=None):
+    """
+    Runs the classification head on the embeddings, one batch of cells at a time.
+
+    Each batch is a `torch.from_numpy` view of the embeddings, and the probabilities are written into a single
+    preallocated array, so no full-size copy of the embeddings is made.
+
+    Args:
+        classification_model (torch.nn.Module): The classification head
+        x_embedded (ndarray | Tensor): Cell embeddings of shape (n_cells, embedding_dim), e.g. from `embedding_buffer`
+        device (str): Device on which to run the classification head
+        batch_size (int): Number of cells classified at once
+        stats (PredictionStats | None): Accumulator updated with the predictions of every batch
+
+    Returns:
+        tuple: (x_embedded, probs, pred_labels, confidence_scores) as CPU torch tensors; x_embedded and probs
+            share their memory with the embedding buffer and the probability array
+    """
+    if isinstance(x_embedded, torch.Tensor):
+        x_embedded = x_embedded.detach().cpu().numpy()
+    n_cells = x_embedded.shape[0]
+
+    probs = None
+    with torch.no_grad():
+        # At least one (possibly empty) batch, to get the number of classes
+        for start in range(0, max(n_cells, 1), batch_size):
+            batch = torch.from_numpy(x_embedded[start:start + batch_size]).to(device=device, dtype=torch.float32)
+            batch_probs = torch.nn.functional.softmax(classification_model(batch), dim=1).cpu().numpy()
+            if probs is None:
+                probs = np.empty((n_cells, batch_probs.shape[1]), dtype=np.float32)
+            probs[start:start + batch_probs.shape[0]] = batch_probs
+            if stats is not None:
+                stats.update_probs(batch_probs)
+
+    probs, pred_labels, confidence_scores = predictions_from_probs(probs)
+    return torch.from_numpy(x_embedded), probs, pred_labels, confidence_scores
+
+
+def classify_heads(head_bank, x_embedded, device, batch_size=CLASSIFY_BATCH_SIZE, stats=None):
+    """
+    Runs several classification heads fused in one bank (see ml.head_bank.HeadBank) over the embeddings, in
+    batches: every batch of embeddings is read once for all the heads.
+
+    Args:
+        head_bank (HeadBank): The fused heads
+        x_embedded (ndarray | Tensor): Cell embeddings of shape (n_cells, embedding_dim)
+        device (str): Device on which to run the heads
+        batch_size (int): Number of cells classified at once
+        stats (dict | None): Head name -> PredictionStats updated with the predictions of every batch
+
+    Returns:
+        tuple: (x_embedded as a CPU torch tensor, head name -> probabilities as ndarray)
+    """
+    if isinstance(x_embedded, torch.Tensor):
+        x_embedded = x_embedded.detach().cpu().numpy()
+    n_cells = x_embedded.shape[0]
+
+    probs = {}
+    with torch.no_grad():
+        for start in range(0, max(n_cells, 1), batch_size):
+            batch = torch.from_numpy(x_embedded[start:start + batch_size]).to(device=device, dtype=torch.float32)
+            for name, logits in head_bank(batch).items():
+                batch_probs = torch.nn.functional.softmax(logits, dim=1).cpu().numpy()
+                if name not in probs:
+                    probs[name] = np.empty((n_cells, batch_probs.shape[1]), dtype=np.float32)
+                probs[name][start:start + batch_probs.shape[0]] = batch_probs
+                if stats is not None:
+                    stats[name].update_probs(batch_probs)
+    return torch.from_numpy(x_embedded), probs
+
+
+def predictions_from_probs(probs):
+    """
+    Derives the predicted labels and confidences from the class probabilities.
+
+    Args:
+        probs (ndarray): Probabilities of shape (n_cells, n_classes)
+
+    Returns:
+        tuple: (probs, pred_labels, confidence_scores) as CPU torch tensors, probs sharing the memory of the input
+    """
+    probs = torch.from_numpy(probs)
+    confidence_scores, pred_labels = probs.max(dim=1)
+    return probs, pred_labels, confidence_scores
+
+
+def compute_statistics(pred_labels, confidence_scores, id2label, probs=None, thresholds=None, batch_size=CLASSIFY_BATCH_SIZE):
+    """
+    Computes the label distribution and the confidence summaries of the predictions, one batch of cells at a
+    time (see ml.statistics.PredictionStats). Workflows usually accumulate them during `classify_embeddings`
+    instead, without another pass over the predictions.
+
+    Args:
+        pred_labels (Tensor): Predicted class index per cell
+        confidence_scores (Tensor): Confidence (max probability) per cell
+        id2label (dict): Mapping from class index to label name
+        probs (Tensor | None): Probabilities per cell, for the entropy
+        thresholds (dict | None): Confidence thresholds of the application
+        batch_size (int): Number of cells added at once
+
+    Returns:
+        dict: Statistics with the keys used in the workflow result (summary, distribution, histograms, ...)
+    """
+    stats = PredictionStats(len(id2label), thresholds)
+    pred_labels, confidence_scores = pred_labels.cpu().numpy(), confidence_scores.cpu().numpy()
+    probs = probs.cpu().numpy() if probs is not None else None
+    for start in range(0, len(pred_labels), batch_size):
+        stop = start + batch_size
+        stats.update(pred_labels[start:stop], confidence_scores[start:stop], probs[start:stop] if probs is not None else None)
+    return stats.result(id2label)
+
+
+def select_landmarks(pred_labels, n_landmarks, min_per_label=UMAP_MIN_LANDMARKS_PER_LABEL, seed=0):
+    """
+    Draws a subsample of the cells stratified by predicted label: each label gets a share of the landmarks
+    proportional to its size, but at least `min_per_label` cells (or all its cells), so that rare cell types
+    keep their own region in the layout.
+
+    Args:
+        pred_labels (ndarray): Predicted class index per cell
+        n_landmarks (int): Target number of landmarks
+        min_per_label (int): Minimum number of landmarks per label
+        seed (int): Seed of the random draw
+
+    Returns:
+        ndarray: Sorted indexes of the landmark cells
+    """
+    labels = np.asarray(pred_labels)
+    if n_landmarks >= len(labels):
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    classes, counts = np.unique(labels, return_counts=True)
+    quotas = np.minimum(counts, np.maximum(counts * n_landmarks // len(labels), min_per_label))
+    landmarks = [
+        rng.choice(np.flatnonzero(labels == label), size=int(quota), replace=False)
+        for label, quota in zip(classes, quotas)
+    ]
+    return np.sort(np.concatenate(landmarks))
+
+
+def project_onto_landmarks(rep, landmarks, landmark_coords, n_neighbors=UMAP_PROJECTION_NEIGHBORS, chunk_rows=SPARSE_CHUNK_ROWS):
+    """
+    Places every cell in the layout of the landmarks: each other cell gets the inverse distance weighted
+    average of the 2D coordinates of its nearest landmarks in the embedding space.
+
+    Args:
+        rep (ndarray): Embeddings of all the cells (possibly a float16 memory map)
+        landmarks (ndarray): Indexes of the landmark cells
+        landmark_coords (ndarray): UMAP coordinates of the landmarks, of shape (n_landmarks, 2)
+        n_neighbors (int): Number of landmarks averaged per cell
+        chunk_rows (int): Number of cells projected at once
+
+    Returns:
+        ndarray: Coordinates of all the cells, of shape (n_cells, 2)
+    """
+    from pynndescent import NNDescent  # Dependency of umap-learn
+
+    index = NNDescent(np.asarray(rep[landmarks], dtype=np.float32), n_neighbors=max(15, n_neighbors), random_state=0)
+    index.prepare()
+    coords = np.empty((rep.shape[0], 2), dtype=np.float32)
+    coords[landmarks] = landmark_coords
+    others = np.setdiff1d(np.arange(rep.shape[0]), landmarks, assume_unique=True)
+    for start in range(0, len(others), chunk_rows):
+        rows = others[start:start + chunk_rows]
+        neighbors, distances = index.query(np.asarray(rep[rows], dtype=np.float32), k=n_neighbors)
+        weights = 1.0 / (distances + 1e-6)
+        weights /= weights.sum(axis=1, keepdims=True)
+        coords[rows] = np.einsum("nk,nkd->nd", weights, landmark_coords[neighbors])
+    return coords
+
+
+def neighbor_preservation(rep, coords, sample, k=UMAP_QUALITY_NEIGHBORS):
+    """
+    Fraction of the k nearest neighbours of each sampled cell in the embedding space which are also among its
+    k nearest neighbours in the 2D layout (neighbours are searched within the sample).
+
+    Args:
+        rep (ndarray): Embeddings of all the cells
+        coords (ndarray): Layout of all the cells
+        sample (ndarray): Sorted indexes of the sampled cells
+        k (int): Number of neighbours
+
+    Returns:
+        float | None: Between 0 and 1, higher is better; None if the sample is too small
+    """
+    if len(sample) <= k:
+        return None
+
+    def knn(x):
+        x = np.asarray(x, dtype=np.float32)
+        squared = (x * x).sum(axis=1)
+        distances = squared[:, None] + squared[None, :] - 2 * x @ x.T
+        np.fill_diagonal(distances, np.inf)
+        return np.argpartition(distances, k, axis=1)[:, :k]
+
+    high, low = knn(rep[sample]), knn(coords[sample])
+    shared = (high[:, :, None] == low[:, None, :]).any(axis=2).sum(axis=1)
+    return float(shared.mean() / k)
+
+
+def compute_umap(data, x_embedded, pred_labels, confidence_scores, id2label):
+    """
+    Computes the UMAP layout of the embeddings and builds the points sent to the frontend.
+
+    Datasets of at least `UMAP_LANDMARK_MIN_CELLS` cells use the landmark mode: UMAP is fitted on `UMAP_LANDMARKS`
+    cells stratified by predicted label (see `select_landmarks`) and the other cells are projected into that layout
+    (see `project_onto_landmarks`), instead of running the neighbors graph and UMAP on every cell.
+
+    The layout is described in `data.uns["umap_layout"]`: mode, number of fitted cells and `neighbor_preservation`
+    on a sample of the cells, comparable with that of a full fit. In landmark mode, it is also measured on a sample
+    of the landmarks only, and `relative_quality` is the ratio of both (the projected layout relative to the fitted one).
+
+    Args:
+        data (AnnData): The loaded single-cell data object (modified in place)
+        x_embedded (Tensor): Cell embeddings
+        pred_labels (Tensor): Predicted class index per cell
+        confidence_scores (Tensor): Confidence per cell
+        id2label (dict): Mapping from class index to label name
+
+    Returns:
+        list: List of dictionaries with UMAP x, y, label, confidence
+    """
+    # Zero-copy view of the embedding buffer for CPU tensors
+    rep = x_embedded.cpu().numpy()
+    labels = pred_labels.cpu().numpy()
+    n_cells = data.n_obs
+    landmarks = None
+    if n_cells >= UMAP_LANDMARK_MIN_CELLS and UMAP_LANDMARKS < n_cells:
+        landmarks = select_landmarks(labels, UMAP_LANDMARKS)
+        print(f"Fitting UMAP on {len(landmarks)} landmarks of {n_cells} cells")
+        subset = ad.AnnData(np.empty((len(landmarks), 0), dtype=np.float32))
+        subset.obsm["X_embedded"] = np.asarray(rep[landmarks], dtype=np.float32)
+        sc.pp.neighbors(subset, use_rep="X_embedded")
+        sc.tl.umap(subset)
+        coords = project_onto_landmarks(rep, landmarks, subset.obsm["X_umap"].astype(np.float32))
+        data.obsm["X_umap"] = coords
+    else:
+        # The neighbors search needs float32
+        data.obsm["X_embedded"] = rep if rep.dtype == np.float32 else rep.astype(np.float32)
+        sc.pp.neighbors(data, use_rep="X_embedded")
+        sc.tl.umap(data)
+        coords = data.obsm["X_umap"]
+
+    rng = np.random.default_rng(0)
+    sample = np.sort(rng.choice(n_cells, size=min(UMAP_QUALITY_SAMPLE, n_cells), replace=False))
+    layout = {
+        "mode": "full" if landmarks is None else "landmark",
+        "fitted_cells": n_cells if landmarks is None else int(len(landmarks)),
+        "neighbor_preservation": neighbor_preservation(rep, coords, sample),
+    }
+    if landmarks is not None:
+        landmark_sample = np.sort(rng.choice(landmarks, size=min(UMAP_QUALITY_SAMPLE, len(landmarks)), replace=False))
+        layout["landmark_neighbor_preservation"] = neighbor_preservation(rep, coords, landmark_sample)
+        if layout["neighbor_preservation"] is not None and layout["landmark_neighbor_preservation"]:
+            layout["relative_quality"] = layout["neighbor_preservation"] / layout["landmark_neighbor_preservation"]
+    data.uns["umap_layout"] = layout
+    return umap_points(coords, pred_labels, confidence_scores, id2label)
+
+
+def umap_points(coords, pred_labels, confidence_scores, id2label):
+    """
+    Builds the points sent to the frontend from a UMAP layout (e.g. restored from a checkpoint).
+
+    Args:
+        coords (ndarray): Layout of the cells, of shape (n_cells, 2)
+        pred_labels (Tensor): Predicted class index per cell
+        confidence_scores (Tensor): Confidence per cell
+        id2label (dict): Mapping from class index to label name
+
+    Returns:
+        list: List of dictionaries with UMAP x, y, label, confidence
+    """
+    xs, ys = coords[:, 0].tolist(), coords[:, 1].tolist()
+    labels = pred_labels.cpu().numpy().tolist()
+    confidences = confidence_scores.cpu().numpy().tolist()
+    return [
+        {"x": xs[i], "y": ys[i], "label": id2label[labels[i]], "confidence": confidences[i]}
+        for i in range(len(xs))
+    ]
+
+
+def build_result(workflow_id, upload_id, model_name, application, stats, confidence_scores, id2label, umap_points,
+                 status="completed"):
+    """
+    Assembles the JSON-serializable result dictionary published at the end of a workflow (or, with
+    `status="partial"` and no UMAP points, the partial result published before the UMAP stage).
+
+    Args:
+        workflow_id (str): Unique ID for this workflow run
+        upload_id (str): ID of the uploaded .h5ad file
+        model_name (str): The model used for embedding and classification
+        application (str): The chosen application
+        stats (dict): Output of `compute_statistics`
+        confidence_scores (Tensor): Confidence per cell
+        id2label (dict): Mapping from class index to label name
+        umap_points (list | None): Output of `compute_umap`, None while it is not computed
+        status (str): Status of the result, "completed" or "partial"
+
+    Returns:
+        dict: The workflow result
+    """
+    return {
+        "workflow_id": workflow_id,
+        "status": status,
+        "metadata": {
+            "model": model_name,
+            "application": application,
+            "input_file_name": f"{upload_id}.h5ad",
+            "n_cells": len(confidence_scores),
+            "created_at": datetime.utcnow().isoformat()
+        },
+        **stats,
+        "confidence_scores": confidence_scores[:100].tolist(),
+        "id_to_label": id2label,
+        "umap": umap_points
+    }
+
+
+def _write_csv_chunks(file_loc, n_rows, columns, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Writes a CSV file one block of rows at a time, so that only a block is ever held as a DataFrame.
+
+    Args:
+        file_loc (str): Path of the CSV file
+        n_rows (int): Number of rows
+        columns (callable): (start, stop) -> dict of column name to the values of the rows [start, stop)
+        chunk_rows (int): Number of rows per block
+    """
+    os.makedirs(os.path.dirname(file_loc), exist_ok=True)
+    with open(file_loc, "w", newline="") as f:
+        # At least one (possibly empty) block, so that the header is always written
+        for start in range(0, max(n_rows, 1), chunk_rows):
+            pd.DataFrame(columns(start, start + chunk_rows)).to_csv(f, index=False, header=start == 0)
+
+
+def save_annotated_data(data, probs, pred_labels, umap_points, workflow_id, folder, head_predictions=None):
+    """
+    Saves annotated data as CSV including cell ID, prediction probabilities,
+    predicted labels, and UMAP coordinates.
+
+    Args:
+        data (AnnData): The annotated scanpy data object
+        probs (ndarray): Prediction probabilities
+        pred_labels (ndarray): Predicted class labels
+        umap_points (list): List of dictionaries with UMAP x, y, label, confidence
+        workflow_id (str): ID for the workflow to name the output file
+        folder (str): Directory in which the CSV file is written
+        head_predictions (dict | None): Additional head name -> (predicted class labels, confidences) as ndarrays
+
+    Returns:
+        str: Path of the written CSV file
+    """
+    def columns(start, stop):
+        chunk = {
+            "cell_id": data.obs.index[start:stop],
+            **{f"PROBA_{i}": probs[start:stop, i] for i in range(probs.shape[1])},
+            "predicted_label": pred_labels[start:stop].tolist(),
+        }
+        for name, (head_labels, head_confidences) in (head_predictions or {}).items():
+            chunk[f"{name}_predicted_label"] = head_labels[start:stop].tolist()
+            chunk[f"{name}_confidence"] = head_confidences[start:stop]
+        chunk["umap_x"] = [p["x"] for p in umap_points[start:stop]]
+        chunk["umap_y"] = [p["y"] for p in umap_points[start:stop]]
+        return chunk
+
+    file_loc = os.path.join(folder, f"annotated_data_{workflow_id}.csv")
+    print(f"Saving annotated data to {file_loc}")
+    _write_csv_chunks(file_loc, data.n_obs, columns)
+    return file_loc
+
+
+def compute_agreement(pred_labels_by_model, confidence_by_model, id2label):
+    """
+    Computes the agreement between the predictions of several models on the same cells.
+
+    Args:
+        pred_labels_by_model (dict): Model name -> predicted class index per cell (ndarray)
+        confidence_by_model (dict): Model name -> confidence per cell (ndarray)
+        id2label (dict): Mapping from class index to label name
+
+    Returns:
+        tuple: (agreement statistics dict, consensus class index per cell as ndarray)
+    """
+    names = list(pred_labels_by_model)
+    labels = np.stack([pred_labels_by_model[name] for name in names])  # (n_models, n_cells)
+    confidences = np.stack([confidence_by_model[name] for name in names])
+    n_classes = len(id2label)
+    n_cells = labels.shape[1]
+
+    # Majority vote, ties broken by the summed confidence of the models voting for each class
+    votes = np.zeros((n_classes, n_cells), dtype=np.float64)
+    support = np.zeros((n_classes, n_cells), dtype=np.float64)
+    for m in range(len(names)):
+        np.add.at(votes, (labels[m], np.arange(n_cells)), 1)
+        np.add.at(support, (labels[m], np.arange(n_cells)), confidences[m])
+    consensus = np.argmax(votes + support / (len(names) + 1), axis=0)
+
+    all_agree = np.all(labels == labels[0], axis=0)
+    pairwise = {}
+    for a in range(len(names)):
+        for b in range(a + 1, len(names)):
+            same = labels[a] == labels[b]
+            confusion = np.zeros((n_classes, n_classes), dtype=np.int64)
+            np.add.at(confusion, (labels[a], labels[b]), 1)
+            pairwise[f"{names[a]}|{names[b]}"] = {
+                "agreement": float(same.mean()) if n_cells else None,
+                "confusion_matrix": confusion.tolist(),
+            }
+
+    per_class = {}
+    for i in range(n_classes):
+        mask = consensus == i
+        per_class[id2label[i]] = float(all_agree[mask].mean()) if mask.any() else None
+
+    stats = {
+        "models": names,
+        "full_agreement": float(all_agree.mean()) if n_cells else None,
+        "num_disagreements": int((~all_agree).sum()),
+        "pairwise": pairwise,
+        "per_class_agreement": per_class,
+        "consensus_distribution": {id2label[i]: int((consensus == i).sum()) for i in range(n_classes)},
+    }
+    return stats, consensus
+
+
+def save_multi_model_annotated_data(data, probs_by_model, pred_labels_by_model, consensus, umap_points, workflow_id, folder):
+    """
+    Saves the annotated data of a multi-model workflow as CSV: cell ID, probabilities and predicted label per
+    model, consensus label and UMAP coordinates.
+
+    Args:
+        data (AnnData): The annotated scanpy data object
+        probs_by_model (dict): Model name -> prediction probabilities (ndarray)
+        pred_labels_by_model (dict): Model name -> predicted class labels (ndarray)
+        consensus (ndarray): Consensus class label per cell
+        umap_points (list): List of dictionaries with UMAP x, y, label, confidence
+        workflow_id (str): ID for the workflow to name the output file
+        folder (str): Directory in which the CSV file is written
+
+    Returns:
+        str: Path of the written CSV file
+    """
+    def columns(start, stop):
+        chunk = {"cell_id": data.obs.index[start:stop]}
+        for name, probs in probs_by_model.items():
+            chunk.update({f"{name}_PROBA_{i}": probs[start:stop, i] for i in range(probs.shape[1])})
+            chunk[f"{name}_predicted_label"] = pred_labels_by_model[name][start:stop].tolist()
+        chunk["consensus_label"] = consensus[start:stop].tolist()
+        chunk["umap_x"] = [p["x"] for p in umap_points[start:stop]]
+        chunk["umap_y"] = [p["y"] for p in umap_points[start:stop]]
+        return chunk
+
+    file_loc = os.path.join(folder, f"annotated_data_{workflow_id}.csv")
+    print(f"Saving annotated data to {file_loc}")
+    _write_csv_chunks(file_loc, data.n_obs, columns)
+    return file_loc
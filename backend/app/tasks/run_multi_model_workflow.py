@@ -0,0 +1,290 @@
+"""
+run_multi_model_workflow.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-07
+
+This module defines the Celery task comparing several models on the same dataset in a single job.
+
+Compared to submitting one workflow per model, the task:
+- reads the uploaded .h5ad file once and deletes it once, after every model ran
+- preprocesses the dataset for each model in sequence (preprocessing modifies the shared AnnData), then embeds and
+  classifies with each requested model, in sequence (default) or in parallel threads
+- keeps the embeddings of each model in its own memory-mapped buffer (see `app.tasks.pipeline.embedding_buffer`)
+- publishes a partial result once every model classified the cells, before the UMAP (see `run_workflow`)
+- computes a single UMAP, from the embeddings of the primary (first) model, with the labels of every model
+- produces one combined result with per-model predictions and statistics, a consensus label and agreement statistics
+
+The top-level fields of the result (summary, distribution, histograms, UMAP, ...) are those of the primary model,
+so that the result can be displayed like a single-model result.
+
+Like `run_workflow`, the task is acknowledged late and checkpoints its stages (see app.checkpoints): the
+probabilities and statistics of each model once it is classified (with the embeddings of the primary model) and the
+UMAP layout. A task redelivered after its worker died only runs the models and stages which did not complete.
+"""
+import os
+import json
+import time
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from app.worker import celery_app
+from app.telemetry import StageRecorder
+from app.scheduling import release_job
+from app.artifacts import RESULTS_DIR
+from app.storage import get_storage
+from app.tasks.pipeline import (
+    classify_embeddings, compute_umap, build_result, compute_agreement,
+    save_multi_model_annotated_data, ensure_sparse, embed_cells, predictions_from_probs, umap_points
+)
+from app.tasks.run_workflow import (
+    load_upload_file, delete_upload_file, embedding_path, delete_embeddings, abort_cancelled,
+    publish_partial_result, redis_client, EMBEDDING_DTYPE
+)
+from app.cancellation import WorkflowCancelled, check_cancelled, publish_failed
+from app.checkpoints import WorkflowCheckpoint, MAX_TASK_ATTEMPTS
+from ml.model_registry import ModelRegistry
+from ml import token_cache
+from ml.statistics import PredictionStats
+from ml.embedding_index import index_run
+from app.tasks.maintain_embedding_index import request_index_maintenance
+
+
+def _preprocess(model_registry, model_name, data, recorder, dataset_hash):
+    """
+    Runs the preprocessing of one model. It modifies `data` (e.g. densifies its matrix), so the models are
+    preprocessed one after the other, even in parallel mode.
+
+    Returns:
+        The preprocessed input of the embedding model
+    """
+    embedding_model, _ = model_registry.get_model(model_name.lower())
+    with recorder.span(f"process_data:{model_name}", data.n_obs):
+        x_processed, _ = token_cache.get_or_process(embedding_model, data, model_name, dataset_hash)
+        ensure_sparse(data, f"process_data:{model_name}")
+    return x_processed
+
+
+def _embed_and_classify(model_registry, model_name, x_processed, n_cells, recorder, workflow_id, stats):
+    """
+    Runs embedding and classification of one model on its preprocessed input, accumulating its prediction
+    statistics in `stats`. Only reads shared state, so several models may run in parallel threads.
+
+    Returns:
+        tuple: (x_embedded, probs, pred_labels, confidence_scores) as torch tensors
+    """
+    embedding_model, classification_model = model_registry.get_model(model_name.lower())
+    with recorder.span(f"embed:{model_name}", n_cells):
+        x_embedded = embed_cells(
+            embedding_model, x_processed, embedding_path(workflow_id, model_name), EMBEDDING_DTYPE,
+            before_batch=lambda: check_cancelled(workflow_id)
+        )
+    with recorder.span(f"classify:{model_name}", n_cells):
+        return classify_embeddings(classification_model, x_embedded, model_registry.get_device(), stats=stats)
+
+
+def _checkpoint_model(checkpoint, workflow_id, model_name, primary, output, stats):
+    """
+    Checkpoints the classification of one model: its probabilities and statistics, and the embeddings of the
+    primary model, which the UMAP needs.
+    """
+    files = {f"probs_{model_name.lower()}": output[1].cpu().numpy()}
+    if model_name == primary:
+        files["embeddings"] = embedding_path(workflow_id, model_name)
+    checkpoint.save(f"classify:{model_name}", files, {"stats": stats.to_dict()})
+
+
+def _restore_model(checkpoint, workflow_id, model_name, primary):
+    """
+    Restores the classification of one model checkpointed by `_checkpoint_model`.
+
+    Returns:
+        tuple: ((x_embedded, probs, pred_labels, confidence_scores), PredictionStats); x_embedded is None for the
+            models other than the primary one
+    """
+    probs, pred_labels, confidence_scores = predictions_from_probs(checkpoint.load(f"probs_{model_name.lower()}"))
+    x_embedded = None
+    if model_name == primary:
+        x_embedded = torch.from_numpy(checkpoint.load("embeddings", embedding_path(workflow_id, model_name)))
+    stats = PredictionStats.from_dict(checkpoint.get(f"classify:{model_name}")["stats"])
+    return (x_embedded, probs, pred_labels, confidence_scores), stats
+
+
+def _model_results(stats_by_model, outputs):
+    """
+    Returns the per-model part of the result: the statistics of each model and its first confidence scores.
+    """
+    return {
+        name: {**stats, "confidence_scores": outputs[name][3][:100].tolist()}
+        for name, stats in stats_by_model.items()
+    }
+
+
+@celery_app.task(name="tasks.run_multi_model_workflow", bind=True, acks_late=True, reject_on_worker_lost=True)
+def run_multi_model_workflow(self, workflow_id, upload_id, model_names, application, parallel=False, dataset_hash=None,
+                             thresholds=None):
+    """
+    Celery task running several models on the same uploaded dataset.
+
+    Args:
+        self: The Celery task instance (for state updates)
+        workflow_id (str): Unique ID for this workflow run
+        upload_id (str): ID of the uploaded .h5ad file
+        model_names (list): Models to run; the first one is the primary model
+        application (str): The chosen application
+        parallel (bool): Embed and classify with the models in parallel threads instead of in sequence (the
+            preprocessing stays sequential). Faster on multi-core or GPU machines, at the cost of holding the
+            inputs and embeddings of every model in memory at the same time.
+        dataset_hash (str): SHA-256 of the upload, used to reuse its cached preprocessed inputs (see ml.token_cache)
+        thresholds (dict | None): Confidence thresholds of the application (see ml.statistics.DEFAULT_THRESHOLDS)
+
+    Returns:
+        dict: A JSON-serializable result dictionary containing the per-model predictions and the agreement statistics.
+    """
+    checkpoint = None
+    try:
+        checkpoint = WorkflowCheckpoint(workflow_id, {
+            "upload_id": upload_id, "models": model_names, "thresholds": thresholds,
+            "embedding_dtype": EMBEDDING_DTYPE.__name__,
+        })
+        if checkpoint.attempt > MAX_TASK_ATTEMPTS:
+            error = f"Workflow {workflow_id} lost its worker {checkpoint.attempt - 1} times, giving up"
+            publish_failed(workflow_id, error)
+            raise RuntimeError(error)
+        return _run_multi_model_workflow(
+            self, workflow_id, upload_id, model_names, application, parallel, dataset_hash, thresholds, checkpoint
+        )
+    except WorkflowCancelled:
+        abort_cancelled(self, workflow_id)
+    finally:
+        delete_embeddings(workflow_id)
+        release_job(workflow_id)
+        if checkpoint is not None:
+            checkpoint.clear()
+
+
+def _run_multi_model_workflow(self, workflow_id, upload_id, model_names, application, parallel, dataset_hash, thresholds,
+                              checkpoint):
+    """
+    Body of `run_multi_model_workflow`. The models and stages completed by a previous delivery of the task are
+    restored from `checkpoint` instead of being run again.
+    """
+    primary = model_names[0]
+    wall_start = time.perf_counter()
+    recorder = StageRecorder("+".join(model_names))
+    with recorder.span("load"):
+        data = load_upload_file(upload_id)
+    n_cells = data.n_obs
+    recorder.observe_cells(n_cells)
+    print(f"Loaded data for workflow {workflow_id} from {upload_id}.h5ad, models: {model_names}")
+    model_registry = ModelRegistry()
+    id2label = model_registry.id2label
+
+    prediction_stats = {name: PredictionStats(len(id2label), thresholds) for name in model_names}
+    outputs = {}
+    resumed = list(checkpoint.stages)
+    if resumed:
+        print(f"Resuming workflow {workflow_id} (attempt {checkpoint.attempt}) after stages {', '.join(resumed)}")
+        with recorder.span("restore", n_cells):
+            for name in model_names:
+                if checkpoint.get(f"classify:{name}"):
+                    outputs[name], prediction_stats[name] = _restore_model(checkpoint, workflow_id, name, primary)
+    pending = [name for name in model_names if name not in outputs]
+
+    self.update_state(state="PROGRESS", meta={"stage": "EMBEDDING", "models": model_names})
+    if parallel and pending:
+        inputs = {}
+        for name in pending:
+            check_cancelled(workflow_id)
+            inputs[name] = _preprocess(model_registry, name, data, recorder, dataset_hash)
+        # One recorder per thread: the spans overlap, so their process-wide measures are not recorded
+        thread_recorders = {name: StageRecorder(recorder.model_name, concurrent=True) for name in pending}
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            futures = {
+                name: executor.submit(
+                    _embed_and_classify, model_registry, name, inputs[name], n_cells, thread_recorders[name],
+                    workflow_id, prediction_stats[name]
+                )
+                for name in pending
+            }
+            outputs.update({name: future.result() for name, future in futures.items()})
+        del inputs
+        for name in pending:
+            recorder.spans.extend(thread_recorders[name].spans)
+            _checkpoint_model(checkpoint, workflow_id, name, primary, outputs[name], prediction_stats[name])
+    else:
+        for name in pending:
+            self.update_state(state="PROGRESS", meta={"stage": "EMBEDDING", "model": name, "models": model_names})
+            x_processed = _preprocess(model_registry, name, data, recorder, dataset_hash)
+            outputs[name] = _embed_and_classify(
+                model_registry, name, x_processed, n_cells, recorder, workflow_id, prediction_stats[name]
+            )
+            del x_processed
+            _checkpoint_model(checkpoint, workflow_id, name, primary, outputs[name], prediction_stats[name])
+            if name != primary:
+                # Only the primary embeddings are needed for the UMAP
+                x_embedded, probs, pred_labels, confidence_scores = outputs[name]
+                outputs[name] = (None, probs, pred_labels, confidence_scores)
+
+    self.update_state(state="PROGRESS", meta={"stage": "RUNNING STATS"})
+    with recorder.span("stats", n_cells):
+        stats_by_model = {name: stats.result(id2label) for name, stats in prediction_stats.items()}
+        pred_labels_by_model = {name: out[2].cpu().numpy() for name, out in outputs.items()}
+        confidence_by_model = {name: out[3].cpu().numpy() for name, out in outputs.items()}
+        agreement, consensus = compute_agreement(pred_labels_by_model, confidence_by_model, id2label)
+
+    check_cancelled(workflow_id)
+    x_embedded, _, pred_labels, confidence_scores = outputs[primary]
+    # Partial result: the predictions, statistics and agreement are served while the UMAP is computed
+    partial = build_result(
+        workflow_id, upload_id, primary, application, stats_by_model[primary], confidence_scores, id2label, None,
+        status="partial"
+    )
+    partial["metadata"]["models"] = model_names
+    partial["models"] = _model_results(stats_by_model, outputs)
+    partial["agreement"] = agreement
+    publish_partial_result(partial, pred_labels, {}, recorder)
+    self.update_state(state="PROGRESS", meta={"stage": "UMAP", "partial_result": True, "models": model_names})
+    layout = checkpoint.get("umap")
+    if layout:
+        with recorder.span("restore", n_cells):
+            data.obsm["X_umap"] = checkpoint.load("umap")
+            data.uns["umap_layout"] = layout["layout"]
+            points = umap_points(data.obsm["X_umap"], pred_labels, confidence_scores, id2label)
+    else:
+        with recorder.span("umap", n_cells):
+            points = compute_umap(data, x_embedded, pred_labels, confidence_scores, id2label)
+        checkpoint.save("umap", {"umap": data.obsm["X_umap"]}, {"layout": data.uns.get("umap_layout")})
+    for i, point in enumerate(points):
+        point["labels"] = {name: id2label[int(pred_labels_by_model[name][i])] for name in model_names}
+        point["consensus"] = id2label[int(consensus[i])]
+
+    with recorder.span("export", n_cells):
+        file_loc = save_multi_model_annotated_data(
+            data,
+            {name: out[1].cpu().numpy() for name, out in outputs.items()},
+            pred_labels_by_model,
+            consensus,
+            points,
+            workflow_id,
+            RESULTS_DIR
+        )
+        get_storage().put("results", os.path.basename(file_loc), file_loc)
+    # Only the embeddings of the primary model are kept until the end of the workflow
+    with recorder.span(f"index:{primary}", n_cells):
+        index_run(primary, workflow_id, x_embedded.numpy(), data.obs.index, pred_labels.numpy())
+        request_index_maintenance(primary)
+
+    result = build_result(workflow_id, upload_id, primary, application, stats_by_model[primary], confidence_scores, id2label, points)
+    result["metadata"]["models"] = model_names
+    result["metadata"]["umap"] = data.uns.get("umap_layout")
+    result["metadata"]["stages"] = recorder.as_list()
+    # Measured end to end: the stages of parallel models overlap, so their sum would overcount
+    result["metadata"]["wall_seconds"] = round(time.perf_counter() - wall_start, 4)
+    if resumed:
+        result["metadata"]["resumed"] = {"attempt": checkpoint.attempt, "stages": resumed}
+    result["models"] = _model_results(stats_by_model, outputs)
+    result["agreement"] = agreement
+    with recorder.span("publish", n_cells):
+        redis_client.publish("workflow_results", json.dumps(result))
+    delete_upload_file(upload_id)
+    return result
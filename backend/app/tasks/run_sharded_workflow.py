@@ -0,0 +1,347 @@
+"""
+run_sharded_workflow.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-08
+
+This module defines the Celery tasks processing one workflow on several workers, by splitting its cells in shards.
+
+`run_workflow` replaces itself by a chord of these tasks when the dataset is large (see `app.scheduling.plan_shards`):
+- `embed_shard` loads, preprocesses, embeds and classifies one range of cells, and saves the embeddings and the
+  probabilities of the shard as .npy files, handed over to the storage backend (see app.storage), followed by
+  the descriptor it returns. It is acknowledged late, so a shard whose worker died is delivered again; the
+  shard is its own checkpoint: a redelivered shard whose outputs and descriptor are stored returns the stored
+  descriptor without embedding the cells again
+- `finalize_sharded_workflow` runs once every shard is done: it merges the shards in cell order into one
+  embedding buffer, then computes the statistics, publishes the partial result, computes the global UMAP and the
+  CSV export, and publishes the result.
+  It is acknowledged late too, and checkpoints the merged embeddings and probabilities and the UMAP layout like
+  `run_workflow` (see app.checkpoints), so a redelivered merge task resumes after its last completed stage. The
+  shard outputs are only deleted when the task ends
+- `abort_sharded_workflow` is the error callback of the chord, releasing the job when a shard fails (shards of a
+  cancelled workflow fail with `WorkflowCancelled`, see app.cancellation)
+
+Every cell is embedded and classified independently of the other cells, so the merged result is the same as the
+result of a single-worker run. The shards are exchanged through the storage backend, so workers may run on
+other hosts when it is remote.
+"""
+import os
+import json
+import numpy as np
+from app.worker import celery_app
+from app.telemetry import StageRecorder
+from app.scheduling import release_job, record_throughput
+from app.tasks.pipeline import (
+    classify_embeddings, compute_umap, build_result, load_h5ad_sparse, load_h5ad_obs,
+    ensure_sparse, embed_cells, predictions_from_probs, umap_points
+)
+from app.tasks.run_workflow import (
+    save_annotated_data, upload_path, embedding_path, delete_embeddings, delete_upload_file, abort_cancelled,
+    publish_partial_result, redis_client, EMBEDDING_DTYPE
+)
+from app.cancellation import WorkflowCancelled, check_cancelled, is_cancelled, publish_cancelled, publish_failed
+from app.checkpoints import WorkflowCheckpoint, MAX_TASK_ATTEMPTS
+from app.storage import get_storage
+from ml.model_registry import ModelRegistry
+from ml.statistics import PredictionStats
+from ml.embedding_index import index_run
+from app.tasks.maintain_embedding_index import request_index_maintenance
+from ml import token_cache
+import torch
+
+
+def shard_path(workflow_id, index, kind):
+    """
+    Returns the path of an output ("embeddings" or "probs") of one shard of a workflow.
+    """
+    return embedding_path(workflow_id, f"shard{index:04d}_{kind}")
+
+
+def shard_descriptor_name(workflow_id, index):
+    """
+    Returns the name, in the "intermediate" storage, of the descriptor of one shard of a workflow.
+    """
+    return f"{workflow_id}_shard{index:04d}_result.json"
+
+
+def completed_shard(workflow_id, index):
+    """
+    Returns the stored descriptor of a shard whose outputs are already stored, e.g. by a delivery of
+    `embed_shard` whose worker died before the task was acknowledged. The descriptor is stored after the
+    outputs, so a shard interrupted while saving them is run again.
+
+    Args:
+        workflow_id (str): ID of the sharded workflow
+        index (int): Index of the shard
+
+    Returns:
+        dict | None: The return value of `embed_shard`, or None if the shard has to be run
+    """
+    storage = get_storage()
+    names = [shard_descriptor_name(workflow_id, index)] + [
+        os.path.basename(shard_path(workflow_id, index, kind)) for kind in ("embeddings", "probs")
+    ]
+    if not all(storage.exists("intermediate", name) for name in names):
+        return None
+    with open(storage.fetch("intermediate", names[0])) as f:
+        return json.load(f)
+
+
+@celery_app.task(name="tasks.embed_shard", bind=True, acks_late=True, reject_on_worker_lost=True)
+def embed_shard(self, workflow_id, upload_id, model_name, index, start, stop, dataset_hash=None, thresholds=None):
+    """
+    Celery task embedding and classifying one shard of the cells of a workflow.
+
+    Args:
+        self: The Celery task instance
+        workflow_id (str): ID of the sharded workflow
+        upload_id (str): ID of the uploaded .h5ad file
+        model_name (str): The model to use for embedding and classification
+        index (int): Index of the shard
+        start (int): First cell of the shard
+        stop (int): End (excluded) of the cell range of the shard
+        dataset_hash (str): SHA-256 of the upload, used to reuse the cached preprocessed input of the shard
+        thresholds (dict | None): Confidence thresholds of the application
+
+    Returns:
+        dict: Index, cell range, stage timings, token cache hit and prediction statistics (see
+            ml.statistics.PredictionStats.to_dict) of the shard
+    """
+    check_cancelled(workflow_id)
+    descriptor = completed_shard(workflow_id, index)
+    if descriptor is not None:
+        print(f"Shard {index} of workflow {workflow_id} is already embedded, reusing its outputs")
+        return descriptor
+    recorder = StageRecorder(model_name)
+    with recorder.span("load"):
+        data = load_h5ad_sparse(upload_path(upload_id), rows=(start, stop))
+    n_cells = data.n_obs
+    recorder.observe_cells(n_cells)
+    print(f"Loaded shard {index} (cells {start}-{stop}) of workflow {workflow_id}")
+
+    model_registry = ModelRegistry()
+    embedding_model, classification_model = model_registry.get_model(model_name.lower())
+    shard_hash = f"{dataset_hash}:{start}-{stop}" if dataset_hash else None
+
+    with recorder.span("process_data", n_cells):
+        x_processed, token_cache_hit = token_cache.get_or_process(embedding_model, data, model_name, shard_hash)
+        ensure_sparse(data, "process_data")
+    with recorder.span("embed", n_cells):
+        x_embedded = embed_cells(
+            embedding_model, x_processed, shard_path(workflow_id, index, "embeddings"), EMBEDDING_DTYPE,
+            before_batch=lambda: check_cancelled(workflow_id)
+        )
+    stats = PredictionStats(len(model_registry.id2label), thresholds)
+    with recorder.span("classify", n_cells):
+        _, probs, _, _ = classify_embeddings(classification_model, x_embedded, model_registry.get_device(), stats=stats)
+        np.save(shard_path(workflow_id, index, "probs"), probs.numpy())
+    del x_embedded
+    storage = get_storage()
+    for kind in ("embeddings", "probs"):
+        path = shard_path(workflow_id, index, kind)
+        storage.put("intermediate", os.path.basename(path), path)
+
+    descriptor = {
+        "index": index,
+        "start": start,
+        "stop": stop,
+        "stages": [{**span, "shard": index} for span in recorder.as_list()],
+        "token_cache_hit": token_cache_hit,
+        "stats": stats.to_dict(),
+    }
+    # Last, it marks the shard as completed (see `completed_shard`)
+    name = shard_descriptor_name(workflow_id, index)
+    local = storage.local_path("intermediate", name)
+    with open(local, "w") as f:
+        json.dump(descriptor, f)
+    storage.put("intermediate", name, local)
+    return descriptor
+
+
+def merge_shards(workflow_id, shard_results, n_cells):
+    """
+    Merges the outputs of the shards, in cell order, into one embedding buffer and one probability array.
+    The shard outputs are fetched from the storage backend; they are kept until the merge task ends (see
+    `delete_shard_outputs`).
+
+    Args:
+        workflow_id (str): ID of the sharded workflow
+        shard_results (list): Return values of `embed_shard`, sorted by index
+        n_cells (int): Total number of cells
+
+    Returns:
+        tuple: (embedding buffer as np.memmap, probabilities as ndarray)
+    """
+    storage = get_storage()
+
+    def fetch(index, kind):
+        return storage.fetch("intermediate", os.path.basename(shard_path(workflow_id, index, kind)))
+
+    first = np.load(fetch(shard_results[0]["index"], "embeddings"), mmap_mode="r")
+    os.makedirs(os.path.dirname(embedding_path(workflow_id)), exist_ok=True)
+    buffer = np.lib.format.open_memmap(
+        embedding_path(workflow_id), mode="w+", dtype=first.dtype, shape=(n_cells, first.shape[1])
+    )
+    del first
+    probs = []
+    for shard in shard_results:
+        buffer[shard["start"]:shard["stop"]] = np.load(fetch(shard["index"], "embeddings"), mmap_mode="r")
+        probs.append(np.load(fetch(shard["index"], "probs")))
+    buffer.flush()
+    return buffer, np.concatenate(probs)
+
+
+def delete_shard_outputs(workflow_id, shard_results):
+    """
+    Deletes the outputs and descriptors of the shards of a workflow from the storage backend.
+
+    Args:
+        workflow_id (str): ID of the sharded workflow
+        shard_results (list): Return values of `embed_shard`
+    """
+    storage = get_storage()
+    for shard in shard_results:
+        names = [shard_descriptor_name(workflow_id, shard["index"])] + [
+            os.path.basename(shard_path(workflow_id, shard["index"], kind)) for kind in ("embeddings", "probs")
+        ]
+        for name in names:
+            if storage.exists("intermediate", name):
+                storage.delete("intermediate", name)
+
+
+@celery_app.task(name="tasks.finalize_sharded_workflow", bind=True, acks_late=True, reject_on_worker_lost=True)
+def finalize_sharded_workflow(self, shard_results, workflow_id, upload_id, model_name, application):
+    """
+    Celery task merging the shards of a workflow and producing its result.
+
+    Args:
+        self: The Celery task instance (it carries the task ID of the original workflow task)
+        shard_results (list): Return values of the `embed_shard` tasks, passed by the chord
+        workflow_id (str): ID of the sharded workflow
+        upload_id (str): ID of the uploaded .h5ad file
+        model_name (str): The model used for embedding and classification
+        application (str): The chosen application
+
+    Returns:
+        dict: The workflow result, as returned by `run_workflow`
+    """
+    checkpoint = None
+    try:
+        checkpoint = WorkflowCheckpoint(workflow_id, {
+            "upload_id": upload_id, "model": model_name, "shards": len(shard_results),
+            "embedding_dtype": EMBEDDING_DTYPE.__name__,
+        })
+        if checkpoint.attempt > MAX_TASK_ATTEMPTS:
+            error = f"Merge of workflow {workflow_id} lost its worker {checkpoint.attempt - 1} times, giving up"
+            publish_failed(workflow_id, error)
+            raise RuntimeError(error)
+        return _finalize_sharded_workflow(
+            self, shard_results, workflow_id, upload_id, model_name, application, checkpoint
+        )
+    except WorkflowCancelled:
+        abort_cancelled(self, workflow_id)
+    finally:
+        # Not reached when the worker process is lost: the redelivered task needs the shard outputs
+        delete_shard_outputs(workflow_id, shard_results)
+        delete_embeddings(workflow_id)
+        release_job(workflow_id)
+        if checkpoint is not None:
+            checkpoint.clear()
+
+
+def _finalize_sharded_workflow(self, shard_results, workflow_id, upload_id, model_name, application, checkpoint):
+    """
+    Body of `finalize_sharded_workflow`. The stages completed by a previous delivery of the task are restored
+    from `checkpoint` instead of being run again.
+    """
+    shard_results = sorted(shard_results, key=lambda shard: shard["index"])
+    recorder = StageRecorder(model_name)
+    with recorder.span("load"):
+        data = load_h5ad_obs(upload_path(upload_id))
+    n_cells = data.n_obs
+    id2label = ModelRegistry().id2label
+    resumed = list(checkpoint.stages)
+    if resumed:
+        print(f"Resuming merge of workflow {workflow_id} (attempt {checkpoint.attempt}) after stages {', '.join(resumed)}")
+
+    self.update_state(state="PROGRESS", meta={"stage": "MERGING", "shards": len(shard_results)})
+    if checkpoint.get("merge"):
+        with recorder.span("restore", n_cells):
+            buffer = checkpoint.load("embeddings", embedding_path(workflow_id))
+            probs = checkpoint.load("probs")
+    else:
+        with recorder.span("merge", n_cells):
+            buffer, probs = merge_shards(workflow_id, shard_results, n_cells)
+        checkpoint.save("merge", {"embeddings": embedding_path(workflow_id), "probs": probs})
+    x_embedded = torch.from_numpy(buffer)
+    probs, pred_labels, confidence_scores = predictions_from_probs(probs)
+
+    self.update_state(state="PROGRESS", meta={"stage": "RUNNING STATS"})
+    with recorder.span("stats", n_cells):
+        # Merged from the statistics of the shards, without another pass over the predictions
+        prediction_stats = PredictionStats.from_dict(shard_results[0]["stats"])
+        for shard in shard_results[1:]:
+            prediction_stats.merge(PredictionStats.from_dict(shard["stats"]))
+        stats = prediction_stats.result(id2label)
+    check_cancelled(workflow_id)
+    # Partial result: the predictions and statistics are served while the UMAP is computed
+    publish_partial_result(
+        build_result(workflow_id, upload_id, model_name, application, stats, confidence_scores, id2label, None, status="partial"),
+        pred_labels, {}, recorder
+    )
+    self.update_state(state="PROGRESS", meta={"stage": "UMAP", "partial_result": True})
+    layout = checkpoint.get("umap")
+    if layout:
+        with recorder.span("restore", n_cells):
+            data.obsm["X_umap"] = checkpoint.load("umap")
+            data.uns["umap_layout"] = layout["layout"]
+            points = umap_points(data.obsm["X_umap"], pred_labels, confidence_scores, id2label)
+    else:
+        with recorder.span("umap", n_cells):
+            points = compute_umap(data, x_embedded, pred_labels, confidence_scores, id2label)
+        checkpoint.save("umap", {"umap": data.obsm["X_umap"]}, {"layout": data.uns.get("umap_layout")})
+    check_cancelled(workflow_id)
+    with recorder.span("export", n_cells):
+        save_annotated_data(data, probs.numpy(), pred_labels.numpy(), points, workflow_id)
+    with recorder.span("index", n_cells):
+        index_run(model_name, workflow_id, buffer, data.obs.index, pred_labels.numpy())
+        request_index_maintenance(model_name)
+
+    result = build_result(workflow_id, upload_id, model_name, application, stats, confidence_scores, id2label, points)
+    finalize_stages = recorder.as_list()
+    result["metadata"]["stages"] = [span for shard in shard_results for span in shard["stages"]] + finalize_stages
+    result["metadata"]["shards"] = len(shard_results)
+    result["metadata"]["umap"] = data.uns.get("umap_layout")
+    result["metadata"]["profiled"] = False
+    result["metadata"]["token_cache_hit"] = all(shard["token_cache_hit"] for shard in shard_results)
+    # The shards run in parallel: the run time of the workflow is that of the slowest shard plus the merge
+    slowest_shard = max(sum(span["wall_seconds"] for span in shard["stages"]) for shard in shard_results)
+    result["metadata"]["wall_seconds"] = slowest_shard + sum(span["wall_seconds"] for span in finalize_stages)
+    if resumed:
+        result["metadata"]["resumed"] = {"attempt": checkpoint.attempt, "stages": resumed}
+    else:
+        # The run time of a resumed merge misses its restored stages
+        record_throughput(model_name, n_cells, result["metadata"]["wall_seconds"])
+    with recorder.span("publish", n_cells):
+        redis_client.publish("workflow_results", json.dumps(result))
+    delete_upload_file(upload_id)
+    return result
+
+
+@celery_app.task(name="tasks.abort_sharded_workflow")
+def abort_sharded_workflow(workflow_id):
+    """
+    Error callback of the chord of a sharded workflow: removes the shard outputs and releases the job.
+    The workflow task itself is marked as failed by Celery; the workflow gets its "cancelled" result if it was
+    cancelled, its "failed" result otherwise.
+
+    Args:
+        workflow_id (str): ID of the sharded workflow
+    """
+    print(f"Sharded workflow {workflow_id} failed, cleaning up")
+    delete_embeddings(workflow_id)
+    release_job(workflow_id)
+    if is_cancelled(workflow_id):
+        publish_cancelled(workflow_id)
+    else:
+        publish_failed(workflow_id, "A shard of the workflow failed")
@@ -10,37 +10,61 @@ This module defines the core asynchronous task used to process a cell type annot
 - Running the embedding and classification models
 - Computing and summarizing prediction confidence and label distribution
 - Generating UMAP coordinates for visualization
-- Storing results and broadcasting them via Redis
+- Storing results and broadcasting them via Redis, with a partial result (status "partial", no UMAP) as soon as the cells are classified
 - Saving annotated data to CSV for download
 - Cleaning up temporary uploaded files
 
 The main Celery task `run_workflow` orchestrates this full process. It relies on the ModelRegistry to retrieve model components and is designed to support future extensions via the `application` parameter.
 
 Redis is used to publish real-time progress updates and final results, while intermediate progress is reported using `self.update_state` for frontend polling.
+The embeddings are moved into a memory-mapped buffer (`EMBEDDING_DIR`, dtype `HELICAL_EMBEDDING_DTYPE`) shared zero-copy by the
+classification, UMAP and export stages; the buffer is deleted when the task ends.
+Each stage is wrapped in a telemetry span (wall time, CPU time, peak RSS, cell count); the spans are stored in `metadata.stages` of the result and exported as Prometheus metrics.
+Large datasets are sharded (see `app.scheduling.plan_shards`): the task is then replaced by a chord of shard tasks
+merged by `tasks.finalize_sharded_workflow` (see `app.tasks.run_sharded_workflow`), which produces the same result.
+When submitted with `profile=True`, the task runs under `app.profiling.workflow_profiler` and the profile artifacts are saved in the results folder.
+The task is acknowledged late: when its worker process dies (OOM kill, restart), the job is delivered again and
+resumes after its last checkpointed stage (see `app.checkpoints`).
+Cancelled workflows (see `app.cancellation`) stop at the next stage or embedding batch: `abort_cancelled` cleans up and
+publishes the "cancelled" result.
 
 This file also defines helpers to load and delete uploaded files, and to store annotated results.
+The individual stages themselves live in `app.tasks.pipeline`.
 
 Dependencies:
 - scanpy for data loading and UMAP
-- torch and numpy for embedding and inference
 - redis for messaging
-- pandas for result export
+- app.tasks.pipeline for inference, statistics, UMAP and CSV export
 """
-import scanpy as sc
-import torch
-import numpy as np
-from datetime import datetime
-from collections import Counter
 import os
+import glob
 import json
 import redis
+import torch
+from celery import chord, group, states
+from celery.exceptions import Ignore
 from app.worker import celery_app
+from app.inspection import count_cells
+from app.artifacts import RESULTS_DIR, EMBEDDING_DIR
+from app.storage import get_storage
+from app.telemetry import StageRecorder
+from app.profiling import workflow_profiler, profile_artifact_path, PSTATS_SUFFIX, COLLAPSED_SUFFIX
+from app.scheduling import release_job, record_throughput, plan_shards, BULK_LANE
+from app.cancellation import WorkflowCancelled, check_cancelled, publish_cancelled, publish_failed
+from app.checkpoints import WorkflowCheckpoint, MAX_TASK_ATTEMPTS
+from app.tasks import pipeline
+from app.tasks.pipeline import (
+    classify_embeddings, classify_heads, predictions_from_probs, compute_umap, build_result, load_h5ad_sparse,
+    ensure_sparse, embed_cells, umap_points, EMBEDDING_DTYPES
+)
 from ml.model_registry import ModelRegistry
-import pandas as pd
+from ml import token_cache
+from ml.statistics import PredictionStats
+from ml.embedding_index import index_run
+from app.tasks.maintain_embedding_index import request_index_maintenance
 
 
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-UPLOAD_DIR = os.path.join(BASE_DIR, "..", "data", "tmp")
+EMBEDDING_DTYPE = EMBEDDING_DTYPES[os.getenv("HELICAL_EMBEDDING_DTYPE", "float32")]
 redis_client = redis.Redis(host="redis", port=6379, db=0)
 
 def publish_workflow_result(result):
@@ -52,8 +76,9 @@ def publish_workflow_result(result):
     """
     redis_client.publish("workflow_results", json.dumps(result))
 
-@celery_app.task(name="tasks.run_workflow", bind=True)
-def run_workflow(self, workflow_id, upload_id, model_name, application):
+@celery_app.task(name="tasks.run_workflow", bind=True, acks_late=True, reject_on_worker_lost=True)
+def run_workflow(self, workflow_id, upload_id, model_name, application, profile=False, dataset_hash=None, shard=None,
+                 thresholds=None, heads=None):
     """
     Celery task that processes a full cell type annotation workflow. This includes:
     - Loading the uploaded .h5ad file
@@ -68,14 +93,123 @@ def run_workflow(self, workflow_id, upload_id, model_name, application):
         upload_id (str): ID of the uploaded .h5ad file
         model_name (str): The model to use for embedding and classification
         application (str): The chosen application, e.g., "cell_type_annotation"
+        profile (bool): If True, the task runs under the profiler and the pstats and collapsed stack
+            artifacts are saved next to the results. Profiled workflows are never sharded.
+        dataset_hash (str): SHA-256 of the upload, used to reuse its cached preprocessed input (see ml.token_cache)
+        shard (bool | None): Split the cells in shards processed by several workers; by default, only
+            large datasets are sharded (see app.scheduling.plan_shards)
+        thresholds (dict | None): Confidence thresholds of the application (see ml.statistics.DEFAULT_THRESHOLDS)
+        heads (list | None): Additional classification heads run on the same embeddings as the cell type head
+            (see ml/parameters/heads.json). Workflows with additional heads are never sharded.
 
     Returns:
         dict: A JSON-serializable result dictionary containing predictions and statistics.
     """
+    replaced = False
+    checkpoint = None
+    try:
+        shards = [] if profile or heads else plan_shards(count_cells(upload_path(upload_id)), shard)
+        if len(shards) > 1:
+            # The shard and merge tasks take over the job, including its release
+            replaced = True
+            return dispatch_shards(self, workflow_id, upload_id, model_name, application, dataset_hash, shards, thresholds)
+        checkpoint = WorkflowCheckpoint(workflow_id, {
+            "upload_id": upload_id, "model": model_name, "thresholds": thresholds, "heads": heads,
+            "embedding_dtype": EMBEDDING_DTYPE.__name__,
+        })
+        if checkpoint.attempt > MAX_TASK_ATTEMPTS:
+            error = f"Workflow {workflow_id} lost its worker {checkpoint.attempt - 1} times, giving up"
+            publish_failed(workflow_id, error)
+            raise RuntimeError(error)
+        with workflow_profiler(profile, RESULTS_DIR, workflow_id):
+            result, recorder = _run_workflow(
+                self, workflow_id, upload_id, model_name, application, profile, dataset_hash, thresholds, heads,
+                checkpoint
+            )
+        if profile:
+            # Before publishing, so that /profile serves the artifacts as soon as the workflow is completed
+            store_profile_artifacts(workflow_id)
+        with recorder.span("publish", result["metadata"]["n_cells"]):
+            publish_workflow_result(result)
+        delete_upload_file(upload_id)
+        return result
+    except WorkflowCancelled:
+        abort_cancelled(self, workflow_id)
+    finally:
+        if not replaced:
+            delete_embeddings(workflow_id)
+            release_job(workflow_id)
+            if checkpoint is not None:
+                checkpoint.clear()
+
+def abort_cancelled(task, workflow_id):
+    """
+    Ends a task whose workflow was cancelled: publishes the "cancelled" result and marks the task as revoked.
+    The embedding buffer and the job are released by the caller; the upload is kept so that it can be resubmitted.
+
+    Raises:
+        Ignore: Always, so that Celery keeps the revoked state
+    """
+    for path in glob.glob(os.path.join(RESULTS_DIR, f"*{workflow_id}*")):
+        # Partial exports and profiles
+        os.remove(path)
+    publish_cancelled(workflow_id)
+    task.update_state(state=states.REVOKED, meta={"stage": "CANCELLED"})
+    raise Ignore()
+
+def dispatch_shards(task, workflow_id, upload_id, model_name, application, dataset_hash, shards, thresholds=None):
+    """
+    Replaces a workflow task by a chord: one `tasks.embed_shard` task per shard, run in parallel by any worker
+    consuming the lane of the workflow, followed by `tasks.finalize_sharded_workflow` which merges the shards.
+    The merge task inherits the task ID of the workflow, so its status and result are those of the workflow.
+
+    Args:
+        task: The Celery task instance being replaced
+        workflow_id (str): Unique ID for this workflow run
+        upload_id (str): ID of the uploaded .h5ad file
+        model_name (str): The model to use for embedding and classification
+        application (str): The chosen application
+        dataset_hash (str): SHA-256 of the upload
+        shards (list): (start, stop) cell ranges, from `plan_shards`
+        thresholds (dict | None): Confidence thresholds of the application
+    """
+    queue = (task.request.delivery_info or {}).get("routing_key") or BULK_LANE
+    header = group(
+        celery_app.signature(
+            "tasks.embed_shard",
+            args=[workflow_id, upload_id, model_name, index, start, stop],
+            kwargs={"dataset_hash": dataset_hash, "thresholds": thresholds},
+            queue=queue
+        )
+        for index, (start, stop) in enumerate(shards)
+    )
+    body = celery_app.signature(
+        "tasks.finalize_sharded_workflow",
+        args=[workflow_id, upload_id, model_name, application],
+        queue=queue
+    )
+    body.on_error(celery_app.signature("tasks.abort_sharded_workflow", args=[workflow_id], immutable=True, queue=queue))
+    print(f"Splitting workflow {workflow_id} in {len(shards)} shards on queue {queue}")
+    task.update_state(state="PROGRESS", meta={"stage": "EMBEDDING", "shards": len(shards)})
+    return task.replace(chord(header, body))
+
+def _run_workflow(self, workflow_id, upload_id, model_name, application, profile, dataset_hash, thresholds, heads,
+                  checkpoint):
+    """
+    Body of `run_workflow`, separated so that it can be wrapped by the profiler. The stages completed by a
+    previous delivery of the task are restored from `checkpoint` instead of being run again.
+
+    Returns:
+        tuple: (result, StageRecorder of the run); the caller publishes the result
+    """
 
-    global UPLOAD_DIR, redis_client
+    global redis_client
     
-    data = load_upload_file(upload_id)
+    recorder = StageRecorder(model_name)
+    with recorder.span("load"):
+        data = load_upload_file(upload_id)
+    n_cells = data.n_obs
+    recorder.observe_cells(n_cells)
     print(f"Loaded data for workflow {workflow_id} from {upload_id}.h5ad")
     model_registry = ModelRegistry()
     print(f"Model name: {model_name}")
@@ -83,115 +217,141 @@ def run_workflow(self, workflow_id, upload_id, model_name, application):
     embedding_model, classification_model = model_registry.get_model(model_name_lower)
     device = model_registry.get_device()
     id2label = model_registry.id2label
+    resumed = list(checkpoint.stages)
+    if resumed:
+        print(f"Resuming workflow {workflow_id} (attempt {checkpoint.attempt}) after stages {', '.join(resumed)}")
 
     self.update_state(state="PROGRESS", meta={"stage": "EMBEDDING"})
     
-    x_processed = embedding_model.process_data(data, gene_names="gene_name")
-    x_embedded = embedding_model.get_embeddings(x_processed)
-
-    if not isinstance(x_embedded, torch.Tensor):
-        x_embedded = torch.tensor(x_embedded, dtype=torch.float32).to(device)
+    check_cancelled(workflow_id)
+    embedded = checkpoint.get("embed")
+    if embedded:
+        with recorder.span("restore", n_cells):
+            x_embedded = checkpoint.load("embeddings", embedding_path(workflow_id))
+        token_cache_hit = embedded["token_cache_hit"]
+    else:
+        with recorder.span("process_data", n_cells):
+            x_processed, token_cache_hit = token_cache.get_or_process(embedding_model, data, model_name, dataset_hash)
+            ensure_sparse(data, "process_data")
+        with recorder.span("embed", n_cells):
+            x_embedded = embed_cells(
+                embedding_model, x_processed, embedding_path(workflow_id), EMBEDDING_DTYPE,
+                before_batch=lambda: check_cancelled(workflow_id)
+            )
+        del x_processed
+        checkpoint.save("embed", {"embeddings": embedding_path(workflow_id)}, {"token_cache_hit": token_cache_hit})
 
+    check_cancelled(workflow_id)
     self.update_state(state="PROGRESS", meta={"stage": "CLASSIFICATION"})
-    with torch.no_grad():
-        y_pred = classification_model(x_embedded)
-
-    probs = torch.nn.functional.softmax(y_pred, dim=1)
-    pred_labels = probs.argmax(dim=1)
-    confidence_scores = probs.max(dim=1).values
+    head_outputs = {}
+    if heads:
+        # The cell type head and the additional heads run fused, in one pass over the embeddings
+        head_bank, head_order, labels_by_head = model_registry.get_head_bank(model_name_lower, heads)
+        stats_by_head = {name: PredictionStats(len(labels_by_head[name]), thresholds) for name in head_order}
+        with recorder.span("classify", n_cells):
+            x_embedded, probs_by_head = classify_heads(head_bank, x_embedded, device, stats=stats_by_head)
+            probs, pred_labels, confidence_scores = predictions_from_probs(probs_by_head[head_order[0]])
+        prediction_stats = stats_by_head[head_order[0]]
+        head_outputs = {
+            name: (
+                probs_by_head[name].argmax(axis=1), probs_by_head[name].max(axis=1),
+                labels_by_head[name], stats_by_head[name]
+            )
+            for name in head_order[1:]
+        }
+    elif checkpoint.get("classify"):
+        with recorder.span("restore", n_cells):
+            x_embedded = torch.from_numpy(x_embedded)
+            probs, pred_labels, confidence_scores = predictions_from_probs(checkpoint.load("probs"))
+            prediction_stats = PredictionStats.from_dict(checkpoint.get("classify")["stats"])
+    else:
+        prediction_stats = PredictionStats(len(id2label), thresholds)
+        with recorder.span("classify", n_cells):
+            x_embedded, probs, pred_labels, confidence_scores = classify_embeddings(
+                classification_model, x_embedded, device, stats=prediction_stats
+            )
+        # The additional heads are not checkpointed, they run again from the embeddings
+        checkpoint.save("classify", {"probs": probs.numpy()}, {"stats": prediction_stats.to_dict()})
 
-    # Distribution
+    # Distribution, accumulated during the classification
     self.update_state(state="PROGRESS", meta={"stage": "RUNNING STATS"})
-    dist = Counter(pred_labels.cpu().numpy())
-    cell_type_distribution = {id2label[i]: int(dist.get(i, 0)) for i in range(len(id2label))}
-
-    # Summary
-    threshold = 0.5
-    num_cells_analysed = len(pred_labels)
-    num_cell_types = len(set(pred_labels.tolist()))
-    num_ambiguous = (confidence_scores < threshold).sum().item()
-    confidence_stats = {
-        "min": confidence_scores.min().item(),
-        "max": confidence_scores.max().item(),
-        "average": confidence_scores.mean().item()
-    }
-
-    high_confidence = int((confidence_scores > 0.8).sum().item())
-    medium_confidence = int(((confidence_scores > 0.6) & (confidence_scores <= 0.8)).sum().item())
-    low_confidence = int((confidence_scores <= 0.6).sum().item())
-    confidence_breakdown = {
-        "high": high_confidence,
-        "medium": medium_confidence,
-        "low": low_confidence
-    }
-
-    # Confidence histograms
-    bins = np.linspace(0, 1, 11)
-    confidence_histograms = {}
-    for i in range(len(id2label)):
-        mask = (pred_labels == i)
-        confs = confidence_scores[mask].cpu().numpy()
-        hist, _ = np.histogram(confs, bins=bins)
-        confidence_histograms[id2label[i]] = {
-            f"{int(bins[j]*100)}-{int(bins[j+1]*100)}": int(hist[j]) for j in range(len(hist))
+    with recorder.span("stats", n_cells):
+        stats = prediction_stats.result(id2label)
+        head_results = {
+            name: {**head_stats.result(head_id2label), "id_to_label": head_id2label}
+            for name, (_, _, head_id2label, head_stats) in head_outputs.items()
         }
 
-    # Average per class
-    confidence_averages = {}
-    for i in range(len(id2label)):
-        mask = (pred_labels == i)
-        if mask.sum() > 0:
-            confidence_averages[id2label[i]] = confidence_scores[mask].mean().item()
-        else:
-            confidence_averages[id2label[i]] = None
+    check_cancelled(workflow_id)
+    # Partial result: the predictions and statistics are served while the UMAP is computed
+    publish_partial_result(
+        build_result(workflow_id, upload_id, model_name, application, stats, confidence_scores, id2label, None, status="partial"),
+        pred_labels, head_results, recorder
+    )
+    self.update_state(state="PROGRESS", meta={"stage": "UMAP", "partial_result": True})
 
     # UMAP
-    data.obsm["X_embedded"] = x_embedded.cpu().numpy()
-    sc.pp.neighbors(data, use_rep="X_embedded")
-    sc.tl.umap(data)
-    umap_points = []
-    for i in range(data.n_obs):
-        umap_points.append({
-            "x": float(data.obsm["X_umap"][i, 0]),
-            "y": float(data.obsm["X_umap"][i, 1]),
-            "label": id2label[pred_labels[i].item()],
-            "confidence": float(confidence_scores[i].item())
-        })
+    layout = checkpoint.get("umap")
+    if layout:
+        with recorder.span("restore", n_cells):
+            data.obsm["X_umap"] = checkpoint.load("umap")
+            data.uns["umap_layout"] = layout["layout"]
+            points = umap_points(data.obsm["X_umap"], pred_labels, confidence_scores, id2label)
+    else:
+        with recorder.span("umap", n_cells):
+            points = compute_umap(data, x_embedded, pred_labels, confidence_scores, id2label)
+        checkpoint.save("umap", {"umap": data.obsm["X_umap"]}, {"layout": data.uns.get("umap_layout")})
+
+    check_cancelled(workflow_id)
+    with recorder.span("export", n_cells):
+        save_annotated_data(
+            data, probs.cpu().numpy(), pred_labels.cpu().numpy(), points, workflow_id,
+            {name: (labels, confidences) for name, (labels, confidences, _, _) in head_outputs.items()}
+        )
+    with recorder.span("index", n_cells):
+        index_run(model_name, workflow_id, x_embedded.numpy(), data.obs.index, pred_labels.numpy())
+        request_index_maintenance(model_name)
+
+    result = build_result(workflow_id, upload_id, model_name, application, stats, confidence_scores, id2label, points)
+    if head_results:
+        result["heads"] = head_results
+    # The publish span cannot be part of the published payload, it is only exported as a metric
+    result["metadata"]["stages"] = recorder.as_list()
+    result["metadata"]["profiled"] = bool(profile)
+    result["metadata"]["token_cache_hit"] = token_cache_hit
+    result["metadata"]["umap"] = data.uns.get("umap_layout")
+    result["metadata"]["wall_seconds"] = sum(span["wall_seconds"] for span in result["metadata"]["stages"])
+    if resumed:
+        result["metadata"]["resumed"] = {"attempt": checkpoint.attempt, "stages": resumed}
+    else:
+        # The run time of a resumed run misses its restored stages
+        record_throughput(model_name, n_cells, result["metadata"]["wall_seconds"])
+    return result, recorder
+
+def publish_partial_result(result, pred_labels, head_results, recorder):
+    """
+    Publishes the partial result of a workflow, available once the cells are classified.
 
-    result = {
-        "workflow_id": workflow_id,
-        "status": "completed",
-        "metadata": {
-            "model": model_name,
-            "application": application,
-            "input_file_name": f"{upload_id}.h5ad",
-            "created_at": datetime.utcnow().isoformat()
-        },
-        "summary": {
-            "num_cells_analysed": num_cells_analysed,
-            "num_cell_types": num_cell_types,
-            "num_ambiguous": num_ambiguous,
-            "confidence_stats": confidence_stats,
-            "confidence_breakdown": confidence_breakdown
-        },
-        "total_cells": num_cells_analysed,
-        "confidence_stats": confidence_stats,
-        "cell_type_distribution": cell_type_distribution,
-        "label_counts": {str(i): int(dist.get(i, 0)) for i in range(len(id2label))},
-        "confidence_histograms": confidence_histograms,
-        "confidence_averages": confidence_averages,
-        "confidence_scores": confidence_scores[:100].tolist(),
-        "id_to_label": id2label,
-        "umap": umap_points
-    }
-    save_annotated_data(data, probs.cpu().numpy(), pred_labels.cpu().numpy(), umap_points, workflow_id)
+    It has the statistics of the final result, the predicted class of each cell (`predicted_labels`, indexes into
+    `id_to_label`) and the stages run so far, but no UMAP points (`umap` is None). The listener stores it until the
+    final result replaces it.
+
+    Args:
+        result (dict): Output of `build_result` with `status="partial"`
+        pred_labels (Tensor): Predicted class index per cell
+        head_results (dict): Statistics of the additional heads
+        recorder (StageRecorder): Telemetry recorder of the workflow
+    """
+    result["predicted_labels"] = pred_labels.tolist()
+    if head_results:
+        result["heads"] = head_results
+    result["metadata"]["stages"] = recorder.as_list()
     redis_client.publish("workflow_results", json.dumps(result))
-    delete_upload_file(upload_id)
-    return result
-def save_annotated_data(data, probs, pred_labels, umap_points, workflow_id):
+    print(f"Published partial result of workflow {result['workflow_id']}")
+
+def save_annotated_data(data, probs, pred_labels, umap_points, workflow_id, head_predictions=None):
     """
-    Saves annotated data as CSV including cell ID, prediction probabilities,
-    predicted labels, and UMAP coordinates.
+    Saves annotated data as CSV in the results folder of the upload directory.
 
     Args:
         data (AnnData): The annotated scanpy data object
@@ -199,22 +359,63 @@ def save_annotated_data(data, probs, pred_labels, umap_points, workflow_id):
         pred_labels (ndarray): Predicted class labels
         umap_points (list): List of dictionaries with UMAP x, y, label, confidence
         workflow_id (str): ID for the workflow to name the output file
+        head_predictions (dict | None): Additional head name -> (predicted class labels, confidences)
     """
     
-    global UPLOAD_DIR
-    folder = os.path.join(UPLOAD_DIR, "results")
-    os.makedirs(folder, exist_ok=True)
-    
-    df = pd.DataFrame({
-        "cell_id": data.obs.index,
-        **{f"PROBA_{i}": probs[:, i] for i in range(probs.shape[1])},
-        "predicted_label": pred_labels.tolist(),
-        "umap_x": [p["x"] for p in umap_points],
-        "umap_y": [p["y"] for p in umap_points]
-    })
-    file_loc = os.path.join(folder, f"annotated_data_{workflow_id}.csv")
-    print(f"Saving annotated data to {file_loc}")
-    df.to_csv(file_loc, index=False)
+    file_loc = pipeline.save_annotated_data(data, probs, pred_labels, umap_points, workflow_id, RESULTS_DIR, head_predictions)
+    get_storage().put("results", os.path.basename(file_loc), file_loc)
+
+def store_profile_artifacts(workflow_id):
+    """
+    Hands the profile artifacts of a workflow over to the storage backend.
+
+    Args:
+        workflow_id (str): ID of the profiled workflow
+    """
+    for kind in (PSTATS_SUFFIX, COLLAPSED_SUFFIX):
+        path = profile_artifact_path(RESULTS_DIR, workflow_id, kind)
+        if os.path.exists(path):
+            get_storage().put("results", os.path.basename(path), path)
+
+def upload_path(upload_id):
+    """
+    Returns a local path of an uploaded .h5ad file. With a remote storage, the file is downloaded into the
+    read-through cache of the host.
+
+    Args:
+        upload_id (str): ID of the uploaded file
+
+    Returns:
+        str: Path of the file
+
+    Raises:
+        FileNotFoundError: If the upload does not exist
+    """
+    return get_storage().fetch("uploads", f"{upload_id}.h5ad")
+
+def embedding_path(workflow_id, model_name=None):
+    """
+    Returns the path of the memory-mapped embedding buffer of a workflow.
+
+    Args:
+        workflow_id (str): ID of the workflow
+        model_name (str): Model of the embeddings, for workflows running several models
+
+    Returns:
+        str: Path of the .npy buffer
+    """
+    suffix = f"_{model_name.lower()}" if model_name else ""
+    return os.path.join(EMBEDDING_DIR, f"{workflow_id}{suffix}.npy")
+
+def delete_embeddings(workflow_id):
+    """
+    Deletes the embedding buffers of a workflow.
+
+    Args:
+        workflow_id (str): ID of the workflow
+    """
+    for path in glob.glob(os.path.join(EMBEDDING_DIR, f"{workflow_id}*.npy")):
+        os.remove(path)
 
 def load_upload_file(upload_id):
     """
@@ -224,14 +425,14 @@ def load_upload_file(upload_id):
         upload_id (str): ID of the uploaded file
 
     Returns:
-        AnnData: The loaded single-cell data object
+        AnnData: The loaded single-cell data object, with `X` as a CSR matrix
     """
-    file_path = os.path.join(UPLOAD_DIR, f"{upload_id}.h5ad")
-    if os.path.exists(file_path):
-        print(f"Loading upload file: {file_path}")
-        return sc.read_h5ad(file_path)
-    else:
+    try:
+        file_path = upload_path(upload_id)
+    except FileNotFoundError:
         raise FileNotFoundError(f"Upload file with ID {upload_id} not found.")
+    print(f"Loading upload file: {file_path}")
+    return load_h5ad_sparse(file_path)
     
 def delete_upload_file(upload_id):
     """
@@ -240,9 +441,10 @@ def delete_upload_file(upload_id):
     Args:
         upload_id (str): ID of the uploaded file
     """
-    file_path = os.path.join(UPLOAD_DIR, f"{upload_id}.h5ad")
-    if os.path.exists(file_path):
-        os.remove(file_path)
-        print(f"Deleted upload file: {file_path}")
+    storage = get_storage()
+    name = f"{upload_id}.h5ad"
+    if storage.exists("uploads", name):
+        storage.delete("uploads", name)
+        print(f"Deleted upload file: {storage.uri('uploads', name)}")
     else:
-        print(f"File not found: {file_path}")
\ No newline at end of file
+        print(f"File not found: {storage.uri('uploads', name)}")
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""
+telemetry.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-02
+
+This module provides the observability primitives shared by the API and the Celery workers:
+
+- `StageRecorder`: wraps each stage of a workflow in a span recording wall time, CPU time,
+  peak RSS and number of cells. The spans are returned so they can be stored in the result metadata,
+  and are exported as Prometheus histograms.
+- API-side metrics: HTTP request latency and task queue depth.
+- `render_metrics`: renders all metrics in the Prometheus text format for the `/metrics` endpoint.
+
+Workers and the API run in different processes (and containers), so metrics are written with the
+Prometheus multiprocess mode when `PROMETHEUS_MULTIPROC_DIR` is set. The directory must be shared between
+the API and the workers (see docker-compose.yaml); the API then aggregates every process on scrape.
+The metric files are named after the PID of their process, and PIDs are only unique within a container: each
+container writes to its own subdirectory (named after its hostname, or `HELICAL_METRICS_INSTANCE`), which it
+clears on start (`clear_metrics_dir`) since the processes of its previous run are gone.
+"""
+import os
+import glob
+import socket
+import time
+import resource
+from contextlib import contextmanager
+
+# Shared directory, kept in the environment so that the subprocesses do not nest their own subdirectory
+METRICS_ROOT = os.environ.get("HELICAL_PROMETHEUS_ROOT") or os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+MULTIPROC_DIR = None
+if METRICS_ROOT:
+    MULTIPROC_DIR = os.path.join(METRICS_ROOT, os.getenv("HELICAL_METRICS_INSTANCE") or socket.gethostname())
+    os.environ["HELICAL_PROMETHEUS_ROOT"] = METRICS_ROOT
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = MULTIPROC_DIR
+    # prometheus_client reads the directory at import time and requires it to exist
+    os.makedirs(MULTIPROC_DIR, exist_ok=True)
+
+import redis
+from prometheus_client import Histogram, CollectorRegistry, generate_latest, CONTENT_TYPE_LATEST, REGISTRY
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from app.scheduling import LANES
+
+QUEUE_NAMES = LANES
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float("inf"))
+RSS_BUCKETS = tuple(2 ** i * 1024 ** 2 for i in range(6, 17)) + (float("inf"),)  # 64 MB .. 64 GB
+CELL_BUCKETS = (100, 1_000, 5_000, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, float("inf"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+STAGE_WALL_SECONDS = Histogram(
+    "helical_stage_wall_seconds", "Wall time of a workflow stage", ["stage", "model"], buckets=DURATION_BUCKETS
+)
+STAGE_CPU_SECONDS = Histogram(
+    "helical_stage_cpu_seconds", "CPU time of a workflow stage", ["stage", "model"], buckets=DURATION_BUCKETS
+)
+STAGE_PEAK_RSS_BYTES = Histogram(
+    "helical_stage_peak_rss_bytes", "Peak resident memory during a workflow stage", ["stage", "model"],
+    buckets=RSS_BUCKETS
+)
+WORKFLOW_CELLS = Histogram(
+    "helical_workflow_cells", "Number of cells processed by a workflow", ["model"], buckets=CELL_BUCKETS
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "helical_http_request_duration_seconds", "Latency of the API requests", ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS
+)
+
+_redis_client = None
+
+
+def _get_redis():
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis(host="redis", port=6379, db=0)
+    return _redis_client
+
+
+def _reset_peak_rss():
+    """
+    Resets the peak RSS (VmHWM) of the current process. Supported on Linux only.
+
+    Returns:
+        bool: Whether the peak was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_bytes():
+    """
+    Returns the peak RSS of the current process since the last reset (or since the process started).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageRecorder:
+    """
+    Records the spans of the stages of one workflow.
+
+    Usage:
+        recorder = StageRecorder(model_name)
+        with recorder.span("embed", n_cells=data.n_obs):
+            ...
+        result["metadata"]["stages"] = recorder.as_list()
+    """
+
+    def __init__(self, model_name, concurrent=False):
+        """
+        Args:
+            model_name (str): Model used by the workflow, used as a metric label
+            concurrent (bool): The stages run in a thread, concurrently with other stages of the same process.
+                The CPU time and the peak RSS are measured for the whole process, so they cannot be attributed to
+                the stage and are not recorded (None), and the peak RSS of the process is not reset.
+        """
+        self.model_name = model_name
+        self.concurrent = concurrent
+        self.spans = []
+
+    @contextmanager
+    def span(self, stage, n_cells=None):
+        """
+        Context manager measuring one stage.
+
+        Args:
+            stage (str): Name of the stage
+            n_cells (int | None): Number of cells processed by the stage
+        """
+        if not self.concurrent:
+            _reset_peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            span = {
+                "stage": stage,
+                "wall_seconds": round(time.perf_counter() - wall_start, 4),
+                "cpu_seconds": None if self.concurrent else round(time.process_time() - cpu_start, 4),
+                "peak_rss_bytes": None if self.concurrent else _peak_rss_bytes(),
+                "n_cells": n_cells,
+            }
+            self.spans.append(span)
+            STAGE_WALL_SECONDS.labels(stage, self.model_name).observe(span["wall_seconds"])
+            if not self.concurrent:
+                STAGE_CPU_SECONDS.labels(stage, self.model_name).observe(span["cpu_seconds"])
+                STAGE_PEAK_RSS_BYTES.labels(stage, self.model_name).observe(span["peak_rss_bytes"])
+
+    def observe_cells(self, n_cells):
+        """Records the number of cells processed by the workflow."""
+        WORKFLOW_CELLS.labels(self.model_name).observe(n_cells)
+
+    def as_list(self):
+        """Returns a copy of the recorded spans, in execution order."""
+        return [dict(span) for span in self.spans]
+
+
+def observe_request(method, route, status, seconds):
+    """
+    Records the latency of an API request.
+
+    Args:
+        method (str): HTTP method
+        route (str): Route template (e.g. "/status/{job_id}") to keep the label cardinality bounded
+        status (int): HTTP status code
+        seconds (float): Request duration
+    """
+    HTTP_REQUEST_SECONDS.labels(method, route, str(status)).observe(seconds)
+
+
+class QueueDepthCollector:
+    """
+    Collector reading the length of the Celery queues from Redis at scrape time.
+    """
+
+    def collect(self):
+        gauge = GaugeMetricFamily("helical_queue_depth", "Number of tasks waiting in the queue", labels=["queue"])
+        try:
+            client = _get_redis()
+            for queue in QUEUE_NAMES:
+                gauge.add_metric([queue], client.llen(queue))
+        except redis.RedisError as e:
+            print(f"Could not read queue depth: {e}")
+        yield gauge
+
+
+class ContainerMetricsCollector:
+    """
+    Collector merging the metric files of every process of every container (one subdirectory per container).
+    """
+
+    def collect(self):
+        files = glob.glob(os.path.join(METRICS_ROOT, "*", "*.db"))
+        return multiprocess.MultiProcessCollector.merge(files, accumulate=True)
+
+
+def render_metrics():
+    """
+    Renders the metrics of every process (API and workers) in the Prometheus text format.
+
+    Returns:
+        tuple: (payload bytes, content type)
+    """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        registry.register(ContainerMetricsCollector())
+    else:
+        registry = REGISTRY
+    queue_registry = CollectorRegistry()
+    queue_registry.register(QueueDepthCollector())
+    return generate_latest(registry) + generate_latest(queue_registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """Removes the live gauges of a terminated process from the multiprocess directory."""
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid, MULTIPROC_DIR)
+
+
+def clear_metrics_dir():
+    """
+    Removes the metric files left in the directory of the container by its previous run. Called once when the
+    container starts (API startup, main worker process), before its processes record anything.
+    """
+    if not MULTIPROC_DIR:
+        return
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, "*.db")):
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Could not remove metric file {path}: {e}")
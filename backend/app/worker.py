@@ -2,27 +2,122 @@
 Celery worker configuration for the Hellical application.
 
 This module sets up the Celery app, specifying Redis as the broker and result backend.
-It also ensures that the model registry is loaded when the Celery worker process starts.
+Jobs are routed to the `fast` and `bulk` queues by the submit endpoint (see app.scheduling).
+It also ensures that the model registry is loaded when the Celery worker process starts, after the process took its
+share of the CPUs of the worker (see app.cpu_topology).
+
+The API imports this module to submit tasks by name (`celery_app.send_task`) and to query their state, so it
+must not import the ML stack at module level: the model registry is only imported by the worker processes.
 """
 from celery import Celery
-from celery.signals import worker_process_init
-from ml.model_registry import ModelRegistry
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown, worker_ready, task_failure
+from billiard.exceptions import WorkerLostError
+from app import telemetry, cpu_topology
+from app.cancellation import publish_failed
+from ml.vocabularies import export_vocabularies
+from app.scheduling import BULK_LANE
+from app.admission import publish_worker_resources
+import os
+
+# Position of the workflow ID in the arguments of the tasks which end a workflow (see `publish_task_failure`).
+# The shards of a sharded workflow are not listed: their failure is handled by `tasks.abort_sharded_workflow`.
+WORKFLOW_ID_ARG = {
+    "tasks.run_workflow": 0,
+    "tasks.run_multi_model_workflow": 0,
+    "tasks.finalize_sharded_workflow": 1,
+}
 
 
 celery_app = Celery(
     "helical_tasks",
     broker="redis://redis:6379/0",
     backend="redis://redis:6379/0",
-    include=["app.tasks.run_workflow", "app.tasks.run_workflow_mock"]
+    include=[
+        "app.tasks.run_workflow", "app.tasks.run_multi_model_workflow", "app.tasks.run_sharded_workflow",
+        "app.tasks.run_workflow_mock", "app.tasks.maintain_embedding_index"
+    ]
+)
+celery_app.conf.update(
+    task_default_queue=BULK_LANE,
+    # Only reserve one task at a time, so that queued jobs can still be picked up by another lane's worker
+    worker_prefetch_multiplier=1,
+    # Running tasks leave the PENDING state at once, so that cancelling a workflow can tell them from queued ones
+    task_track_started=True,
+    # Late-acknowledged tasks (see app.checkpoints) are redelivered by Redis once unacknowledged for this long:
+    # it must exceed the longest run, or a running job would be delivered to a second worker
+    broker_transport_options={
+        "visibility_timeout": int(float(os.getenv("HELICAL_VISIBILITY_TIMEOUT_HOURS", "12")) * 3600)
+    },
 )
 
+@worker_init.connect
+def record_pool_size(sender=None, **kwargs):
+    """
+    Celery signal handler that runs in the main worker process, before the pool starts.
+
+    Records the number of child processes, between which the CPUs are partitioned, and clears the Prometheus
+    metric files of the previous run of the container.
+    """
+    cpu_topology.set_pool_size(getattr(sender, "concurrency", None))
+    telemetry.clear_metrics_dir()
+
+
 @worker_process_init.connect
 def load_models_on_startup(**kwargs):
     """
     Celery signal handler that runs when a worker process starts.
 
     Loads the model registry into memory, so that models are ready
-    for use when tasks are processed.
+    for use when tasks are processed. The thread pools of the process are sized to its share
+    of the CPUs before the models are loaded.
     """
+    cpu_topology.configure_worker_process()
+    from ml.model_registry import ModelRegistry
     registry = ModelRegistry()
-    # Optionally preload models or perform setup
\ No newline at end of file
+    # Share the gene vocabularies with the API, used to validate uploads
+    try:
+        export_vocabularies(registry.embedding_models)
+    except OSError as e:
+        print(f"Could not export vocabularies: {e}")
+
+
+@worker_ready.connect
+def start_resource_reporting(sender=None, **kwargs):
+    """
+    Celery signal handler that runs once the worker is ready.
+
+    Starts publishing the available memory of the worker host, used by the admission control of the API.
+    """
+    publish_worker_resources(sender.hostname if sender is not None else os.uname().nodename)
+
+
+@worker_process_shutdown.connect
+def cleanup_metrics_on_shutdown(pid=None, **kwargs):
+    """
+    Celery signal handler that runs when a worker process exits.
+
+    Removes the live Prometheus metrics of the process from the shared multiprocess directory.
+    """
+    telemetry.mark_process_dead(pid or os.getpid())
+
+
+@task_failure.connect
+def publish_task_failure(sender=None, task_id=None, exception=None, args=None, kwargs=None, **extra):
+    """
+    Celery signal handler that runs when a task raises.
+
+    Publishes the "failed" result of the workflow of a failed workflow task, so that the workflow and the workflows
+    attached to it do not stay pending forever and the failure is recorded in the run history. A task rejected
+    because its worker process was lost is delivered again (see app.checkpoints), so it does not end its workflow.
+    """
+    name = getattr(sender, "name", None)
+    if name not in WORKFLOW_ID_ARG:
+        return
+    if isinstance(exception, WorkerLostError) and getattr(sender, "reject_on_worker_lost", False):
+        return
+    args = list(args or [])
+    position = WORKFLOW_ID_ARG[name]
+    workflow_id = args[position] if len(args) > position else (kwargs or {}).get("workflow_id")
+    if workflow_id is None:
+        return
+    publish_failed(workflow_id, f"{type(exception).__name__}: {exception}")
@@ -0,0 +1,159 @@
+"""
+bench_api_startup.py
+
+Cold start benchmark of the FastAPI process.
+
+The API must start quickly and stay small so that replicas can be added under load: it submits tasks to the
+workers by name and must never import the ML stack. This benchmark measures, in fresh interpreters:
+- `import`: the time to import `app.main` and the resulting peak RSS, and which ML modules got imported
+- `uvicorn` (with `--uvicorn`): the time from launching `uvicorn app.main:app` to its first HTTP response,
+  and the RSS of the server process at that point
+
+The run exits with a non-zero status if one of the `FORBIDDEN_MODULES` was imported, or if the median import
+time or RSS exceeds `--max-import-seconds` / `--max-rss-mb`.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_api_startup --repeats 5
+    python -m benchmarks.bench_api_startup --uvicorn --output startup.json
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Top-level packages the API process must not import
+FORBIDDEN_MODULES = ["torch", "scanpy", "helical", "transformers", "anndata", "datasets", "umap", "sklearn"]
+
+# Run in a fresh interpreter, prints its measurements as JSON on the last line of stdout
+IMPORT_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import app.main
+elapsed = time.perf_counter() - start
+forbidden = {forbidden!r}
+print(json.dumps({{
+    "import_s": elapsed,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": len(sys.modules),
+    "forbidden_imported": sorted({{m.split(".")[0] for m in sys.modules}} & set(forbidden)),
+}}))
+"""
+
+
+def _rss_mb(pid):
+    """Returns the resident set size of a process in MB, read from /proc."""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_import():
+    """
+    Imports `app.main` in a fresh interpreter.
+
+    Returns:
+        dict: import_s, max_rss_mb, modules (number of imported modules) and forbidden_imported
+    """
+    out = subprocess.run(
+        [sys.executable, "-c", IMPORT_PROBE.format(forbidden=FORBIDDEN_MODULES)],
+        cwd=BASE_DIR, capture_output=True, text=True, check=True
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure_uvicorn(timeout=60.0):
+    """
+    Starts `uvicorn app.main:app` and waits for its first HTTP response.
+
+    Args:
+        timeout (float): Maximum time to wait for the server, in seconds
+
+    Returns:
+        dict: ready_s (time to the first response) and rss_mb (RSS of the server at that point)
+    """
+    port = _free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"uvicorn exited with status {server.returncode}")
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/openapi.json", timeout=1).read()
+                return {"ready_s": time.perf_counter() - start, "rss_mb": _rss_mb(server.pid)}
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError(f"uvicorn did not answer within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Cold start benchmark of the API process")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of cold starts")
+    parser.add_argument("--uvicorn", action="store_true", help="Also measure the time to the first HTTP response")
+    parser.add_argument("--max-import-seconds", type=float, default=None, help="Fail above this median import time")
+    parser.add_argument("--max-rss-mb", type=float, default=None, help="Fail above this median peak RSS")
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    imports = [measure_import() for _ in range(args.repeats)]
+    report = {
+        "python": sys.version.split()[0],
+        "import": {
+            "import_s": statistics.median(r["import_s"] for r in imports),
+            "max_rss_mb": statistics.median(r["max_rss_mb"] for r in imports),
+            "modules": imports[0]["modules"],
+            "forbidden_imported": imports[0]["forbidden_imported"],
+        },
+    }
+    if args.uvicorn:
+        starts = [measure_uvicorn() for _ in range(args.repeats)]
+        report["uvicorn"] = {
+            "ready_s": statistics.median(r["ready_s"] for r in starts),
+            "rss_mb": statistics.median(r["rss_mb"] for r in starts),
+        }
+
+    failures = []
+    if report["import"]["forbidden_imported"]:
+        failures.append(f"ML modules imported by the API: {', '.join(report['import']['forbidden_imported'])}")
+    if args.max_import_seconds is not None and report["import"]["import_s"] > args.max_import_seconds:
+        failures.append(f"import time {report['import']['import_s']:.2f}s > {args.max_import_seconds}s")
+    if args.max_rss_mb is not None and report["import"]["max_rss_mb"] > args.max_rss_mb:
+        failures.append(f"peak RSS {report['import']['max_rss_mb']:.0f} MB > {args.max_rss_mb} MB")
+    report["failures"] = failures
+    for failure in failures:
+        print(f"FAILED {failure}", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,368 @@
+"""
+bench_pipeline.py
+
+Stage-level benchmark of the cell type annotation pipeline.
+
+Runs the stages of `run_workflow` (load, process_data, embed, head, stats, neighbors/UMAP, CSV export,
+publish) on synthetic datasets of configurable size and records, for each stage, the wall time, the CPU
+time, the peak Python/NumPy allocation (tracemalloc) and the process RSS. The foundation model is
+replaced by the deterministic `StandInEmbedder`, so the benchmark runs offline on CPU.
+
+The report is written as JSON. Passing a previous report with `--baseline` compares the two runs and
+exits with a non-zero status when a stage regressed by more than `--tolerance`.
+
+The sparse data path is checked on the real loader and guard of `app.tasks.pipeline`: `load_h5ad_sparse` must
+load `X` as CSR without materializing it dense, and `ensure_sparse` must convert a matrix densified by a model's
+preprocessing back to CSR one block of rows at a time. The run also fails when the allocations made by one of the
+`SPARSE_STAGES` peak above `--max-dense-fraction` of the size of the dense matrix. `--dense-input` writes the
+synthetic dataset with a dense `X`, to check the chunked conversion on load.
+
+The preprocessing of the real models (helical's `process_data`) may densify the whole matrix while it runs; only
+sharding bounds that peak (see app.scheduling.plan_shards), and the `StandInEmbedder` is sparse by construction,
+so the `process_data` stage is not part of the check.
+
+Usage (from the backend directory):
+    python -m benchmarks.bench_pipeline --cells 1000 10000 --genes 2000 --output bench.json
+    python -m benchmarks.bench_pipeline --cells 10000 --baseline bench.json
+    python -m benchmarks.bench_pipeline --cells 50000 --genes 20000 --density 0.02 --dense-input --repeats 1
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import scanpy as sc
+import scipy.sparse as sp
+import torch
+import torch.nn as nn
+
+from app.tasks.pipeline import (
+    classify_embeddings, compute_statistics, compute_umap, build_result, save_annotated_data, load_h5ad_sparse,
+    ensure_sparse, embedding_buffer, EMBEDDING_DTYPES
+)
+from benchmarks.synthetic import make_synthetic_adata, StandInEmbedder
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_HEAD_WEIGHTS = os.path.join(BASE_DIR, "ml", "parameters", "head_model_geneformer.pth")
+ID2LABEL = {0: 'ERYTHROID', 1: 'LYMPHOID', 2: 'MK', 3: 'MYELOID', 4: 'PROGENITOR', 5: 'STROMA'}
+STAGES = ["load", "process_data", "restore_sparse", "embed", "head", "stats", "umap", "csv_export", "publish"]
+# Metrics compared against the baseline; lower is better for all of them.
+COMPARED_METRICS = ["wall_s", "py_peak_mb"]
+# Stages which must not materialize a dense copy of the expression matrix
+SPARSE_STAGES = ["load", "restore_sparse"]
+
+
+def _rss_mb():
+    """Returns the current resident set size of the process in MB."""
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+def _max_rss_mb():
+    """Returns the peak resident set size of the process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+@contextmanager
+def measure(stage, records):
+    """
+    Measures one stage and stores its metrics in `records[stage]`.
+
+    Args:
+        stage (str): Name of the stage
+        records (dict): Dictionary receiving the metrics
+    """
+    tracemalloc.reset_peak()
+    py_before, _ = tracemalloc.get_traced_memory()
+    rss_before = _rss_mb()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    yield
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    _, py_peak = tracemalloc.get_traced_memory()
+    records[stage] = {
+        "wall_s": wall,
+        "cpu_s": cpu,
+        "py_peak_mb": py_peak / 1e6,
+        # Allocated by the stage itself, on top of what it received
+        "py_growth_mb": (py_peak - py_before) / 1e6,
+        "rss_delta_mb": _rss_mb() - rss_before,
+        "max_rss_mb": _max_rss_mb(),
+    }
+
+
+def load_head(weights_path):
+    """
+    Builds the classification head used by the model registry and loads its weights.
+
+    Args:
+        weights_path (str | None): Path to a state dict; random weights are used when None
+
+    Returns:
+        nn.Module: Head in eval mode
+    """
+    torch.manual_seed(0)
+    head = nn.Sequential(
+        nn.Linear(512, 128),
+        nn.ReLU(),
+        nn.Dropout(0.4),
+        nn.Linear(128, 32),
+        nn.ReLU(),
+        nn.Dropout(0.4),
+        nn.Linear(32, len(ID2LABEL))
+    )
+    if weights_path:
+        head.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    head.eval()
+    return head
+
+
+def run_once(n_cells, n_genes, density, workdir, head, redis_url=None, dense_input=False, embedding_dtype="float32"):
+    """
+    Runs all the pipeline stages once on a freshly generated dataset.
+
+    Args:
+        n_cells (int): Number of cells
+        n_genes (int): Number of genes
+        density (float): Fraction of non-zero entries
+        workdir (str): Scratch directory for the .h5ad input and the CSV output
+        head (nn.Module): Classification head
+        redis_url (str | None): If set, the result is also published to this Redis instance
+        dense_input (bool): Write the dataset with a dense `X`
+        embedding_dtype (str): dtype of the memory-mapped embedding buffer
+
+    Returns:
+        dict: Metrics per stage
+    """
+    input_path = os.path.join(workdir, "input.h5ad")
+    adata = make_synthetic_adata(n_cells, n_genes, density=density)
+    if dense_input:
+        adata.X = adata.X.toarray()
+    adata.write_h5ad(input_path)
+    del adata
+    embedder = StandInEmbedder()
+    records = {}
+
+    tracemalloc.start()
+    try:
+        with measure("load", records):
+            data = load_h5ad_sparse(input_path)
+        with measure("process_data", records):
+            x_processed = embedder.process_data(data, gene_names="gene_name")
+        records["process_data"]["sparse"] = float(sp.issparse(data.X) and sp.issparse(x_processed))
+        # Stands for the preprocessing of a real model densifying data.X in place, outside of the measures
+        data.X = data.X.toarray()
+        with measure("restore_sparse", records):
+            ensure_sparse(data, "process_data")
+        records["restore_sparse"]["sparse"] = float(sp.isspmatrix_csr(data.X))
+        with measure("embed", records):
+            x_embedded = embedding_buffer(embedder.get_embeddings(x_processed), os.path.join(workdir, "embeddings.npy"),
+                                          EMBEDDING_DTYPES[embedding_dtype])
+        with measure("head", records):
+            x_embedded, probs, pred_labels, confidence_scores = classify_embeddings(head, x_embedded, "cpu")
+        with measure("stats", records):
+            stats = compute_statistics(pred_labels, confidence_scores, ID2LABEL)
+        with measure("umap", records):
+            umap_points = compute_umap(data, x_embedded, pred_labels, confidence_scores, ID2LABEL)
+        records["umap"]["neighbor_preservation"] = data.uns["umap_layout"]["neighbor_preservation"] or 0.0
+        with measure("csv_export", records):
+            save_annotated_data(data, probs.cpu().numpy(), pred_labels.cpu().numpy(), umap_points, "bench",
+                                os.path.join(workdir, "results"))
+        with measure("publish", records):
+            result = build_result("bench", "bench", "StandIn", 1, stats, confidence_scores, ID2LABEL, umap_points)
+            payload = json.dumps(result)
+            if redis_url:
+                import redis
+                redis.Redis.from_url(redis_url).publish("workflow_results_bench", payload)
+        records["publish"]["payload_mb"] = len(payload) / 1e6
+    finally:
+        tracemalloc.stop()
+    return records
+
+
+def summarize(runs):
+    """
+    Aggregates repeated runs of one configuration with the median of each metric.
+
+    Args:
+        runs (list): List of per-stage metric dictionaries
+
+    Returns:
+        dict: Median metrics per stage, plus the total wall time
+    """
+    stages = {}
+    for stage in runs[0]:
+        metrics = runs[0][stage].keys()
+        stages[stage] = {m: statistics.median(r[stage][m] for r in runs) for m in metrics}
+    return {
+        "stages": stages,
+        "total_wall_s": sum(s["wall_s"] for s in stages.values()),
+    }
+
+
+def compare(report, baseline, tolerance):
+    """
+    Compares a report against a baseline report.
+
+    Args:
+        report (dict): Current report
+        baseline (dict): Previous report
+        tolerance (float): Relative increase above which a metric is flagged (0.2 = 20%)
+
+    Returns:
+        list: Regressions, as dictionaries with the configuration, stage, metric and both values
+    """
+    regressions = []
+    previous = {r["config_id"]: r for r in baseline.get("results", [])}
+    for result in report["results"]:
+        base = previous.get(result["config_id"])
+        if base is None:
+            continue
+        for stage, metrics in result["stages"].items():
+            for metric in COMPARED_METRICS:
+                old = base["stages"].get(stage, {}).get(metric)
+                new = metrics.get(metric)
+                # Ignore noise on stages that are too short to be measured reliably
+                if old is None or new is None or old < 1e-3:
+                    continue
+                if new > old * (1 + tolerance):
+                    regressions.append({
+                        "config_id": result["config_id"],
+                        "stage": stage,
+                        "metric": metric,
+                        "baseline": old,
+                        "current": new,
+                        "change": new / old - 1,
+                    })
+    return regressions
+
+
+def check_sparse_memory(report, max_fraction):
+    """
+    Checks that the stages of `SPARSE_STAGES` did not materialize a dense copy of the expression matrix and
+    left it in CSR format.
+
+    Args:
+        report (dict): Current report
+        max_fraction (float): Maximum peak allocation growth of a stage, as a fraction of the dense matrix size
+
+    Returns:
+        list: Violations, as dictionaries with the configuration, stage, peak and limit
+    """
+    violations = []
+    for result in report["results"]:
+        limit = max_fraction * result["config"]["dense_x_mb"]
+        for stage in SPARSE_STAGES:
+            metrics = result["stages"].get(stage, {})
+            growth = metrics.get("py_growth_mb")
+            if (growth is not None and growth > limit) or metrics.get("sparse", 1.0) < 1.0:
+                violations.append({
+                    "config_id": result["config_id"],
+                    "stage": stage,
+                    "py_growth_mb": growth,
+                    "limit_mb": limit,
+                    "sparse": bool(metrics.get("sparse", 1.0)),
+                })
+    return violations
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Stage-level benchmark of the annotation pipeline")
+    parser.add_argument("--cells", type=int, nargs="+", default=[1000, 10000], help="Number of cells per dataset")
+    parser.add_argument("--genes", type=int, nargs="+", default=[2000], help="Number of genes per dataset")
+    parser.add_argument("--density", type=float, nargs="+", default=[0.05], help="Fraction of non-zero entries")
+    parser.add_argument("--repeats", type=int, default=3, help="Number of runs per configuration")
+    parser.add_argument("--head-weights", default=DEFAULT_HEAD_WEIGHTS,
+                        help="State dict of the classification head ('' for random weights)")
+    parser.add_argument("--redis-url", default=None, help="Also publish the result to this Redis instance")
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file (default: stdout)")
+    parser.add_argument("--baseline", default=None, help="Previous JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative regression threshold")
+    parser.add_argument("--embedding-dtype", choices=sorted(EMBEDDING_DTYPES), default="float32",
+                        help="dtype of the memory-mapped embedding buffer")
+    parser.add_argument("--dense-input", action="store_true", help="Write the synthetic datasets with a dense X")
+    parser.add_argument("--max-dense-fraction", type=float, default=0.5,
+                        help="Maximum peak allocation growth of the load/restore_sparse stages, as a fraction of the dense X size")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    torch.set_num_threads(max(1, torch.get_num_threads()))
+    head = load_head(args.head_weights or None)
+
+    report = {
+        "created_at": datetime.utcnow().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "torch": torch.__version__,
+            "numpy": np.__version__,
+            "scanpy": sc.__version__,
+            "torch_threads": torch.get_num_threads(),
+        },
+        "results": [],
+    }
+
+    workdir = tempfile.mkdtemp(prefix="helical_bench_")
+    try:
+        for n_cells in args.cells:
+            for n_genes in args.genes:
+                for density in args.density:
+                    config_id = f"cells={n_cells},genes={n_genes},density={density}"
+                    print(f"Benchmarking {config_id}", file=sys.stderr)
+                    runs = [run_once(n_cells, n_genes, density, workdir, head, args.redis_url, args.dense_input,
+                                     args.embedding_dtype)
+                            for _ in range(args.repeats)]
+                    report["results"].append({
+                        "config_id": config_id,
+                        "config": {"cells": n_cells, "genes": n_genes, "density": density,
+                                   "repeats": args.repeats, "dense_input": args.dense_input,
+                                   "embedding_dtype": args.embedding_dtype,
+                                   "dense_x_mb": n_cells * n_genes * 4 / 1e6},
+                        **summarize(runs),
+                    })
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    exit_code = 0
+    report["sparse_violations"] = check_sparse_memory(report, args.max_dense_fraction)
+    for v in report["sparse_violations"]:
+        print(f"DENSIFIED {v['config_id']} {v['stage']}: peak {v['py_growth_mb']:.1f} MB "
+              f"> {v['limit_mb']:.1f} MB (sparse output: {v['sparse']})", file=sys.stderr)
+    if report["sparse_violations"]:
+        exit_code = 1
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report["regressions"] = compare(report, baseline, args.tolerance)
+        for reg in report["regressions"]:
+            print(f"REGRESSION {reg['config_id']} {reg['stage']}.{reg['metric']}: "
+                  f"{reg['baseline']:.4f} -> {reg['current']:.4f} ({reg['change']:+.0%})", file=sys.stderr)
+        if report["regressions"]:
+            exit_code = 1
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+synthetic.py
+
+Synthetic inputs for the pipeline benchmarks.
+
+This module generates AnnData objects shaped like the user uploads (sparse counts with a `gene_name`
+column in `var`) and provides a deterministic stand-in for the foundation models, so that the benchmarks
+run offline on CPU without downloading Geneformer or scGPT weights.
+"""
+import numpy as np
+import scipy.sparse as sp
+import anndata as ad
+import pandas as pd
+
+
+def make_synthetic_adata(n_cells, n_genes, density=0.05, seed=0):
+    """
+    Generates a synthetic single-cell dataset.
+
+    Args:
+        n_cells (int): Number of cells (rows)
+        n_genes (int): Number of genes (columns)
+        density (float): Fraction of non-zero entries in the count matrix
+        seed (int): Seed of the random generator
+
+    Returns:
+        AnnData: Dataset with a CSR float32 count matrix and a `gene_name` column in `var`
+    """
+    rng = np.random.default_rng(seed)
+    nnz_per_row = max(1, int(round(n_genes * density)))
+
+    indptr = np.arange(0, (n_cells + 1) * nnz_per_row, nnz_per_row, dtype=np.int64)
+    indices = np.empty(n_cells * nnz_per_row, dtype=np.int32)
+    for i in range(n_cells):
+        indices[i * nnz_per_row:(i + 1) * nnz_per_row] = np.sort(
+            rng.choice(n_genes, size=nnz_per_row, replace=False)
+        )
+    counts = rng.negative_binomial(2, 0.3, size=n_cells * nnz_per_row).astype(np.float32) + 1
+    X = sp.csr_matrix((counts, indices, indptr), shape=(n_cells, n_genes))
+
+    obs = pd.DataFrame(index=[f"cell_{i}" for i in range(n_cells)])
+    var = pd.DataFrame(
+        {"gene_name": [f"GENE{j}" for j in range(n_genes)]},
+        index=[f"ENSG{j:011d}" for j in range(n_genes)],
+    )
+    return ad.AnnData(X=X, obs=obs, var=var)
+
+
+class StandInEmbedder:
+    """
+    Deterministic replacement for the Helical embedding models.
+
+    It mimics the `process_data` / `get_embeddings` interface: `process_data` normalizes and log-transforms
+    the counts (keeping them sparse), and `get_embeddings` projects them onto a fixed random basis.
+    """
+
+    def __init__(self, embedding_dim=512, seed=0, batch_size=4096):
+        """
+        Args:
+            embedding_dim (int): Dimensionality of the produced embeddings
+            seed (int): Seed of the random projection
+            batch_size (int): Number of cells projected at once
+        """
+        self.embedding_dim = embedding_dim
+        self.seed = seed
+        self.batch_size = batch_size
+
+    def process_data(self, data, gene_names="gene_name"):
+        """
+        Normalizes the counts of each cell to 1e4 and applies log1p.
+
+        Args:
+            data (AnnData): Input dataset
+            gene_names (str): Column of `var` holding the gene names
+
+        Returns:
+            csr_matrix: Normalized expression matrix
+        """
+        if gene_names not in data.var.columns:
+            raise ValueError(f"Column '{gene_names}' not found in data.var")
+        X = sp.csr_matrix(data.X, dtype=np.float32)
+        totals = np.asarray(X.sum(axis=1)).ravel()
+        totals[totals == 0] = 1.0
+        X = sp.diags(1e4 / totals).dot(X).tocsr()
+        X.data = np.log1p(X.data)
+        return X
+
+    def get_embeddings(self, x_processed):
+        """
+        Projects the processed matrix onto a fixed Gaussian basis.
+
+        Args:
+            x_processed (csr_matrix): Output of `process_data`
+
+        Returns:
+            ndarray: Embeddings of shape (n_cells, embedding_dim), float32
+        """
+        rng = np.random.default_rng(self.seed)
+        basis = rng.standard_normal((x_processed.shape[1], self.embedding_dim)).astype(np.float32)
+        basis /= np.sqrt(x_processed.shape[1])
+        out = np.empty((x_processed.shape[0], self.embedding_dim), dtype=np.float32)
+        for start in range(0, x_processed.shape[0], self.batch_size):
+            stop = start + self.batch_size
+            out[start:stop] = x_processed[start:stop] @ basis
+        return out
@@ -1,5 +1,5 @@
 # backend/db/init_db.py
-from sqlalchemy import create_engine, Column, Integer, String, Enum, ForeignKey, Float
+from sqlalchemy import create_engine, Column, Integer, String, Enum, ForeignKey, Float, inspect, text
 from sqlalchemy.orm import declarative_base, relationship
 from db.database import Base, engine
 from db.models import Base, Model, ModelAttribute, SpeedEnum, Application, ApplicationAttribute
@@ -12,11 +12,61 @@ Base.metadata.create_all(bind=engine)
 from sqlalchemy.orm import sessionmaker
 
 
+def migrate_run_history():
+    """
+    Drops the run history tables created by older versions of the schema (never written to, with an integer
+    workflow ID), so that `create_all` recreates them with their current columns and indexes.
+    """
+    inspector = inspect(engine)
+    if not inspector.has_table("run_history"):
+        return
+    if "n_cells" in {column["name"] for column in inspector.get_columns("run_history")}:
+        return
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS result_metadata"))
+        connection.execute(text("DROP TABLE run_history"))
+    print("Dropped the legacy run history tables")
+
+
+# Columns added to existing tables since their creation: `create_all` only creates the missing tables
+ADDED_COLUMNS = {
+    "workflows": ["upload_id", "task_id", "cache_key", "attached_to", "batch_id", "created_at"],
+    "applications": ["statistics_thresholds"],
+    "run_stages": ["shard"],
+}
+
+
+def migrate_added_columns():
+    """
+    Adds the columns (and their indexes) missing from the tables created by older versions of the schema.
+    The existing rows get NULL values, which every reader handles (e.g. no cache key: the workflow is never reused).
+    """
+    inspector = inspect(engine)
+    for table_name, column_names in ADDED_COLUMNS.items():
+        if not inspector.has_table(table_name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table_name)}
+        missing = [name for name in column_names if name not in existing]
+        if not missing:
+            continue
+        table = Base.metadata.tables[table_name]
+        with engine.begin() as connection:
+            for name in missing:
+                column_type = table.columns[name].type.compile(dialect=engine.dialect)
+                connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {name} {column_type}"))
+            for index in table.indexes:
+                if any(column.name in missing for column in index.columns):
+                    index.create(connection, checkfirst=True)
+        print(f"Added the columns {missing} to the {table_name} table")
+
+
 def init_database():
     SessionLocal = sessionmaker(bind=engine)
     db = SessionLocal()
     
+    migrate_run_history()
     Base.metadata.create_all(bind=engine)
+    migrate_added_columns()
 
     if not db.query(Model).first():
         geneformer = Model(name="Geneformer", speed=SpeedEnum.fast, recommended=1, accuracy=94, description="A transformer-based model for gene expression analysis.")
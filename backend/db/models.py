@@ -1,8 +1,9 @@
 # backend/db/models.py
 from sqlalchemy.orm import declarative_base
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Float, Enum, PrimaryKeyConstraint, JSON
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Float, Enum, PrimaryKeyConstraint, JSON, DateTime, Date, Index
 from sqlalchemy.orm import relationship
 from db.database import Base
+from datetime import datetime
 import enum
 
 
@@ -14,6 +15,49 @@ class Workflow(Base):
     model_id = Column(Integer, ForeignKey("models.id"), nullable=False)
     result = Column(JSON, nullable=True)  # Stores the result of the workflow
     status = Column(String)
+    upload_id = Column(String, ForeignKey("uploads.id"), nullable=True)
+    task_id = Column(String, nullable=True)  # Celery task ID
+    cache_key = Column(String, nullable=True, index=True)  # Hash of (upload content, model, application, pipeline version)
+    attached_to = Column(String, ForeignKey("workflows.id"), nullable=True, index=True)  # Workflow whose result is reused
+    batch_id = Column(String, ForeignKey("batches.id"), nullable=True, index=True)  # Batch submission, if any
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Batch(Base):
+    __tablename__ = "batches"
+    id = Column(String, primary_key=True)  # UUID as string
+    application_id = Column(Integer, ForeignKey("applications.id"), nullable=False)
+    size = Column(Integer, nullable=False)  # Number of workflows of the batch
+    group_id = Column(String, nullable=True)  # Celery group ID
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Upload(Base):
+    __tablename__ = "uploads"
+    id = Column(String, primary_key=True)  # UUID as string
+    filename = Column(String, nullable=True)  # Original file name
+    content_hash = Column(String, nullable=False, index=True)  # SHA-256 of the file content
+    size_bytes = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    dataset_info = relationship("DatasetInfo", back_populates="upload", uselist=False, cascade="all, delete-orphan")
+
+
+class DatasetInfo(Base):
+    __tablename__ = "dataset_info"
+    upload_id = Column(String, ForeignKey("uploads.id"), primary_key=True)
+    n_obs = Column(Integer, nullable=False, index=True)  # Number of cells
+    n_vars = Column(Integer, nullable=False)  # Number of genes
+    nnz = Column(Integer, nullable=True)  # Non-zero entries (None for dense matrices)
+    sparsity = Column(Float, nullable=True)  # Fraction of zeros
+    dtype = Column(String, nullable=True)
+    x_encoding = Column(String, nullable=True)  # e.g. csr_matrix, csc_matrix, dense
+    size_bytes = Column(Integer, nullable=False)
+    has_gene_name = Column(Boolean, nullable=False)
+    vocabulary_overlap = Column(JSON, nullable=True)  # Model name -> fraction of genes known by the model
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    upload = relationship("Upload", back_populates="dataset_info")
 
     
 # --- Table definitions ---
@@ -65,6 +109,7 @@ class Application(Base):
     time_estimation_min = Column(Integer, nullable=True)  # Estimated time in minutes
     time_estimation_max = Column(Integer, nullable=True)  # Estimated time in minutes
     is_new = Column(Boolean, default=True)  # Indicates if the application is new
+    statistics_thresholds = Column(JSON, nullable=True)  # Overrides of ml.statistics.DEFAULT_THRESHOLDS
     
     attributes = relationship("ApplicationAttribute", back_populates="application", cascade="all, delete-orphan")
     application_models = relationship(
@@ -92,27 +137,63 @@ class ApplicationAttribute(Base):
 class RunHistory(Base):
     __tablename__ = "run_history"
     id = Column(Integer, primary_key=True)
-    workflow_id = Column(Integer, ForeignKey("workflows.id"))
-    model_id = Column(Integer, ForeignKey("models.id"))
-    application_id = Column(Integer, ForeignKey("applications.id"))
-    timestamp = Column(String, nullable=False)
-    result_path = Column(String, nullable=True)  # Path to stored results
-    status = Column(String, nullable=False)  # e.g., 'success', 'failed'
+    workflow_id = Column(String, ForeignKey("workflows.id"), nullable=False, unique=True)  # One row per run
+    model_id = Column(Integer, ForeignKey("models.id"), nullable=False)
+    application_id = Column(Integer, ForeignKey("applications.id"), nullable=False)
+    timestamp = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)  # End of the run
+    result_path = Column(String, nullable=True)  # Name of the annotated CSV in the "results" storage
+    status = Column(String, nullable=False)  # e.g. 'completed', 'failed'
+    n_cells = Column(Integer, nullable=True)
+    wall_seconds = Column(Float, nullable=True)  # Processing time (slowest shard + merge for sharded runs)
+    latency_seconds = Column(Float, nullable=True)  # From submission to result, queueing included
     user_note = Column(String, nullable=True)
 
+    __table_args__ = (
+        Index("ix_run_history_model_timestamp", "model_id", "timestamp"),
+        Index("ix_run_history_application_timestamp", "application_id", "timestamp"),
+    )
+
     workflow = relationship("Workflow")
     model = relationship("Model")
     application = relationship("Application")
     run_info = relationship("ResultMetadata", back_populates="run", cascade="all, delete-orphan")
+    stages = relationship("RunStage", back_populates="run", cascade="all, delete-orphan")
     
 class ResultMetadata(Base):
     __tablename__ = "result_metadata"
     id = Column(Integer, primary_key=True)
-    run_id = Column(Integer, ForeignKey("run_history.id"))
+    run_id = Column(Integer, ForeignKey("run_history.id"), index=True)
     key = Column(String, nullable=False)
     value = Column(String, nullable=True)
 
     run = relationship("RunHistory", back_populates="run_info")
+
+
+class RunStage(Base):
+    __tablename__ = "run_stages"
+    id = Column(Integer, primary_key=True)
+    run_id = Column(Integer, ForeignKey("run_history.id"), nullable=False, index=True)
+    stage = Column(String, nullable=False)  # e.g. 'load', 'embed', 'classify'
+    shard = Column(Integer, nullable=True)  # Shard index, for the stages of sharded runs
+    wall_seconds = Column(Float, nullable=False)
+    cpu_seconds = Column(Float, nullable=True)
+    peak_rss_bytes = Column(Integer, nullable=True)
+    n_cells = Column(Integer, nullable=True)
+
+    run = relationship("RunHistory", back_populates="stages")
+
+
+class RunDailySummary(Base):
+    __tablename__ = "run_daily_summary"
+    day = Column(Date, nullable=False)
+    model_id = Column(Integer, ForeignKey("models.id"), nullable=False)
+    application_id = Column(Integer, ForeignKey("applications.id"), nullable=False)
+    status = Column(String, nullable=False)
+    runs = Column(Integer, nullable=False, default=0)
+    cells = Column(Integer, nullable=False, default=0)
+    wall_seconds = Column(Float, nullable=False, default=0.0)
+
+    __table_args__ = (PrimaryKeyConstraint("day", "model_id", "application_id", "status"),)
     
 class ApplicationModel(Base):
     __tablename__ = "application_models"
@@ -0,0 +1,487 @@
+# backend/ml/embedding_index.py
+"""
+Persistent store of the cell embeddings of past runs, with an IVF index for nearest neighbour search.
+
+One store per embedding model, in `EMBEDDING_INDEX_DIR/<model>/`:
+
+- `vectors.bin`: append-only matrix of the L2-normalized embeddings (float16), read through `np.memmap`
+- `rows.bin`: append-only records (run, cell index in the run, predicted label) of the same rows
+- `cells/<workflow_id>.npy`: cell IDs of each run, to look a cell up by its ID
+- `centroids.npy` and `lists/<i>.bin`: the IVF index, i.e. k-means centroids of the vectors and, per centroid,
+  the append-only list of the rows assigned to it
+- `meta.json`: dimension, committed row count, runs with their row offsets, number of lists, generation
+
+Runs are appended by the workers with `add_run`, under an exclusive file lock; `meta.json` is replaced atomically
+once the data is written, so that readers only see committed rows. Until `IVF_TRAIN_MIN_ROWS` rows are stored,
+queries scan every row; the index is then trained on a sample (spherical k-means) and new rows are assigned
+to their nearest centroid on insertion. A query scores the rows of the `nprobe` lists closest to the query
+vector, i.e. about `nprobe / nlist` of the store.
+
+The store holds at most `EMBEDDING_INDEX_MAX_ROWS` rows: `prune` drops the oldest runs, rewriting the remaining
+rows into the files of a new generation (`vectors.<generation>.bin`, ...), so that readers of the previous
+`meta.json` keep consistent files; those are removed by the next prune.
+
+Neither the training nor the pruning runs in the workflow which added the rows: `needs_maintenance` tells the
+caller to schedule them (see app.tasks.maintain_embedding_index). `rebuild` trains the index without holding the
+lock of the writers, which only wait for the final swap of the lists. Both can also be run by hand, e.g. after
+the store has grown by orders of magnitude:
+
+    python -m ml.embedding_index rebuild geneformer
+    python -m ml.embedding_index prune geneformer
+
+Similarity is the cosine similarity of the embeddings. This module only depends on NumPy.
+"""
+import fcntl
+import json
+import os
+import shutil
+import sys
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EMBEDDING_INDEX_DIR = os.getenv("HELICAL_EMBEDDING_INDEX_DIR", os.path.join(BASE_DIR, "data", "index"))
+EMBEDDING_INDEX_ENABLED = os.getenv("HELICAL_EMBEDDING_INDEX", "1") == "1"
+IVF_TRAIN_MIN_ROWS = int(os.getenv("HELICAL_IVF_TRAIN_MIN_ROWS", "50000"))
+IVF_NLIST = int(os.getenv("HELICAL_IVF_NLIST", "1024"))
+EMBEDDING_INDEX_MAX_ROWS = int(os.getenv("HELICAL_EMBEDDING_INDEX_MAX_ROWS", "5000000"))  # 0 = unlimited
+IVF_SAMPLE_ROWS = 100_000
+KMEANS_ITERATIONS = 10
+DEFAULT_NPROBE = 16
+APPEND_CHUNK_ROWS = 50_000
+STORE_DTYPE = np.float16
+ROW_DTYPE = np.dtype([("run", "<i4"), ("cell", "<i4"), ("label", "<i2")])
+LIST_DTYPE = np.dtype("<i8")
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex:
+    """
+    Embedding store and IVF index of one model.
+    """
+
+    def __init__(self, model_name, root=EMBEDDING_INDEX_DIR):
+        """
+        Args:
+            model_name (str): Name of the embedding model (case insensitive)
+            root (str): Directory of the stores of every model
+        """
+        self.model_name = model_name.lower()
+        self.dir = os.path.join(root, self.model_name)
+        self._centroids = None  # (mtime, centroids), cached by readers
+        self._cells = {}  # workflow ID -> cell IDs, cached by readers
+
+    def _path(self, *parts):
+        return os.path.join(self.dir, *parts)
+
+    def _data_path(self, meta, name, *parts):
+        """
+        Path of a data file ("vectors.bin", "rows.bin" or the "lists" directory) of the generation of `meta`.
+        The files of generation 0 have no suffix.
+        """
+        generation = meta.get("generation", 0)
+        if generation:
+            base, ext = os.path.splitext(name)
+            name = f"{base}.{generation}{ext}"
+        return self._path(name, *parts)
+
+    def meta(self):
+        """
+        Returns the committed state of the store.
+
+        Returns:
+            dict: dim, count (committed rows), runs (workflow_id, offset, n_cells) and nlist (0 without index)
+        """
+        try:
+            with open(self._path("meta.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"dim": None, "count": 0, "runs": [], "nlist": 0, "generation": 0}
+
+    def _write_meta(self, meta):
+        tmp_path = self._path(f"meta.json.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._path("meta.json"))
+
+    @contextmanager
+    def _lock(self):
+        os.makedirs(self._path("cells"), exist_ok=True)
+        with open(self._path(".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _vectors(self, meta):
+        if not meta["count"]:
+            return np.empty((0, meta["dim"] or 0), dtype=STORE_DTYPE)
+        return np.memmap(
+            self._data_path(meta, "vectors.bin"), dtype=STORE_DTYPE, mode="r", shape=(meta["count"], meta["dim"])
+        )
+
+    def _rows(self, meta):
+        if not meta["count"]:
+            return np.empty(0, dtype=ROW_DTYPE)
+        return np.memmap(self._data_path(meta, "rows.bin"), dtype=ROW_DTYPE, mode="r", shape=(meta["count"],))
+
+    def add_run(self, workflow_id, vectors, cell_ids, labels):
+        """
+        Appends the embeddings of a run. A run already in the store is not added again (redelivered tasks).
+
+        Args:
+            workflow_id (str): ID of the workflow
+            vectors (ndarray): Embeddings of shape (n_cells, dim), e.g. the memory-mapped embedding buffer
+            cell_ids (Sequence[str]): ID of each cell
+            labels (ndarray): Predicted class index of each cell
+
+        Returns:
+            int: Number of rows added
+        """
+        n_cells, dim = vectors.shape
+        labels = np.asarray(labels)
+        with self._lock():
+            meta = self.meta()
+            if any(run["workflow_id"] == workflow_id for run in meta["runs"]):
+                return 0
+            if meta["dim"] is None:
+                meta["dim"] = dim
+            elif meta["dim"] != dim:
+                raise ValueError(f"Embeddings of dimension {dim} cannot be added to a store of dimension {meta['dim']}")
+            offset = meta["count"]
+            run_index = len(meta["runs"])
+            centroids = np.load(self._path("centroids.npy")) if meta["nlist"] else None
+            lists_dir = self._data_path(meta, "lists")
+            os.makedirs(lists_dir, exist_ok=True)
+
+            # Discard what a crashed writer may have appended after the last committed row
+            for name, itemsize in (("vectors.bin", dim * np.dtype(STORE_DTYPE).itemsize), ("rows.bin", ROW_DTYPE.itemsize)):
+                with open(self._data_path(meta, name), "ab") as f:
+                    f.truncate(offset * itemsize)
+            with open(self._data_path(meta, "vectors.bin"), "ab") as vector_file, \
+                    open(self._data_path(meta, "rows.bin"), "ab") as row_file:
+                for start in range(0, n_cells, APPEND_CHUNK_ROWS):
+                    stop = min(start + APPEND_CHUNK_ROWS, n_cells)
+                    chunk = _normalize(vectors[start:stop])
+                    vector_file.write(chunk.astype(STORE_DTYPE).tobytes())
+                    rows = np.empty(stop - start, dtype=ROW_DTYPE)
+                    rows["run"] = run_index
+                    rows["cell"] = np.arange(start, stop)
+                    rows["label"] = labels[start:stop]
+                    row_file.write(rows.tobytes())
+                    if centroids is not None:
+                        self._append_to_lists(lists_dir, offset + start, self._assign(chunk, centroids))
+            np.save(self._path("cells", f"{workflow_id}.npy"), np.asarray(cell_ids, dtype=str))
+
+            meta["count"] = offset + n_cells
+            meta["runs"].append({"workflow_id": workflow_id, "offset": offset, "n_cells": n_cells})
+            self._write_meta(meta)
+        return n_cells
+
+    def needs_training(self, meta=None):
+        """Returns whether the store is large enough to be indexed but has no index yet."""
+        meta = meta or self.meta()
+        return not meta["nlist"] and meta["count"] >= IVF_TRAIN_MIN_ROWS
+
+    def needs_maintenance(self, max_rows=EMBEDDING_INDEX_MAX_ROWS):
+        """Returns whether the index has to be trained or the store pruned (see `rebuild` and `prune`)."""
+        meta = self.meta()
+        return self.needs_training(meta) or bool(max_rows and meta["count"] > max_rows)
+
+    @staticmethod
+    def _assign(vectors, centroids):
+        """Returns the nearest centroid of each (normalized) vector."""
+        return np.argmax(vectors @ centroids.T, axis=1)
+
+    def _append_to_lists(self, lists_dir, first_row, assignment):
+        order = np.argsort(assignment, kind="stable")
+        lists, starts = np.unique(assignment[order], return_index=True)
+        for list_id, rows in zip(lists, np.split(order, starts[1:])):
+            with open(os.path.join(lists_dir, f"{list_id}.bin"), "ab") as f:
+                f.write((first_row + rows).astype(LIST_DTYPE).tobytes())
+
+    def _assign_rows(self, vectors, centroids, lists_dir, start, stop):
+        """Appends the rows [start, stop) of the store to the lists of their nearest centroid."""
+        for first in range(start, stop, APPEND_CHUNK_ROWS):
+            chunk = vectors[first:min(first + APPEND_CHUNK_ROWS, stop)].astype(np.float32)
+            self._append_to_lists(lists_dir, first, self._assign(chunk, centroids))
+
+    def _kmeans(self, vectors, nlist, seed):
+        """Trains IVF centroids on a sample of the vectors with spherical k-means."""
+        count = len(vectors)
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(count, size=min(count, IVF_SAMPLE_ROWS), replace=False))
+        sample = vectors[sample].astype(np.float32)
+        # About 40 training vectors per list at least
+        nlist = max(1, min(nlist, len(sample) // 40))
+        print(f"Training the IVF index of {self.model_name}: {nlist} lists on {len(sample)} of {count} rows")
+
+        centroids = sample[rng.choice(len(sample), size=nlist, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.concatenate([
+                self._assign(sample[start:start + APPEND_CHUNK_ROWS], centroids)
+                for start in range(0, len(sample), APPEND_CHUNK_ROWS)
+            ])
+            counts = np.bincount(assignment, minlength=nlist)
+            empty = counts == 0
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.zeros_like(centroids)
+            sums[~empty] = np.add.reduceat(sample[np.argsort(assignment, kind="stable")], starts[~empty], axis=0)
+            # Empty lists are reseeded with random vectors of the sample
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()), replace=False)]
+            centroids = _normalize(sums)
+        return centroids
+
+    def rebuild(self, nlist=IVF_NLIST, seed=0):
+        """
+        Trains the IVF index on the current content of the store, and assigns every row.
+
+        The k-means and the assignment of the committed rows run without the lock, on a snapshot of the store;
+        the writers only wait for the assignment of the rows they appended meanwhile and the swap of the lists.
+
+        Returns:
+            bool: Whether the index was replaced (not if the store was empty or pruned meanwhile)
+        """
+        snapshot = self.meta()
+        if not snapshot["count"]:
+            return False
+        vectors = self._vectors(snapshot)
+        centroids = self._kmeans(vectors, nlist, seed)
+        lists_dir = self._data_path(snapshot, "lists")
+        build_dir = f"{lists_dir}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(build_dir)
+        try:
+            self._assign_rows(vectors, centroids, build_dir, 0, snapshot["count"])
+            with self._lock():
+                meta = self.meta()
+                if meta.get("generation", 0) != snapshot.get("generation", 0):
+                    print(f"The {self.model_name} store was pruned during the training, dropping the new index")
+                    return False
+                self._assign_rows(self._vectors(meta), centroids, build_dir, snapshot["count"], meta["count"])
+                old_dir = f"{lists_dir}.{uuid.uuid4().hex}.old"
+                if os.path.exists(lists_dir):
+                    os.rename(lists_dir, old_dir)
+                os.rename(build_dir, lists_dir)
+                tmp_path = self._path(f"centroids.{uuid.uuid4().hex}.tmp.npy")
+                np.save(tmp_path, centroids)
+                os.replace(tmp_path, self._path("centroids.npy"))
+                meta["nlist"] = len(centroids)
+                self._write_meta(meta)
+                shutil.rmtree(old_dir, ignore_errors=True)
+            return True
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    def _remove_generation(self, generation, workflow_ids):
+        """Removes the data files of a previous generation and the cell IDs of the runs it dropped."""
+        old = {"generation": generation}
+        for name in ("vectors.bin", "rows.bin"):
+            if os.path.exists(self._data_path(old, name)):
+                os.remove(self._data_path(old, name))
+        shutil.rmtree(self._data_path(old, "lists"), ignore_errors=True)
+        for workflow_id in workflow_ids:
+            if os.path.exists(self._path("cells", f"{workflow_id}.npy")):
+                os.remove(self._path("cells", f"{workflow_id}.npy"))
+
+    def prune(self, max_rows=EMBEDDING_INDEX_MAX_ROWS):
+        """
+        Drops the oldest runs until the store holds at most `max_rows` rows (the latest run is always kept).
+
+        The remaining rows are copied, and assigned to the current centroids, into the files of a new generation;
+        the files of the previous generation are kept for the readers of the previous `meta.json` and removed by
+        the next prune. Runs under the lock, but only copies the rows (no training).
+
+        Returns:
+            int: Number of rows dropped
+        """
+        if not max_rows:
+            return 0
+        with self._lock():
+            meta = self.meta()
+            runs = meta["runs"]
+            n_dropped, remaining = 0, meta["count"]
+            while n_dropped < len(runs) - 1 and remaining > max_rows:
+                remaining -= runs[n_dropped]["n_cells"]
+                n_dropped += 1
+            if not n_dropped:
+                return 0
+            first = runs[n_dropped]["offset"]
+            pruned = {
+                **meta,
+                "count": meta["count"] - first,
+                "runs": [{**run, "offset": run["offset"] - first} for run in runs[n_dropped:]],
+                "generation": meta.get("generation", 0) + 1,
+            }
+            vectors, rows = self._vectors(meta), self._rows(meta)
+            centroids = np.load(self._path("centroids.npy")) if meta["nlist"] else None
+            lists_dir = self._data_path(pruned, "lists")
+            shutil.rmtree(lists_dir, ignore_errors=True)  # Left by a crashed prune
+            os.makedirs(lists_dir)
+            with open(self._data_path(pruned, "vectors.bin"), "wb") as vector_file, \
+                    open(self._data_path(pruned, "rows.bin"), "wb") as row_file:
+                for start in range(first, meta["count"], APPEND_CHUNK_ROWS):
+                    stop = min(start + APPEND_CHUNK_ROWS, meta["count"])
+                    chunk = np.asarray(vectors[start:stop])
+                    vector_file.write(chunk.tobytes())
+                    chunk_rows = np.array(rows[start:stop])
+                    chunk_rows["run"] -= n_dropped
+                    row_file.write(chunk_rows.tobytes())
+                    if centroids is not None:
+                        self._append_to_lists(lists_dir, start - first, self._assign(chunk.astype(np.float32), centroids))
+
+            retired = meta.get("retired")
+            pruned["retired"] = {
+                "generation": meta.get("generation", 0),
+                "runs": [run["workflow_id"] for run in runs[:n_dropped]],
+            }
+            self._write_meta(pruned)
+            if retired:
+                self._remove_generation(retired["generation"], retired["runs"])
+        print(f"Dropped {n_dropped} runs ({first} rows) from the {self.model_name} store")
+        return first
+
+    def _load_centroids(self):
+        path = self._path("centroids.npy")
+        mtime = os.stat(path).st_mtime
+        if self._centroids is None or self._centroids[0] != mtime:
+            self._centroids = (mtime, np.load(path))
+        return self._centroids[1]
+
+    def _run_cells(self, workflow_id):
+        if workflow_id not in self._cells:
+            self._cells[workflow_id] = np.load(self._path("cells", f"{workflow_id}.npy"), mmap_mode="r")
+        return self._cells[workflow_id]
+
+    def vector(self, workflow_id, cell_id):
+        """
+        Returns the stored (normalized) embedding of a cell.
+
+        Raises:
+            KeyError: If the run or the cell is not in the store
+        """
+        meta = self.meta()
+        run = next((run for run in meta["runs"] if run["workflow_id"] == workflow_id), None)
+        if run is None:
+            raise KeyError(f"Workflow {workflow_id} is not in the {self.model_name} index")
+        matches = np.flatnonzero(self._run_cells(workflow_id) == cell_id)
+        if not len(matches):
+            raise KeyError(f"Cell {cell_id} not found in workflow {workflow_id}")
+        return self._vectors(meta)[run["offset"] + int(matches[0])].astype(np.float32)
+
+    def search(self, query, k=10, nprobe=DEFAULT_NPROBE, exclude_workflow=None):
+        """
+        Finds the k stored cells most similar to a vector.
+
+        Args:
+            query (array-like): Query embedding of shape (dim,)
+            k (int): Number of neighbours
+            nprobe (int): Number of IVF lists scanned (ignored before the index is trained)
+            exclude_workflow (str | None): Leave out the cells of this run
+
+        Returns:
+            list: Neighbours as dictionaries (workflow_id, cell_id, label, score), most similar first
+        """
+        meta = self.meta()
+        if not meta["count"]:
+            return []
+        query = _normalize(query).ravel()
+        if query.shape[0] != meta["dim"]:
+            raise ValueError(f"Query of dimension {query.shape[0]}, expected {meta['dim']}")
+        vectors = self._vectors(meta)
+        rows = self._rows(meta)
+        exclude_run = next((i for i, run in enumerate(meta["runs"]) if run["workflow_id"] == exclude_workflow), None)
+
+        if meta["nlist"]:
+            centroids = self._load_centroids()
+            probe = np.argsort(centroids @ query)[::-1][:nprobe]
+            candidates = [
+                np.fromfile(path, dtype=LIST_DTYPE)
+                for path in (self._data_path(meta, "lists", f"{list_id}.bin") for list_id in probe)
+                if os.path.exists(path)
+            ]
+            candidates = np.concatenate(candidates) if candidates else np.empty(0, dtype=LIST_DTYPE)
+            candidates = np.sort(candidates[candidates < meta["count"]])  # Sorted reads of the memory map
+        else:
+            candidates = np.arange(meta["count"])
+        if exclude_run is not None:
+            candidates = candidates[rows["run"][candidates] != exclude_run]
+
+        best_rows, best_scores = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        for start in range(0, len(candidates), APPEND_CHUNK_ROWS):
+            chunk = candidates[start:start + APPEND_CHUNK_ROWS]
+            scores = vectors[chunk].astype(np.float32) @ query
+            best_rows = np.concatenate([best_rows, chunk])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_rows) > k:
+                top = np.argpartition(-best_scores, k)[:k]
+                best_rows, best_scores = best_rows[top], best_scores[top]
+        order = np.argsort(-best_scores)
+
+        neighbours = []
+        for row, score in zip(best_rows[order], best_scores[order]):
+            record = rows[row]
+            run = meta["runs"][int(record["run"])]
+            neighbours.append({
+                "workflow_id": run["workflow_id"],
+                "cell_id": str(self._run_cells(run["workflow_id"])[int(record["cell"])]),
+                "label": int(record["label"]),
+                "score": float(score),
+            })
+        return neighbours
+
+    def size_bytes(self):
+        """Returns the disk usage of the store."""
+        total = 0
+        for root, _, files in os.walk(self.dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+
+_indexes = {}
+
+
+def get_index(model_name):
+    """
+    Returns the store of a model, shared within the process (readers cache the centroids and cell IDs).
+    """
+    key = model_name.lower()
+    if key not in _indexes:
+        _indexes[key] = EmbeddingIndex(key)
+    return _indexes[key]
+
+
+def index_run(model_name, workflow_id, vectors, cell_ids, labels):
+    """
+    Adds the embeddings of a finished run to the store of its model, unless the store is disabled with
+    `HELICAL_EMBEDDING_INDEX=0`. Failures are logged and never fail the workflow.
+
+    Returns:
+        int: Number of rows added
+    """
+    if not EMBEDDING_INDEX_ENABLED:
+        return 0
+    try:
+        added = get_index(model_name).add_run(workflow_id, vectors, cell_ids, labels)
+        print(f"Indexed {added} cells of workflow {workflow_id} for {model_name}")
+        return added
+    except Exception as e:
+        print(f"Could not index the embeddings of workflow {workflow_id}: {e}")
+        return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] not in ("rebuild", "prune"):
+        sys.exit("Usage: python -m ml.embedding_index rebuild|prune <model>")
+    getattr(get_index(sys.argv[2]), sys.argv[1])()
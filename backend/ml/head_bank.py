@@ -0,0 +1,135 @@
+# backend/ml/head_bank.py
+"""
+Bank of classification heads sharing one embedding pass.
+
+Each task (cell type, finer cell types, disease state, QC, ...) has its own MLP head on the embeddings of a
+model (see ml.head_config). Instead of running the heads one after the other, `HeadBank` fuses them:
+
+- the first linear layers of all the heads are concatenated into a single `nn.Linear`, so the embeddings are
+  read once per batch by one (input_dim x sum of the first hidden sizes) matrix multiplication
+- the output is split per head and goes through the remaining (small) layers of each head
+
+The embeddings are therefore computed once and reused by every requested head, and the cost of an additional
+head is that of its own weights. `HeadRegistry` loads the heads of the configuration and caches one fused bank
+per (model, heads) combination.
+"""
+import os
+
+import torch
+import torch.nn as nn
+
+from ml.head_config import load_head_config, PARAMETERS_DIR
+
+
+def build_head(input_dim, hidden_dims, num_classes, dropout=0.4):
+    """
+    Builds the MLP of a classification head: (Linear, ReLU, Dropout) per hidden layer, then the output Linear.
+    The layer indexes match the state dicts of the trained heads in ml/parameters.
+
+    Args:
+        input_dim (int): Dimension of the embeddings
+        hidden_dims (list): Sizes of the hidden layers (at least one)
+        num_classes (int): Number of classes
+        dropout (float): Dropout probability (inactive in evaluation mode)
+
+    Returns:
+        nn.Sequential: The head
+    """
+    layers = []
+    for dim in hidden_dims:
+        layers += [nn.Linear(input_dim, dim), nn.ReLU(), nn.Dropout(dropout)]
+        input_dim = dim
+    layers.append(nn.Linear(input_dim, num_classes))
+    return nn.Sequential(*layers)
+
+
+class HeadBank(nn.Module):
+    """
+    Several classification heads fused into one forward pass over the same embeddings.
+    """
+
+    def __init__(self, heads):
+        """
+        Args:
+            heads (dict): Head name -> nn.Sequential starting with an nn.Linear over the same input dimension
+        """
+        super().__init__()
+        self.names = list(heads)
+        firsts = [heads[name][0] for name in self.names]
+        if len({first.in_features for first in firsts}) != 1:
+            raise ValueError("The heads of a bank must have the same input dimension")
+        self.split_sizes = [first.out_features for first in firsts]
+        self.fused = nn.Linear(firsts[0].in_features, sum(self.split_sizes))
+        with torch.no_grad():
+            self.fused.weight.copy_(torch.cat([first.weight for first in firsts]))
+            self.fused.bias.copy_(torch.cat([first.bias for first in firsts]))
+        self.tails = nn.ModuleDict({name: heads[name][1:] for name in self.names})
+
+    def forward(self, x):
+        """
+        Args:
+            x (torch.Tensor): Embeddings of shape (batch_size, input_dim)
+
+        Returns:
+            dict: Head name -> logits of shape (batch_size, num_classes of the head)
+        """
+        hidden = self.fused(x).split(self.split_sizes, dim=1)
+        return {name: self.tails[name](h) for name, h in zip(self.names, hidden)}
+
+
+class HeadRegistry:
+    """
+    Loads the classification heads of the configuration, and builds the fused banks.
+    """
+
+    def __init__(self, input_dim, device, config=None, parameters_dir=PARAMETERS_DIR):
+        """
+        Args:
+            input_dim (int): Dimension of the embeddings of every model
+            device (str): Device of the heads
+            config (dict | None): Head configuration, defaults to `load_head_config()`
+            parameters_dir (str): Directory of the weight files
+        """
+        self.device = device
+        self.config = config if config is not None else load_head_config()
+        self.heads = {}
+        self.banks = {}
+        for model_name, heads in self.config.items():
+            for head_name, spec in heads.items():
+                weights = os.path.join(parameters_dir, spec["weights"])
+                if not os.path.exists(weights):
+                    raise FileNotFoundError(f"State dict file of head {model_name}/{head_name} not found: {weights}")
+                head = build_head(spec.get("input_dim", input_dim), spec["hidden_dims"], len(spec["labels"]))
+                head.load_state_dict(torch.load(weights, map_location=device))
+                head.to(device)
+                head.eval()
+                self.heads[(model_name, head_name)] = head
+
+    def get_head(self, model_name, head_name):
+        """Returns one head of a model, as a standalone module."""
+        return self.heads[(model_name.lower(), head_name)]
+
+    def get_bank(self, model_name, head_names):
+        """
+        Returns the fused bank of some heads of a model, built on first use.
+
+        Args:
+            model_name (str): Name of the embedding model
+            head_names (list): Heads of the bank, in output order
+
+        Returns:
+            HeadBank: The bank, in evaluation mode on the device of the registry
+
+        Raises:
+            KeyError: If a head is not configured for the model
+        """
+        key = (model_name.lower(), tuple(head_names))
+        if key not in self.banks:
+            missing = [name for name in head_names if (key[0], name) not in self.heads]
+            if missing:
+                raise KeyError(f"Unknown heads for model {model_name}: {', '.join(missing)}")
+            bank = HeadBank({name: self.heads[(key[0], name)] for name in head_names})
+            bank.to(self.device)
+            bank.eval()
+            self.banks[key] = bank
+        return self.banks[key]
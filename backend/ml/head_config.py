@@ -0,0 +1,80 @@
+# backend/ml/head_config.py
+"""
+Configuration of the classification heads of each embedding model.
+
+Heads are declared in `ml/parameters/heads.json` (or the file of `HELICAL_HEADS_CONFIG`), per embedding model:
+
+    {
+      "geneformer": {
+        "cell_type": {
+          "weights": "head_model_geneformer.pth",   # state dict, relative to ml/parameters
+          "hidden_dims": [128, 32],                 # hidden layers of the MLP
+          "labels": ["ERYTHROID", "LYMPHOID", ...], # class index -> label
+          "default": true                           # head of the cell type annotation
+        },
+        "disease_state": {...}
+      }
+    }
+
+Adding a task only needs its trained head and an entry here: every head of a model runs on the same embeddings
+(see ml.head_bank). This module only reads JSON, so the API can validate the requested heads without the ML stack.
+"""
+import json
+import os
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PARAMETERS_DIR = os.path.join(BASE_DIR, "ml", "parameters")
+HEADS_CONFIG = os.getenv("HELICAL_HEADS_CONFIG", os.path.join(PARAMETERS_DIR, "heads.json"))
+
+_config = None
+
+
+def load_head_config():
+    """
+    Loads the head configuration of `HEADS_CONFIG`, once per process.
+
+    Returns:
+        dict: Model name (lower case) -> head name -> head specification
+
+    Raises:
+        ValueError: If a model does not have exactly one default head
+    """
+    global _config
+    if _config is None:
+        with open(HEADS_CONFIG) as f:
+            config = {model.lower(): heads for model, heads in json.load(f).items()}
+        for model, heads in config.items():
+            defaults = [name for name, spec in heads.items() if spec.get("default")]
+            if len(defaults) != 1:
+                raise ValueError(f"Model {model} must have exactly one default head, found {len(defaults)}")
+        _config = config
+    return _config
+
+
+def head_names(model_name):
+    """
+    Returns the heads of an embedding model, the default head first.
+
+    Args:
+        model_name (str): Name of the embedding model (case insensitive)
+
+    Returns:
+        list: Head names, empty for an unknown model
+    """
+    heads = load_head_config().get(model_name.lower(), {})
+    return sorted(heads, key=lambda name: not heads[name].get("default"))
+
+
+def default_head(model_name):
+    """Returns the name of the default (cell type) head of an embedding model."""
+    return head_names(model_name)[0]
+
+
+def head_labels(model_name, head):
+    """
+    Returns the label map of a head.
+
+    Returns:
+        dict: Class index -> label name
+    """
+    return dict(enumerate(load_head_config()[model_name.lower()][head]["labels"]))
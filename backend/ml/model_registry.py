@@ -4,8 +4,9 @@ from transformers import AutoModel, AutoTokenizer
 from helical.models.scgpt import scGPT, scGPTConfig
 from helical.models.geneformer import Geneformer, GeneformerConfig
 import torch
-import torch.nn as nn
 import os
+from ml.head_bank import HeadRegistry
+from ml.head_config import default_head, head_labels, head_names
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 models_dir = os.path.join(BASE_DIR, "ml", "parameters")
@@ -28,22 +29,15 @@ class ModelRegistry:
         self.input_shape = 512
         self.num_classes = 6
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.params_head_scgpt = os.path.join(models_dir, "head_model_scgpt.pth")
-        self.params_head_geneformer = os.path.join(models_dir, "head_model_geneformer.pth")
 
         self.embedding_models = {}
-        self.classification_models = {}
+        self.classification_models = {}  # Model name -> default (cell type) head
         
         self._load_models()
         
-        self.id2label= {0: 'ERYTHROID',
-        1: 'LYMPHOID',
-        2: 'MK',
-        3: 'MYELOID',
-        4: 'PROGENITOR',
-        5: 'STROMA'}
-        
-        self.num_classes = 6
+        # Label map of the default heads, which all annotate the same cell types (see ml/parameters/heads.json)
+        self.id2label = head_labels("geneformer", default_head("geneformer"))
+        self.num_classes = len(self.id2label)
         
         print("✅ Models loaded successfully----------.")
         
@@ -57,21 +51,9 @@ class ModelRegistry:
         geneformer = Geneformer(configurer = geneformer_config)
         self.embedding_models["geneformer"] = geneformer
 
-        scgpt_classification_head = self._get_head_model()
-        scgpt_classification_head.load_state_dict(torch.load(self.params_head_scgpt))
-        scgpt_classification_head.to(self.device)
-        scgpt_classification_head.eval()
-        self.classification_models["scgpt"] = scgpt_classification_head
-        
-        geneformer_classification_head = self._get_head_model()
-        geneformer_classification_head.load_state_dict(torch.load(self.params_head_geneformer))
-        #Check if the state_dict file exists at "../ml/parameters/head_model_geneformer.pth"
-        if not os.path.exists(self.params_head_geneformer):
-            raise FileNotFoundError("State dict file not found.")
-
-        geneformer_classification_head.to(self.device)
-        geneformer_classification_head.eval()
-        self.classification_models["geneformer"] = geneformer_classification_head
+        self.heads = HeadRegistry(self.input_shape, self.device)
+        for name in self.embedding_models:
+            self.classification_models[name] = self.heads.get_head(name, default_head(name))
 
     def get_model(self, name):
         return (self.embedding_models.get(name), self.classification_models.get(name))
@@ -81,17 +63,23 @@ class ModelRegistry:
     
     def get_label(self, id):
         return self.id2label.get(id, "Unknown")
-    
-    def _get_head_model(self):
-        return nn.Sequential(
-            nn.Linear(self.input_shape, 128),
-            nn.ReLU(),
-            nn.Dropout(0.4),
-            nn.Linear(128, 32),
-        nn.ReLU(),
-        nn.Dropout(0.4),
-        nn.Linear(32, self.num_classes)
-        )
+
+    def get_head_bank(self, name, heads):
+        """
+        Returns the fused bank running the default head of a model and the given additional heads.
+
+        Args:
+            name (str): Name of the embedding model
+            heads (list): Additional heads (see ml/parameters/heads.json)
+
+        Returns:
+            tuple: (HeadBank, head names in output order, head name -> id2label)
+        """
+        names = list(dict.fromkeys([default_head(name), *heads]))
+        return self.heads.get_bank(name, names), names, {head: head_labels(name, head) for head in names}
+
+    def list_heads(self, name):
+        return head_names(name)
 
     
     
\ No newline at end of file
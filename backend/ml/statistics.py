@@ -0,0 +1,279 @@
+# backend/ml/statistics.py
+"""
+Streaming, mergeable statistics of the predictions of a classification head.
+
+`PredictionStats` accumulates, one batch of cells at a time, everything the workflow summary needs:
+label distribution, confidence min/max/mean, confidence breakdown and ambiguous cells, per-class confidence
+histograms and means, confidence quantiles and prediction entropy. Every update is a handful of vectorized
+`np.bincount` calls over the batch, so the statistics of any number of cells fit in a few small arrays:
+
+- per class: cell count, confidence sum, entropy sum and a `HISTOGRAM_BINS` confidence histogram
+- globally: a `QUANTILE_RESOLUTION` confidence histogram, from which the quantiles are interpolated
+  (within 1 / QUANTILE_RESOLUTION of the exact value)
+
+Accumulators of different batches or shards are combined with `merge`, and travel between workers as plain
+JSON with `to_dict` / `from_dict`. The merged statistics are exactly those of a single pass, except for the
+floating point rounding of the sums.
+
+The confidence thresholds (ambiguous cells, high/medium/low breakdown) default to `DEFAULT_THRESHOLDS` and can be
+overridden per application (see `Application.statistics_thresholds`).
+"""
+import math
+
+import numpy as np
+
+DEFAULT_THRESHOLDS = {
+    "ambiguous": 0.5,  # Cells below this confidence are ambiguous
+    "medium": 0.6,  # Cells above this confidence (and up to "high") have a medium confidence, the others low
+    "high": 0.8,  # Cells above this confidence have a high confidence
+}
+HISTOGRAM_BINS = 10
+QUANTILE_RESOLUTION = 1000
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def resolve_thresholds(thresholds=None):
+    """
+    Completes the threshold overrides of an application with the defaults, and checks them.
+
+    Args:
+        thresholds (dict | None): Overrides of `DEFAULT_THRESHOLDS`
+
+    Returns:
+        dict: The thresholds
+
+    Raises:
+        ValueError: If a threshold is unknown, or the thresholds are not ordered within [0, 1]
+    """
+    thresholds = dict(thresholds or {})
+    unknown = set(thresholds) - set(DEFAULT_THRESHOLDS)
+    if unknown:
+        raise ValueError(f"Unknown statistics thresholds: {', '.join(sorted(unknown))}")
+    thresholds = {**DEFAULT_THRESHOLDS, **{key: float(value) for key, value in thresholds.items()}}
+    if not 0.0 <= thresholds["medium"] <= thresholds["high"] <= 1.0 or not 0.0 <= thresholds["ambiguous"] <= 1.0:
+        raise ValueError(f"Invalid statistics thresholds: {thresholds}")
+    return thresholds
+
+
+class PredictionStats:
+    """
+    Accumulator of the statistics of the predictions of one model.
+    """
+
+    def __init__(self, n_classes, thresholds=None):
+        """
+        Args:
+            n_classes (int): Number of classes of the classification head
+            thresholds (dict | None): Overrides of `DEFAULT_THRESHOLDS`
+        """
+        self.n_classes = n_classes
+        self.thresholds = resolve_thresholds(thresholds)
+        self.counts = np.zeros(n_classes, dtype=np.int64)
+        self.confidence_sums = np.zeros(n_classes, dtype=np.float64)
+        self.entropy_sums = np.zeros(n_classes, dtype=np.float64)
+        self.entropy_cells = 0  # Cells whose entropy is known (updates with probabilities)
+        self.histograms = np.zeros((n_classes, HISTOGRAM_BINS), dtype=np.int64)
+        self.quantile_histogram = np.zeros(QUANTILE_RESOLUTION, dtype=np.int64)
+        self.breakdown = np.zeros(3, dtype=np.int64)  # low, medium, high
+        self.n_ambiguous = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    @property
+    def n_cells(self):
+        return int(self.counts.sum())
+
+    def update(self, pred_labels, confidence_scores, probs=None):
+        """
+        Adds a batch of predictions.
+
+        Args:
+            pred_labels (array-like): Predicted class index per cell
+            confidence_scores (array-like): Confidence (max probability) per cell
+            probs (array-like | None): Probabilities of shape (n_cells, n_classes), for the entropy
+
+        Returns:
+            PredictionStats: self
+        """
+        labels = np.asarray(pred_labels, dtype=np.int64).ravel()
+        confidences = np.asarray(confidence_scores, dtype=np.float64).ravel()
+        if not len(labels):
+            return self
+        n = self.n_classes
+
+        self.counts += np.bincount(labels, minlength=n)
+        self.confidence_sums += np.bincount(labels, weights=confidences, minlength=n)
+        bins = _bin_index(confidences, HISTOGRAM_BINS)
+        self.histograms += np.bincount(labels * HISTOGRAM_BINS + bins, minlength=n * HISTOGRAM_BINS).reshape(n, HISTOGRAM_BINS)
+        self.quantile_histogram += np.bincount(_bin_index(confidences, QUANTILE_RESOLUTION), minlength=QUANTILE_RESOLUTION)
+
+        levels = (confidences > self.thresholds["medium"]).astype(np.int64) + (confidences > self.thresholds["high"])
+        self.breakdown += np.bincount(levels, minlength=3)
+        self.n_ambiguous += int(np.count_nonzero(confidences < self.thresholds["ambiguous"]))
+        self.min = min(self.min, float(confidences.min()))
+        self.max = max(self.max, float(confidences.max()))
+
+        if probs is not None:
+            probs = np.asarray(probs, dtype=np.float32)
+            entropy = -np.sum(probs * np.log(np.clip(probs, 1e-12, None)), axis=1)
+            self.entropy_sums += np.bincount(labels, weights=entropy, minlength=n)
+            self.entropy_cells += len(labels)
+        return self
+
+    def update_probs(self, probs):
+        """
+        Adds a batch of class probabilities of shape (n_cells, n_classes).
+
+        Returns:
+            PredictionStats: self
+        """
+        probs = np.asarray(probs)
+        return self.update(probs.argmax(axis=1), probs.max(axis=1), probs)
+
+    def merge(self, other):
+        """
+        Adds the statistics of another accumulator (e.g. of another shard) with the same classes and thresholds.
+
+        Returns:
+            PredictionStats: self
+        """
+        if other.n_classes != self.n_classes or other.thresholds != self.thresholds:
+            raise ValueError("Cannot merge statistics with different classes or thresholds")
+        self.counts += other.counts
+        self.confidence_sums += other.confidence_sums
+        self.entropy_sums += other.entropy_sums
+        self.entropy_cells += other.entropy_cells
+        self.histograms += other.histograms
+        self.quantile_histogram += other.quantile_histogram
+        self.breakdown += other.breakdown
+        self.n_ambiguous += other.n_ambiguous
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantiles(self, qs=QUANTILES):
+        """
+        Interpolates confidence quantiles from the fine histogram.
+
+        Args:
+            qs (Iterable[float]): Quantiles in [0, 1]
+
+        Returns:
+            dict: Quantile (as a string, e.g. "0.5") -> confidence, or None without cells
+        """
+        total = self.quantile_histogram.sum()
+        if not total:
+            return {str(q): None for q in qs}
+        cumulative = np.cumsum(self.quantile_histogram)
+        values = {}
+        for q in qs:
+            target = q * total
+            index = int(np.searchsorted(cumulative, target, side="left"))
+            index = min(index, QUANTILE_RESOLUTION - 1)
+            below = cumulative[index - 1] if index else 0
+            fraction = (target - below) / self.quantile_histogram[index] if self.quantile_histogram[index] else 0.0
+            value = (index + fraction) / QUANTILE_RESOLUTION
+            values[str(q)] = float(min(max(value, self.min), self.max))
+        return values
+
+    def result(self, id2label):
+        """
+        Builds the statistics of the workflow result.
+
+        Args:
+            id2label (dict): Mapping from class index to label name
+
+        Returns:
+            dict: Statistics with the keys used in the workflow result (summary, distribution, histograms, ...)
+        """
+        n_cells = self.n_cells
+        confidence_stats = {
+            "min": self.min if n_cells else None,
+            "max": self.max if n_cells else None,
+            "average": float(self.confidence_sums.sum() / n_cells) if n_cells else None,
+        }
+        confidence_breakdown = {
+            "high": int(self.breakdown[2]),
+            "medium": int(self.breakdown[1]),
+            "low": int(self.breakdown[0]),
+        }
+        edges = [int(round(100 * j / HISTOGRAM_BINS)) for j in range(HISTOGRAM_BINS + 1)]
+        labels = [id2label[i] for i in range(self.n_classes)]
+        entropy = None
+        if self.entropy_cells:
+            mean_entropy = float(self.entropy_sums.sum() / self.entropy_cells)
+            entropy = {
+                "mean": mean_entropy,
+                "normalized_mean": mean_entropy / math.log(self.n_classes) if self.n_classes > 1 else 0.0,
+                "per_class": {
+                    labels[i]: float(self.entropy_sums[i] / self.counts[i]) if self.counts[i] else None
+                    for i in range(self.n_classes)
+                },
+            }
+
+        return {
+            "summary": {
+                "num_cells_analysed": n_cells,
+                "num_cell_types": int(np.count_nonzero(self.counts)),
+                "num_ambiguous": self.n_ambiguous,
+                "confidence_stats": confidence_stats,
+                "confidence_breakdown": confidence_breakdown,
+                "confidence_quantiles": self.quantiles(),
+                "entropy": entropy,
+                "thresholds": self.thresholds,
+            },
+            "total_cells": n_cells,
+            "confidence_stats": confidence_stats,
+            "cell_type_distribution": {labels[i]: int(self.counts[i]) for i in range(self.n_classes)},
+            "label_counts": {str(i): int(self.counts[i]) for i in range(self.n_classes)},
+            "confidence_histograms": {
+                labels[i]: {f"{edges[j]}-{edges[j + 1]}": int(self.histograms[i, j]) for j in range(HISTOGRAM_BINS)}
+                for i in range(self.n_classes)
+            },
+            "confidence_averages": {
+                labels[i]: float(self.confidence_sums[i] / self.counts[i]) if self.counts[i] else None
+                for i in range(self.n_classes)
+            },
+        }
+
+    def to_dict(self):
+        """Returns the state of the accumulator as a JSON-serializable dictionary."""
+        return {
+            "n_classes": self.n_classes,
+            "thresholds": self.thresholds,
+            "counts": self.counts.tolist(),
+            "confidence_sums": self.confidence_sums.tolist(),
+            "entropy_sums": self.entropy_sums.tolist(),
+            "entropy_cells": self.entropy_cells,
+            "histograms": self.histograms.tolist(),
+            "quantile_histogram": self.quantile_histogram.tolist(),
+            "breakdown": self.breakdown.tolist(),
+            "n_ambiguous": self.n_ambiguous,
+            "min": self.min if math.isfinite(self.min) else None,
+            "max": self.max if math.isfinite(self.max) else None,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """Rebuilds an accumulator from the output of `to_dict`."""
+        stats = cls(state["n_classes"], state["thresholds"])
+        stats.counts = np.asarray(state["counts"], dtype=np.int64)
+        stats.confidence_sums = np.asarray(state["confidence_sums"], dtype=np.float64)
+        stats.entropy_sums = np.asarray(state["entropy_sums"], dtype=np.float64)
+        stats.entropy_cells = state["entropy_cells"]
+        stats.histograms = np.asarray(state["histograms"], dtype=np.int64).reshape(stats.n_classes, HISTOGRAM_BINS)
+        stats.quantile_histogram = np.asarray(state["quantile_histogram"], dtype=np.int64)
+        stats.breakdown = np.asarray(state["breakdown"], dtype=np.int64)
+        stats.n_ambiguous = state["n_ambiguous"]
+        stats.min = state["min"] if state["min"] is not None else math.inf
+        stats.max = state["max"] if state["max"] is not None else -math.inf
+        return stats
+
+
+def _bin_index(confidences, n_bins):
+    """
+    Index of the bin of each confidence among `n_bins` equal bins of [0, 1], the last bin including 1
+    (the convention of `np.histogram`).
+    """
+    edges = np.linspace(0.0, 1.0, n_bins + 1)
+    return np.clip(np.searchsorted(edges, confidences, side="right") - 1, 0, n_bins - 1)
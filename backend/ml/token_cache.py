@@ -0,0 +1,182 @@
+# backend/ml/token_cache.py
+"""
+On-disk cache of the preprocessed (tokenized) inputs of the embedding models.
+
+`embedding_model.process_data` maps gene names, ranks genes and tokenizes every cell, which is a large share of
+the run time on big files. The output is cached per (dataset content hash, model, tokenizer version):
+
+- entries are stored with the Hugging Face `datasets` Arrow format (`save_to_disk`), and reloaded with
+  `load_from_disk`, which memory-maps the tokens instead of reading them into RAM
+- entries are written to a temporary directory and renamed, so a crashed worker never leaves a partial entry
+- the cache is bounded by `TOKEN_CACHE_MAX_BYTES`, evicting the least recently used entries
+
+Preprocessed inputs that are not Hugging Face datasets (no `save_to_disk`) are not cached.
+"""
+import hashlib
+import os
+import shutil
+import time
+import uuid
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOKEN_CACHE_DIR = os.getenv("HELICAL_TOKEN_CACHE_DIR", os.path.join(BASE_DIR, "data", "cache", "tokens"))
+TOKEN_CACHE_MAX_BYTES = int(os.getenv("HELICAL_TOKEN_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+# Bump when the preprocessing arguments change
+TOKEN_CACHE_VERSION = "1"
+COMPLETE_MARKER = "_complete"
+
+
+def tokenizer_version(model_name):
+    """
+    Returns the version string of the tokenizer of a model. It changes with the installed helical version,
+    which ships the gene dictionaries and the tokenizers.
+    """
+    try:
+        from importlib.metadata import version
+        helical_version = version("helical")
+    except Exception:
+        helical_version = "unknown"
+    return f"{model_name.lower()}:helical-{helical_version}:v{TOKEN_CACHE_VERSION}"
+
+
+def cache_key(dataset_hash, model_name, gene_names="gene_name"):
+    """
+    Computes the cache key of the preprocessed input of a dataset for a model.
+
+    Args:
+        dataset_hash (str): SHA-256 of the uploaded file
+        model_name (str): Name of the model
+        gene_names (str): Column of `var` holding the gene names
+
+    Returns:
+        str: The cache key
+    """
+    raw = f"{dataset_hash}:{tokenizer_version(model_name)}:{gene_names}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def _entry_path(key):
+    return os.path.join(TOKEN_CACHE_DIR, key)
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def load(key):
+    """
+    Loads a cached preprocessed input, memory-mapped.
+
+    Args:
+        key (str): Cache key
+
+    Returns:
+        Dataset | None: The cached dataset, or None on a cache miss
+    """
+    path = _entry_path(key)
+    marker = os.path.join(path, COMPLETE_MARKER)
+    if not os.path.exists(marker):
+        return None
+    from datasets import load_from_disk
+    try:
+        dataset = load_from_disk(path)
+    except (OSError, ValueError) as e:
+        print(f"Discarding unreadable token cache entry {key}: {e}")
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    os.utime(marker)  # LRU bookkeeping
+    return dataset
+
+
+def store(key, x_processed):
+    """
+    Stores a preprocessed input in the cache and evicts old entries if the cache is over its quota.
+
+    Args:
+        key (str): Cache key
+        x_processed: Output of `embedding_model.process_data`
+
+    Returns:
+        bool: Whether the input was cached
+    """
+    if not hasattr(x_processed, "save_to_disk"):
+        return False
+    os.makedirs(TOKEN_CACHE_DIR, exist_ok=True)
+    path = _entry_path(key)
+    tmp_path = os.path.join(TOKEN_CACHE_DIR, f".tmp-{key}-{uuid.uuid4().hex}")
+    try:
+        x_processed.save_to_disk(tmp_path)
+        open(os.path.join(tmp_path, COMPLETE_MARKER), "w").close()
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not cache preprocessed input {key}: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return False
+    evict()
+    return True
+
+
+def evict(max_bytes=None):
+    """
+    Removes the least recently used entries until the cache fits in `max_bytes`.
+
+    Args:
+        max_bytes (int | None): Quota in bytes, defaults to `TOKEN_CACHE_MAX_BYTES`
+    """
+    max_bytes = TOKEN_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    if not os.path.isdir(TOKEN_CACHE_DIR):
+        return
+    entries = []
+    for name in os.listdir(TOKEN_CACHE_DIR):
+        path = os.path.join(TOKEN_CACHE_DIR, name)
+        marker = os.path.join(path, COMPLETE_MARKER)
+        if name.startswith(".tmp-"):
+            # Leftover of a crashed write, removed once it is clearly stale
+            if time.time() - os.path.getmtime(path) > 24 * 3600:
+                shutil.rmtree(path, ignore_errors=True)
+            continue
+        if os.path.exists(marker):
+            entries.append((os.path.getmtime(marker), _dir_size(path), path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        print(f"Evicting token cache entry {os.path.basename(path)} ({size / 1024 ** 2:.0f} MB)")
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def get_or_process(embedding_model, data, model_name, dataset_hash, gene_names="gene_name"):
+    """
+    Returns the preprocessed input of a dataset, from the cache when possible.
+
+    Args:
+        embedding_model: Helical embedding model
+        data (AnnData): The loaded dataset
+        model_name (str): Name of the model
+        dataset_hash (str | None): SHA-256 of the uploaded file; caching is disabled when None
+        gene_names (str): Column of `var` holding the gene names
+
+    Returns:
+        tuple: (preprocessed input, whether it came from the cache)
+    """
+    if dataset_hash is None:
+        return embedding_model.process_data(data, gene_names=gene_names), False
+    key = cache_key(dataset_hash, model_name, gene_names)
+    cached = load(key)
+    if cached is not None:
+        print(f"Token cache hit for {model_name} ({key[:12]})")
+        return cached, True
+    x_processed = embedding_model.process_data(data, gene_names=gene_names)
+    store(key, x_processed)
+    return x_processed, False
@@ -0,0 +1,99 @@
+# backend/ml/vocabularies.py
+"""
+Gene vocabularies of the embedding models, shared between the workers and the API.
+
+The vocabularies ship with the helical models, which only the workers load. When a worker starts, it exports
+the gene names known by each model to `VOCAB_DIR/<model>.txt` on the shared data volume; the API reads these
+files to compute the vocabulary overlap of uploads without importing the ML stack.
+
+The gene names are looked up on the helical model objects on a best-effort basis: a model whose vocabulary
+cannot be found is skipped, and its overlap is then reported as unknown.
+"""
+import os
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VOCAB_DIR = os.getenv("HELICAL_VOCAB_DIR", os.path.join(BASE_DIR, "data", "vocab"))
+
+# Attribute paths holding a mapping keyed by gene name, tried in order
+VOCABULARY_ATTRIBUTES = [
+    "gene_name_id_dict",      # Geneformer: gene symbol -> Ensembl ID
+    "tk.gene_mapping_dict",   # Geneformer tokenizer mapping
+    "vocab",                  # scGPT: GeneVocab (gene symbol -> token)
+]
+
+_cache = {}
+
+
+def _resolve(obj, path):
+    for attr in path.split("."):
+        obj = getattr(obj, attr, None)
+        if obj is None:
+            return None
+    return obj
+
+
+def vocabulary_of(embedding_model):
+    """
+    Returns the gene names known by a helical embedding model.
+
+    Args:
+        embedding_model: Helical embedding model
+
+    Returns:
+        set | None: The gene names, or None if the vocabulary could not be found
+    """
+    for path in VOCABULARY_ATTRIBUTES:
+        mapping = _resolve(embedding_model, path)
+        if mapping is None:
+            continue
+        if hasattr(mapping, "get_stoi"):
+            mapping = mapping.get_stoi()
+        try:
+            return {str(gene) for gene in mapping}
+        except TypeError:
+            continue
+    return None
+
+
+def export_vocabularies(embedding_models):
+    """
+    Writes the vocabulary of each model to `VOCAB_DIR`, one gene name per line.
+
+    Args:
+        embedding_models (dict): Model name -> helical embedding model
+    """
+    os.makedirs(VOCAB_DIR, exist_ok=True)
+    for name, model in embedding_models.items():
+        genes = vocabulary_of(model)
+        if genes is None:
+            print(f"No vocabulary found for {name}, skipping export")
+            continue
+        path = os.path.join(VOCAB_DIR, f"{name.lower()}.txt")
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(sorted(genes)))
+        os.replace(tmp_path, path)
+
+
+def load_vocabulary(model_name):
+    """
+    Loads the exported vocabulary of a model, cached until the file changes.
+
+    Args:
+        model_name (str): Name of the model
+
+    Returns:
+        set | None: The gene names, or None if no worker exported the vocabulary yet
+    """
+    path = os.path.join(VOCAB_DIR, f"{model_name.lower()}.txt")
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    cached = _cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path) as f:
+        genes = {line.strip() for line in f if line.strip()}
+    _cache[path] = (mtime, genes)
+    return genes
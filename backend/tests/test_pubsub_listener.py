@@ -0,0 +1,62 @@
+"""
+test_pubsub_listener.py
+
+Author: Vincent Lefeuve
+Date: 2025-07-14
+
+Tests of the storage of published workflow results (see app.pubsub_listener).
+Run from backend/: python -m unittest discover tests
+"""
+import json
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db.database import Base
+from db.models import Workflow
+from app.memoization import attached_result
+from app.cancellation import cancelled_result
+from app.pubsub_listener import apply_workflow_result
+
+
+class ApplyWorkflowResultTest(unittest.TestCase):
+    def setUp(self):
+        engine = create_engine("sqlite://")
+        Base.metadata.create_all(engine)
+        self.db = sessionmaker(bind=engine)()
+        self.db.add(Workflow(id="source", application_id=1, model_id=1, status="pending"))
+        self.db.add(Workflow(id="attached", application_id=1, model_id=1, status="pending", attached_to="source"))
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_attached_workflow_receives_the_result(self):
+        apply_workflow_result(self.db, {"workflow_id": "source", "status": "completed", "metadata": {}})
+
+        attached = self.db.get(Workflow, "attached")
+        self.assertEqual(attached.status, "completed")
+        self.assertEqual(
+            json.loads(attached.result),
+            attached_result({"workflow_id": "source", "status": "completed", "metadata": {}}, "attached", "source"),
+        )
+
+    def test_cancelled_attached_workflow_stays_cancelled(self):
+        attached = self.db.get(Workflow, "attached")
+        attached.status = "cancelled"
+        attached.result = json.dumps(cancelled_result("attached"))
+        self.db.commit()
+
+        for status in ("partial", "completed"):
+            apply_workflow_result(self.db, {"workflow_id": "source", "status": status, "metadata": {}})
+
+        self.db.expire_all()
+        attached = self.db.get(Workflow, "attached")
+        self.assertEqual(self.db.get(Workflow, "source").status, "completed")
+        self.assertEqual(attached.status, "cancelled")
+        self.assertEqual(json.loads(attached.result), cancelled_result("attached"))
+
+
+if __name__ == "__main__":
+    unittest.main()
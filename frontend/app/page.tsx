@@ -86,7 +86,7 @@ export default function Dashboard() {
 
   const convertToJobState = (status: string, info: any): JobState => {
     if (status === "SUCCESS") return "success"
-    if (status === "PROGRESS" || status === "PENDING") {
+    if (status === "PROGRESS" || status === "PENDING" || status === "STARTED") {
       switch (info?.stage?.toUpperCase()) {
         case "EMBEDDING":
           return "embedding"